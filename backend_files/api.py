@@ -1,26 +1,338 @@
 from db_connector import DBManager
-from flask import Flask, request, Response
+from db_replicas import RecentWriters
+from spatial_index import SpatialIndex
+from clustering import ClusterIndex
+from report_log import ReportSink
+from password_hashing import PasswordService, PasswordQueueFull
+from json_encoding import JSONEncoder
+from payload_cache import PayloadCache
+from compression import Compressor
+from request_metrics import RequestMetrics, render_gauges
+from log_setup import setup_logging
+from api_common import (RequestError, IndexCursor, check_admin, password_busy_result, write_result, public_user,
+                        opening_hours_now, clock_resource, index_locations, listing_page, page_headers, listing_filters,
+                        nearby_query, with_distances, search_query, viewport_query, viewport_toilet_ids,
+                        viewport_result, ids_query, batch_items, batch_result, sync_query, changed_ids, sync_result,
+                        expired_sync_result, report_fields, reports_query, query_reports, reports_headers, not_modified,
+                        cached_response, set_validators)
+from flask import Flask, request, Response, g
 from config import *
-import json
 import datetime
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+setup_logging(log_level, log_sample_rate)
+log = logging.getLogger("toilets.api")
+
+json_encoder = JSONEncoder(json_backend)
+payload_cache = PayloadCache(payload_cache_max_bytes, payload_cache_max_entry_bytes)
+compressor = Compressor(compression_min_size, gzip_level, brotli_quality,
+                        snapshot_gzip_level, snapshot_brotli_quality)
+# Compresses payload cache snapshots at the slow snapshot settings, away from the request threads
+snapshot_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="snapshots")
+
+
 class Result:
-    def __init__(self, status: int, message):
+    def __init__(self, status: int, message, headers: dict = None):
         self.status = status
         self.message = message
+        self.headers = headers
 
     def display(self):
-        return Response(json.dumps(self.message, default=str), self.status, mimetype='application/json')
+        return Response(json_encoder.dumps(self.message), self.status, headers=self.headers,
+                        mimetype='application/json')
+
+
+def stream_json_array(items, batch_size: int = 500):
+    # Writes the same bytes json_encoder would for the whole list, without ever holding the whole list
+    return Response(json_encoder.iter_array(items, batch_size), 200, mimetype='application/json')
+
+
+def get_listing(listing: str, filters: dict = None):
+    # ?after_id=&limit= returns one keyset page, without them the whole listing is streamed
+    paging = listing_page(request.args)
+    if paging is None:
+        return stream_json_array(db.stream_listing(listing, filters=filters))
+
+    after_id, limit = paging
+    page = db.get_listing_page(listing, after_id, limit, filters)
+
+    return Result(200, page, page_headers(page, limit)).display()
 
 
 app = Flask(__name__)
 app.config['JSON_SORT_KEYS'] = False
 
-db = DBManager(host, username, password, database_name)
+
+@app.errorhandler(RequestError)
+def request_error(e: RequestError):
+    return Result(e.status, {"Message": e.message}).display()
+
+
+@app.errorhandler(PasswordQueueFull)
+def password_queue_full(e: PasswordQueueFull):
+    log.warning(e)
+    return Result(*password_busy_result(e)).display()
+
+
+db = DBManager(host, username, password, database_name,
+               pool_min_size=pool_min_size, pool_max_size=pool_max_size, pool_timeout=pool_timeout,
+               version_refresh_interval=version_refresh_interval,
+               user_cache_size=user_cache_size, user_cache_ttl=user_cache_ttl,
+               passwords=PasswordService(argon2_time_cost, argon2_memory_cost, argon2_parallelism,
+                                         password_workers, password_queue_size),
+               replica_hosts=replica_hosts, replica_max_lag=replica_max_lag,
+               replica_check_interval=replica_check_interval)
+
+recent_writers = RecentWriters(read_your_writes_seconds)
+
+request_metrics = RequestMetrics(max_logged_queries=slow_request_max_queries)
+db.set_query_listener(request_metrics.query)
+
+
+def store_payload(etag: str, body: bytes, headers: list):
+    # The body is served from the cache straight away, its compressed snapshots once snapshot_executor made them
+    payload_cache.put(etag, body, headers)
+    snapshot_executor.submit(store_snapshot, etag, body)
+
+
+def store_snapshot(etag: str, body: bytes):
+    try:
+        payload_cache.add_variants(etag, body, compressor.snapshot(body))
+    except Exception:
+        log.exception("Compressing the snapshot of %s failed", etag)
+
+
+def cache_payload(etag: str, response: Response):
+    # Keeps the encoded body, and its compressed snapshots, for the next request with the same ETag.
+    # Streamed bodies are kept once they are complete, by one request at a time.
+    headers = [(name, value) for name, value in response.headers if name.lower() != "content-length"]
+
+    if not response.is_streamed:
+        store_payload(etag, response.get_data(), headers)
+        return
+
+    if not payload_cache.claim(etag):
+        return
+
+    def tee(chunks):
+        parts = list()
+        size = 0
+        try:
+            for chunk in chunks:
+                if parts is not None:
+                    parts.append(chunk)
+                    size += len(chunk)
+                    if size > payload_cache.max_entry_bytes:
+                        parts = None
+                yield chunk
+
+            if parts is not None:
+                store_payload(etag, b"".join(parts), headers)
+        finally:
+            # Also when the client went away before the end
+            payload_cache.release(etag)
+            if hasattr(chunks, "close"):
+                chunks.close()
+
+    response.response = tee(response.response)
+
+
+def conditional(*keys, cache: bool = False, resource=None):
+    # ETag / Last-Modified from the write versions of `keys`, formatted with the view arguments.
+    # The ETag also covers the path and query, or resource() for responses that depend on more than those:
+    # it returns (resource, clocked), clocked responses get no Last-Modified and ignore If-Modified-Since.
+    # A matching If-None-Match or If-Modified-Since is answered with 304 before the view runs.
+    # With cache=True the encoded body is kept in payload_cache and reused until one of the versions changes.
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            path, clocked = resource() if resource is not None else (request.full_path, False)
+            etag, last_modified = db.get_etag(path, [key.format(**kwargs) for key in keys])
+            if clocked:
+                last_modified = None
+
+            current, matched = not_modified(request.if_none_match, request.if_modified_since, etag, last_modified,
+                                            compressor.encodings)
+            cached = payload_cache.get(etag) if cache and not current else None
+
+            if current:
+                response = Response(status=304)
+            elif cached is not None:
+                response = cached_response(Response, cached, compressor, request.accept_encodings)
+            else:
+                response = view(**kwargs)
+                if response.status_code != 200:
+                    return response
+                if cache:
+                    cache_payload(etag, response)
+
+            set_validators(response, etag, matched, last_modified)
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def request_time() -> datetime.time:
+    # opening_hours_now() once per request, the ETag and the open_now filter must see the same minute
+    if "opening_hours_now" not in g:
+        g.opening_hours_now = opening_hours_now()
+    return g.opening_hours_now
+
+
+def toilets_resource() -> tuple:
+    return clock_resource(request.full_path, request.args, request_time())
+
+
+report_sink = ReportSink(report_log_directory, report_queue_size, report_flush_interval,
+                         report_max_bytes, report_max_age, report_max_files)
+
+toilet_index = SpatialIndex()
+cluster_index = ClusterIndex()
+index_cursor = IndexCursor()
+toilet_index_lock = threading.Lock()
+
+
+def sync_toilet_index():
+    # Only toilets written since the last sync are read, the indexes are never rebuilt
+    with toilet_index_lock:
+        index_cursor.start(db.versions.get("toilets_")[0])
+
+        while True:
+            if index_cursor.cursor is None:
+                # Taken before the locations are read, see DBManager.get_sync_cursor()
+                cursor = db.get_sync_cursor()
+                index_locations(toilet_index, cluster_index, db.get_toilet_locations())
+                index_cursor.loaded(cursor)
+                return
+
+            toilet_ids, more = index_cursor.advance(db.get_toilet_changes(index_cursor.cursor,
+                                                                          index_cursor.PAGE_SIZE))
+            if toilet_ids:
+                index_locations(toilet_index, cluster_index, db.get_toilet_locations(toilet_ids))
+            if toilet_ids is not None and not more:
+                return
+
+
+def refresh_toilet_index():
+    # Picks up toilets added through other worker processes
+    if index_cursor.needs_sync(db.versions.get("toilets_")[0]):
+        sync_toilet_index()
+
+
+with app.app_context():
+    sync_toilet_index()
+
+
+@app.before_request
+def start_request_metrics():
+    g.request_metrics = request_metrics.begin()
+
+
+@app.after_request
+def record_request_metrics(response):
+    # Registered before the other after_request hooks so it runs last. The request is finished when the
+    # server closes the response, so a streamed body and the statements fetching it are counted too.
+    active = g.pop("request_metrics", None)
+    if active is None:
+        return response
+
+    if response.is_streamed:
+        response.response = request_metrics.bind(active, response.response)
+
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    method, full_path, status = request.method, request.full_path, response.status_code
+    response.call_on_close(lambda: finish_request_metrics(active, method, route, full_path, status))
+
+    return response
+
+
+def finish_request_metrics(active, method: str, route: str, full_path: str, status: int):
+    seconds, query_count, queries = request_metrics.end(active, method, route, status)
+
+    if seconds >= slow_request_seconds:
+        statements = "\n".join(f"  {query_seconds * 1000:.1f} ms  {describe_query(query)}"
+                               for query, query_seconds in queries)
+        log.warning("Slow request %s %s: %d in %.3f s, %d queries\n%s", method, full_path, status, seconds,
+                    query_count, statements)
+
+
+def describe_query(query, max_length: int = 500) -> str:
+    if isinstance(query, bytes):
+        query = query.decode(errors="replace")
+    query = " ".join(str(query).split())
+    return query if len(query) <= max_length else query[:max_length] + "..."
+
+
+def client_key() -> str:
+    return request.headers.get("X-Client-Id") or request.remote_addr
+
+
+@app.before_request
+def route_db_reads():
+    # Reads go to a replica, except for clients that wrote within read_your_writes_seconds.
+    # Those are recognised by the cookie set below, which works across worker processes,
+    # or by this process' own record of their writes.
+    if db.replicas is None:
+        return
+
+    primary_until = request.cookies.get("primary_until", 0, type=float)
+    db.route_reads(request.method in ("GET", "HEAD") and primary_until < time.time()
+                   and not recent_writers.recently_wrote(client_key()))
+
+
+@app.after_request
+def remember_writer(response):
+    if db.replicas is not None and request.method == "POST" and response.status_code < 400:
+        recent_writers.wrote(client_key())
+        response.set_cookie("primary_until", str(time.time() + read_your_writes_seconds),
+                            max_age=read_your_writes_seconds)
+    return response
+
+
+@app.teardown_appcontext
+def release_db_connection(exception):
+    # Give the request's connection back to the pool, rolling back anything left uncommitted
+    db.release()
+
+
+@app.after_request
+def compress_response(response):
+    # JSON bodies that weren't served from a snapshot are compressed here. Streamed ones are compressed
+    # chunk by chunk, whatever their size: they are the whole listings.
+    if (response.mimetype != "application/json" or response.status_code in (204, 304)
+            or "Content-Encoding" in response.headers):
+        return response
+
+    if not response.is_streamed:
+        body = response.get_data()
+        if len(body) < compressor.min_size:
+            return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = compressor.negotiate(request.accept_encodings)
+    if encoding:
+        if response.is_streamed:
+            response.response = compressor.compress_chunks(response.response, encoding)
+        else:
+            response.set_data(compressor.compress(body, encoding))
+        response.headers["Content-Encoding"] = encoding
+
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag(f"{etag}-{encoding}", weak)
+
+    return response
 
 
 @app.get('/')
 def index():
-    print("Sending server status...")
+    log.info("Sending server status...")
 
     try:
         return Result(200, {"Status": "Server online"}).display()
@@ -28,23 +340,81 @@ def index():
         return Result(500, {'Status': "Server error: " + str(e)}).display()
 
 
+@app.get('/metrics')
+def get_metrics():
+    body = request_metrics.render()
+    body += render_gauges("db_pool", "Primary connection pool counters.", db.pool.metrics())
+    if db.replicas is not None:
+        for replica in db.replicas.replicas:
+            body += render_gauges("db_replica_pool", "Replica connection pool counters.", replica.pool.metrics(),
+                                  replica=replica.name)
+    body += render_gauges("prepared_statements", "Prepared statement counters.", db.statements.metrics())
+    body += render_gauges("user_cache", "User cache counters.", db.user_cache.metrics())
+    body += render_gauges("payload_cache", "Payload cache counters.", payload_cache.metrics())
+    body += render_gauges("compression", "Response compression counters.", compressor.metrics())
+    body += render_gauges("password_hashing", "Password hashing pool counters.", db.passwords.metrics())
+    body += render_gauges("report_sink", "Report log counters.", report_sink.metrics())
+
+    return Response(body, 200, content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get('/stats/pool')
+def get_pool_stats():
+    return Result(200, db.pool.metrics()).display()
+
+
+@app.get('/stats/statements')
+def get_statement_stats():
+    return Result(200, db.statements.metrics()).display()
+
+
+@app.get('/stats/replicas')
+def get_replica_stats():
+    return Result(200, db.replicas.metrics() if db.replicas is not None else {"replicas": []}).display()
+
+
+@app.get('/stats/user_cache')
+def get_user_cache_stats():
+    return Result(200, db.user_cache.metrics()).display()
+
+
+@app.get('/stats/payload_cache')
+def get_payload_cache_stats():
+    return Result(200, {"json_backend": json_encoder.backend, **payload_cache.metrics()}).display()
+
+
+@app.get('/stats/compression')
+def get_compression_stats():
+    return Result(200, compressor.metrics()).display()
+
+
+@app.post('/schema/refresh')
+def refresh_schema():
+    log.info("Refreshing schema...")
+    check_admin(request.headers.get("Authorization"), admin_token)
+
+    db.refresh_schema()
+
+    return Result(200, {"Message": "Schema refreshed", "Tables": db.schema.tables()}).display()
+
+
 @app.get('/users')
+@conditional("users_", cache=True)
 def get_all_users():
-    print("Getting all users...")
+    log.info("Getting all users...")
 
-    users = db.get_all_users()
-
-    return Result(200, users).display()
+    return get_listing("users_")
 
 
 @app.get('/users/<id>')
+@conditional("users_")
 def get_user_by_id(id: int):
-    print("Getting user by id...")
-
-    user = db.get_user_by_id(id)
+    log.info("Getting user by id...")
 
-    user.pop("login_", None)
-    user.pop("password_hashed_", None)
+    try:
+        user = db.user_cache.get(int(id))
+    except ValueError:
+        user = None
 
     if user:
         return Result(200, user).display()
@@ -54,18 +424,14 @@ def get_user_by_id(id: int):
 
 @app.post('/users')
 def add_user():
-    print("Adding user...")
+    log.info("Adding user...")
 
-    insertion_res = db.add_user(request.json)
-    if not insertion_res:
-        return Result(201, {"Message": "User created"}).display()
-    else:
-        return Result(500, {"Message": str(insertion_res)}).display()
+    return Result(*write_result(db.add_user(request.json), "User created")).display()
 
 
 @app.get('/user_exists/<login>')
 def check_if_user_exists(login: str):
-    print("Getting login availability...")
+    log.info("Getting login availability...")
 
     res = db.check_if_user_exists(login)
 
@@ -73,123 +439,150 @@ def check_if_user_exists(login: str):
 
 
 @app.get('/toilets')
+@conditional("toilets_", "toilet_reviews_", "toilet_verifications_", "users_", cache=True, resource=toilets_resource)
 def get_all_toilets():
-    print("Getting all toilets...")
+    log.info("Getting all toilets...")
 
-    toilets = db.get_all_toilets()
+    return get_listing("toilets_", listing_filters(request.args, request_time()))
 
-    for toilet in toilets:
-        avg = 0
-        user_id = toilet["author_id_"]
-        user = db.get_user_by_id(user_id)
-        name = user["display_name_"]
 
-        reviews = db.get_reviews_by_toilet_id(toilet["id_"])
-        count = 0
-        if reviews:
+@app.get('/toilets/<int:id>')
+@conditional("toilets_", "toilet_reviews_:{id}", "toilet_verifications_", "users_", cache=True)
+def get_toilet_by_id(id: int):
+    log.info("Getting toilet by id...")
 
-            for review in reviews:
-                rating = review["rating_"]
-                avg += rating
-                count += 1
-        if count:
-            avg = avg / count
-        toilet["average_rating_"] = avg
-        toilet["author_name_"] = name
-        toilet["review_count_"] = count
+    toilets = db.get_toilets_with_details([id])
 
-    return Result(200, toilets).display()
+    if toilets:
+        return Result(200, toilets[0]).display()
+    else:
+        return Result(404, {"Message": "Toilet not found!"}).display()
 
 
-@app.get('/toilets/<id>')
-def get_toilet_by_id(id: int):
-    print("Getting toilet by id...")
+@app.get('/toilets/nearby')
+@conditional("toilets_", "toilet_reviews_", "toilet_verifications_", "users_")
+def get_nearby_toilets():
+    log.info("Getting nearby toilets...")
 
-    toilet = db.get_toilet(id)
+    refresh_toilet_index()
 
-    avg = 0
-    user_id = toilet["author_id_"]
-    user = db.get_user_by_id(user_id)
-    name = user["display_name_"]
+    nearest = toilet_index.nearest(*nearby_query(request.args))
+    toilets = db.get_toilets_with_details([toilet_id for _, toilet_id in nearest])
 
-    reviews = db.get_reviews_by_toilet_id(toilet["id_"])
-    count = 0
-    if reviews:
+    return Result(200, with_distances(nearest, toilets)).display()
+
+
+@app.get('/toilets/search')
+@conditional("toilets_", "toilet_reviews_", "toilet_verifications_", "users_")
+def search_toilets():
+    log.info("Searching toilets...")
+
+    text, limit, reviews = search_query(request.args)
+
+    return Result(200, db.search_toilets(text, limit, reviews, search_rating_weight)).display()
 
-        for review in reviews:
-            rating = review["rating_"]
-            avg += rating
-            count += 1
 
-    if count:
-        avg = avg / count
+@app.get('/toilets/viewport')
+@conditional("toilets_", "toilet_reviews_", "toilet_verifications_", "users_")
+def get_viewport_toilets():
+    log.info("Getting toilets in viewport...")
 
-    toilet["average_rating_"] = avg
-    toilet["author_name_"] = name
-    toilet["review_count_"] = count
+    refresh_toilet_index()
 
+    box, zoom = viewport_query(request.args)
 
-    if toilet:
-        return Result(200, toilet).display()
+    toilet_ids = viewport_toilet_ids(toilet_index, cluster_index, box, zoom)
+    if toilet_ids is None:
+        return Result(200, viewport_result(clusters=cluster_index.clusters(zoom, *box))).display()
+
+    toilets = db.get_toilets_with_details(toilet_ids) if toilet_ids else []
+    return Result(200, viewport_result(toilets=toilets)).display()
+
+
+@app.get('/toilets/<int:id>/verification')
+@conditional("toilets_", "toilet_verifications_")
+def get_toilet_verification(id: int):
+    log.info("Getting toilet verification tally...")
+
+    tallies = db.get_verification_tallies([id])
+    if tallies:
+        return Result(200, tallies[0]).display()
     else:
         return Result(404, {"Message": "Toilet not found!"}).display()
 
 
+@app.get('/toilets/verification')
+@conditional("toilets_", "toilet_verifications_")
+def get_toilets_verification():
+    log.info("Getting toilet verification tallies...")
+
+    return Result(200, db.get_verification_tallies(ids_query(request.args))).display()
+
+
 @app.post('/toilets')
 def add_toilet():
-    print("Adding toilet...")
+    log.info("Adding toilet...")
 
     insertion_res = db.add_toilet(request.json)
-    print(insertion_res)
     if not insertion_res:
-        return Result(201, {"Message": "Toilet created"}).display()
-    else:
-        return Result(500, {"Message": str(insertion_res)}).display()
+        sync_toilet_index()
+
+    return Result(*write_result(insertion_res, "Toilet created")).display()
+
+
+def add_batch(kind: str):
+    # (created statuses, the items, the response)
+    items = batch_items(request.get_json(silent=True))
+
+    statuses = db.add_batch(kind, items)
+    created, status_code = batch_result(statuses)
+
+    return created, items, Result(status_code, statuses).display()
+
+
+@app.post('/toilets/batch')
+def add_toilets_batch():
+    log.info("Adding toilets batch...")
+
+    created, _, response = add_batch("toilets")
+    if created:
+        sync_toilet_index()
+
+    return response
 
 
 @app.post('/users/login')
 def check_login_and_password():
-    print("Checking password...")
+    log.info("Checking password...")
 
     res = db.check_password(request.json)
 
     if res:
-        res.pop("login_", None)
-        res.pop("password_hashed_", None)
-        return Result(200, res).display()
+        return Result(200, public_user(res)).display()
     else:
         return Result(404, {}).display()
 
 
 @app.get('/reviews')
+@conditional("toilet_reviews_", "users_", cache=True)
 def get_all_reviews():
-    print("Getting all reviews...")
-
-    reviews = db.get_all_reviews()
-    for review in reviews:
-        user_id = review["user_id_"]
-        user = db.get_user_by_id(user_id)
-        name = user["display_name_"]
-
-        review["user_display_name_"] = name
-        print(review)
+    log.info("Getting all reviews...")
 
-    return Result(200, reviews).display()
+    return get_listing("toilet_reviews_")
 
 
 @app.get('/reviews/<id>')
+@conditional("toilet_reviews_:{id}", "users_", cache=True)
 def get_reviews_by_toilet_id(id: int):
-    print("Getting reviews by toilet id...")
+    log.info("Getting reviews by toilet id...")
 
     reviews = db.get_reviews_by_toilet_id(id)
 
     if reviews:
+        users = db.user_cache.get_many(review["user_id_"] for review in reviews)
         for review in reviews:
-            user_id = review["user_id_"]
-            user = db.get_user_by_id(user_id)
-            name = user["display_name_"]
-
-            review["user_display_name_"] = name
+            user = users.get(review["user_id_"])
+            review["user_display_name_"] = user["display_name_"] if user else None
 
         return Result(200, reviews).display()
     else:
@@ -198,27 +591,41 @@ def get_reviews_by_toilet_id(id: int):
 
 @app.post('/reviews')
 def add_review():
-    print("Adding review...")
+    log.info("Adding review...")
 
     insertion_res = db.add_review(request.json)
     if not insertion_res:
-        return Result(201, {"Message": "Review created"}).display()
-    else:
-        return Result(500, {"Message": str(insertion_res)}).display()
+        toilet_id = request.json["toilet_id_"]
+        cluster_index.set_rating(toilet_id, db.get_toilet_rating(toilet_id))
+
+    return Result(*write_result(insertion_res, "Review created")).display()
+
+
+@app.post('/reviews/batch')
+def add_reviews_batch():
+    log.info("Adding reviews batch...")
+
+    created, items, response = add_batch("reviews")
+    if created:
+        toilet_ids = {int(items[status["index_"]]["toilet_id_"]) for status in created}
+        for toilet_id, rating in db.get_toilet_ratings(toilet_ids).items():
+            cluster_index.set_rating(toilet_id, rating)
+
+    return response
 
 
 @app.get('/verifications')
+@conditional("toilet_verifications_", cache=True)
 def get_all_verifications():
-    print("Getting all verifications...")
-
-    verifications = db.get_all_verifications()
+    log.info("Getting all verifications...")
 
-    return Result(200, verifications).display()
+    return get_listing("toilet_verifications_")
 
 
 @app.get('/verifications/<id>')
+@conditional("toilet_verifications_")
 def get_verifications_by_id(id: int):
-    print("Getting verifications by id...")
+    log.info("Getting verifications by id...")
 
     verification = db.get_verification(id)
     if verification:
@@ -229,44 +636,79 @@ def get_verifications_by_id(id: int):
 
 @app.post('/verifications')
 def add_verification():
-    print("Adding verification...")
+    log.info("Adding verification...")
 
-    insertion_res = db.add_verification(request.json)
-    if not insertion_res:
-        return Result(201, {"Message": "Verification created"}).display()
-    else:
-        return Result(500, {"Message": str(insertion_res)}).display()
+    return Result(*write_result(db.add_verification(request.json), "Verification created")).display()
+
+
+@app.get('/sync')
+def sync_changes():
+    log.info("Getting changes...")
+
+    since, limit = sync_query(request.args)
+
+    changes = db.get_changes(since, limit)
+    if changes is None:
+        return Result(*expired_sync_result(since, db.get_sync_cursor())).display()
+
+    changed = changed_ids(changes)
+    res = sync_result(
+        changes, since, limit,
+        toilets=db.get_listing_by_ids("toilets_", changed["toilet"]) if changed["toilet"] else [],
+        reviews=db.get_listing_by_ids("toilet_reviews_", changed["review"]) if changed["review"] else [],
+        verifications=(db.get_listing_by_ids("toilet_verifications_", changed["verification"])
+                       if changed["verification"] else []),
+        users=db.get_users_summaries(changed["user"]) if changed["user"] else [])
+
+    return Result(200, res).display()
+
+
+@app.post('/verifications/batch')
+def add_verifications_batch():
+    log.info("Adding verifications batch...")
+
+    _, _, response = add_batch("verifications")
+
+    return response
 
 
 @app.post('/users/change_name')
 def change_display_name():
-    print("Changing name")
-
-    update_res = db.change_name(request.json)
+    log.info("Changing name")
 
-    if not update_res:
-        return Result(200, {"Message": "Display Name updated"}).display()
-    else:
-        return Result(500, {"Message": set(update_res)}).display()
+    return Result(*write_result(db.change_name(request.json), "Display Name updated", 200)).display()
 
 
 @app.post("/toilets/report")
 def report_toilet():
-    report_data = request.json
-
-    try:
-        user_id = report_data["user_id_"]
-        toilet_id = report_data["toilet_id_"]
-        message = report_data["message_"]
+    user_id, toilet_id, message = report_fields(request.json)
 
-        res_string = f"{datetime.datetime.now().__str__()} - UserID {user_id} ToiletID {toilet_id} Message {message} \n"
-        with open("report_log.txt", "a") as f:
-            f.write(res_string)
+    if report_sink.submit(user_id, toilet_id, message):
         return Result(200, {"Message": "New report added"}).display()
-    except Exception as e:
-        return Result(500, {"Message": str(e)}).display()
+    else:
+        return Result(503, {"Message": "Too many reports, try again later"}).display()
+
+
+@app.get("/admin/reports")
+def get_reports():
+    log.info("Getting reports...")
+
+    check_admin(request.headers.get("Authorization"), admin_token)
+    toilet_id, user_id, before, limit = reports_query(request.args)
+
+    reports = query_reports(report_sink.query, toilet_id, user_id, before, limit)
+
+    return Result(200, reports, reports_headers(reports, limit)).display()
+
+
+@app.get("/stats/passwords")
+def get_password_stats():
+    return Result(200, db.passwords.metrics()).display()
 
 
+@app.get("/stats/reports")
+def get_report_stats():
+    return Result(200, report_sink.metrics()).display()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,369 @@
+import datetime
+import hmac
+import zoneinfo
+
+from config import opening_hours_timezone, password_retry_after
+from db_connector import DUPLICATE_VOTE
+from spatial_index import parse_coordinates
+from validation import toilet_filters
+
+# Route logic shared by api.py (Flask) and asgi_api.py (Quart): reading and checking query arguments and
+# bodies, and shaping response bodies. The apps only add the database calls and the framework glue, so the
+# two can't drift apart. `args` is the request's query MultiDict, the same werkzeug type in both frameworks.
+# Invalid requests raise RequestError, both apps answer it with {"Message": message} and its status.
+
+MAX_VIEWPORT_TOILETS = 500
+MAX_BATCH_SIZE = 1000
+
+opening_hours_zone = zoneinfo.ZoneInfo(opening_hours_timezone)
+
+
+class RequestError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def check_admin(authorization, token):
+    # Admin routes take "Authorization: Bearer <admin_token>", with no admin_token configured they are off
+    if not token:
+        raise RequestError(403, "Admin routes are disabled")
+
+    scheme, _, given = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(given.strip().encode(), token.encode()):
+        raise RequestError(401, "Admin token required")
+
+
+def password_busy_result(e) -> tuple:
+    # (status, body, headers) while the Argon2 pool is saturated: the credentials weren't checked, so
+    # neither a 404 nor a 500 would be true, the client should try again shortly
+    return 503, {"Message": str(e)}, {"Retry-After": str(password_retry_after)}
+
+
+def write_result(error, message: str, status: int = 201) -> tuple:
+    # (status, body) for the None-or-error-string result of a DBManager write
+    if not error:
+        return status, {"Message": message}
+    if error == DUPLICATE_VOTE:
+        return 409, {"Message": "User already verified this toilet"}
+    return 500, {"Message": str(error)}
+
+
+def public_user(user: dict) -> dict:
+    user.pop("login_", None)
+    user.pop("password_hashed_", None)
+    return user
+
+
+def opening_hours_now() -> datetime.time:
+    # To the minute, so open_now answers stay the same for a whole minute and can be cached for it
+    return datetime.datetime.now(opening_hours_zone).time().replace(second=0, microsecond=0)
+
+
+def clock_resource(full_path: str, args, now: datetime.time) -> tuple:
+    # (resource of the ETag, whether the answer depends on the clock). open_now answers change with the clock,
+    # their ETags do too. Their Last-Modified would only follow the writes, so they go without one.
+    if args.get("open_now"):
+        return f"{full_path}@{now:%H:%M}", True
+    return full_path, False
+
+
+def index_locations(toilet_index, cluster_index, locations):
+    # Adds (toilet id, coordinates, rating) rows to both indexes, toilets already in them are left as they are
+    for toilet_id, coordinates, rating in locations:
+        location = parse_coordinates(coordinates)
+        if location:
+            toilet_index.add(toilet_id, *location)
+            cluster_index.add(toilet_id, *location, rating)
+
+
+class IndexCursor:
+    # Where the toilet indexes are in the change log. Toilets are picked up by the log's commit-safe
+    # (tx_, id_) cursor rather than by id: ids are handed out before commit, so a toilet whose transaction
+    # committed after a higher id had been indexed would be skipped for good.
+    # The apps read every location once (cursor None), then the toilet entries after the cursor.
+
+    PAGE_SIZE = 5000
+
+    def __init__(self):
+        self.cursor = None
+        self.version = None  # toilets_ version when the last sync started
+        self.pending = False  # entries after the cursor were still waiting for older transactions
+
+    def needs_sync(self, version) -> bool:
+        return self.cursor is None or self.pending or version != self.version
+
+    def start(self, version):
+        self.version = version
+        self.pending = False
+
+    def loaded(self, cursor: tuple):
+        # Every location was read after `cursor` was taken. One more incremental sync picks up
+        # whatever was still in flight then.
+        self.cursor = tuple(cursor)
+        self.pending = True
+
+    def advance(self, changes) -> tuple:
+        # (ids of the toilets to read, whether to read another page) for a get_toilet_changes() page.
+        # None instead of the ids when the log was compacted past the cursor: everything is read again.
+        if changes is None:
+            self.cursor = None
+            return None, False
+
+        toilet_ids = list()
+        for tx, change_id, toilet_id, committed in changes:
+            if not committed:
+                # Picked up by the next sync, after the transactions before it have finished
+                self.pending = True
+                break
+            self.cursor = (tx, change_id)
+            toilet_ids.append(toilet_id)
+
+        return toilet_ids, len(changes) == self.PAGE_SIZE and not self.pending
+
+
+def listing_page(args):
+    # (after_id, limit) of a keyset page, None when the whole listing is to be streamed
+    if "after_id" not in args and "limit" not in args:
+        return None
+
+    after_id = args.get("after_id", 0, type=int)
+    limit = args.get("limit", 100, type=int)
+    if not 1 <= limit <= 1000:
+        raise RequestError(400, "limit must be between 1 and 1000")
+
+    return after_id, limit
+
+
+def page_headers(page: list, limit: int) -> dict:
+    # A full page may have a next one
+    if len(page) == limit:
+        return {"X-Next-After-Id": str(page[-1]["id_"])}
+    return dict()
+
+
+def listing_filters(args, now) -> dict:
+    try:
+        return toilet_filters(args, now)
+    except ValueError as e:
+        raise RequestError(400, str(e))
+
+
+def nearby_query(args) -> tuple:
+    # (lat, lon, k, radius_m)
+    lat = args.get("lat", type=float)
+    lon = args.get("lon", type=float)
+    k = args.get("k", 10, type=int)
+    radius_m = args.get("radius_m", type=float)
+
+    if lat is None or lon is None or not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise RequestError(400, "Valid lat and lon are required")
+    if not 1 <= k <= 100:
+        raise RequestError(400, "k must be between 1 and 100")
+
+    return lat, lon, k, radius_m
+
+
+def with_distances(nearest: list, toilets: list) -> list:
+    # Toilets in the order of their (distance, toilet id) pairs, with the distance as distance_m_
+    toilets = {toilet["id_"]: toilet for toilet in toilets}
+
+    res = list()
+    for distance, toilet_id in nearest:
+        toilet = toilets.get(toilet_id)
+        if toilet:
+            toilet["distance_m_"] = round(distance, 1)
+            res.append(toilet)
+
+    return res
+
+
+def search_query(args) -> tuple:
+    # (text, limit, reviews). The trigram indexes need a whole trigram, shorter texts would scan every row.
+    text = args.get("q", "").strip()
+    limit = args.get("limit", 20, type=int)
+    reviews = args.get("reviews", "false").lower() == "true"
+
+    if not 3 <= len(text) <= 100:
+        raise RequestError(400, "q must be 3 to 100 characters long")
+    if not 1 <= limit <= 100:
+        raise RequestError(400, "limit must be between 1 and 100")
+
+    return text, limit, reviews
+
+
+def viewport_query(args) -> tuple:
+    # ((min_lat, min_lon, max_lat, max_lon), zoom)
+    try:
+        box = (float(args["min_lat"]), float(args["min_lon"]), float(args["max_lat"]), float(args["max_lon"]))
+        zoom = int(args["zoom"])
+    except (KeyError, ValueError) as e:
+        raise RequestError(400, "Invalid viewport: " + str(e))
+
+    min_lat, min_lon, max_lat, max_lon = box
+    if min_lat > max_lat or not (-90 <= min_lat <= 90 and -90 <= max_lat <= 90
+                                 and -180 <= min_lon <= 180 and -180 <= max_lon <= 180):
+        raise RequestError(400, "Invalid viewport bounds")
+
+    return box, zoom
+
+
+def viewport_toilet_ids(toilet_index, cluster_index, box: tuple, zoom: int):
+    # Ids of the toilets to send one by one, None when the viewport is answered with clusters.
+    # Even fully zoomed in, a very dense box is still answered with clusters.
+    if zoom <= cluster_index.max_zoom:
+        return None
+
+    toilet_ids = toilet_index.within(*box, MAX_VIEWPORT_TOILETS)
+    return toilet_ids if len(toilet_ids) <= MAX_VIEWPORT_TOILETS else None
+
+
+def viewport_result(toilets: list = None, clusters: list = None) -> dict:
+    if clusters is not None:
+        return {"clustered_": True, "toilets_": [], "clusters_": clusters}
+    return {"clustered_": False, "toilets_": toilets, "clusters_": []}
+
+
+def ids_query(args) -> list:
+    try:
+        ids = [int(part) for part in args.get("ids", "").split(",") if part.strip()]
+    except ValueError:
+        raise RequestError(400, "ids must be a comma separated list of integers")
+
+    if not 1 <= len(ids) <= MAX_BATCH_SIZE:
+        raise RequestError(400, f"Between 1 and {MAX_BATCH_SIZE} ids are allowed")
+
+    return ids
+
+
+def batch_items(items) -> list:
+    if not isinstance(items, list) or not items:
+        raise RequestError(400, "Expected a non-empty JSON array")
+    if len(items) > MAX_BATCH_SIZE:
+        raise RequestError(413, f"At most {MAX_BATCH_SIZE} items per batch")
+
+    return items
+
+
+def batch_result(statuses: list) -> tuple:
+    # (created statuses, status code): 201 only when everything went in, 207 tells the client
+    # to look at the per-item statuses
+    created = [status for status in statuses if status["status_"] == "created"]
+    return created, 201 if len(created) == len(statuses) else 207
+
+
+def sync_query(args) -> tuple:
+    # ((tx, id) cursor, limit)
+    try:
+        since = tuple(int(part) for part in args.get("since", "0_0").split("_"))
+        if len(since) != 2:
+            raise ValueError(since)
+    except ValueError:
+        raise RequestError(400, "Invalid sync cursor")
+
+    limit = args.get("limit", 1000, type=int)
+    if not 1 <= limit <= 5000:
+        raise RequestError(400, "limit must be between 1 and 5000")
+
+    return since, limit
+
+
+def changed_ids(changes: list) -> dict:
+    # entity -> ids changed, from (tx_, id_, entity_, entity_id_) change log rows
+    changed = {"toilet": set(), "review": set(), "verification": set(), "user": set()}
+    for _, _, entity, entity_id in changes:
+        changed[entity].add(entity_id)
+    return changed
+
+
+def format_cursor(cursor: tuple) -> str:
+    return "%d_%d" % tuple(cursor)
+
+
+def sync_result(changes: list, since: tuple, limit: int, toilets: list, reviews: list, verifications: list,
+                users: list) -> dict:
+    return {
+        "toilets_": toilets,
+        "reviews_": reviews,
+        "verifications_": verifications,
+        "users_": users,
+        "next_cursor_": format_cursor(changes[-1][:2] if changes else since),
+        "has_more_": len(changes) == limit,
+        "full_resync_": False,
+    }
+
+
+def expired_sync_result(since: tuple, cursor: tuple) -> tuple:
+    # (status, body) for a cursor older than the compaction horizon, with the cursor to sync from once the
+    # listings have been downloaded again. since=0_0, the default, is a new client that has nothing yet:
+    # it gets a regular empty page with full_resync_ set instead of a 410.
+    if since == (0, 0):
+        return 200, {"toilets_": [], "reviews_": [], "verifications_": [], "users_": [],
+                     "next_cursor_": format_cursor(cursor), "has_more_": False, "full_resync_": True}
+
+    return 410, {"Message": "Sync cursor expired, full resync required", "cursor_": format_cursor(cursor)}
+
+
+def report_fields(report_data) -> tuple:
+    # (user id, toilet id, message)
+    try:
+        return report_data["user_id_"], report_data["toilet_id_"], report_data["message_"]
+    except Exception as e:
+        raise RequestError(500, str(e))
+
+
+def reports_query(args) -> tuple:
+    # (toilet id, user id, before, limit)
+    limit = args.get("limit", 50, type=int)
+    if not 1 <= limit <= 500:
+        raise RequestError(400, "limit must be between 1 and 500")
+
+    return args.get("toilet_id", type=int), args.get("user_id", type=int), args.get("before"), limit
+
+
+def query_reports(query, toilet_id: int, user_id: int, before: str, limit: int) -> list:
+    # ReportSink.query, with an unknown `before` cursor answered as a bad request
+    try:
+        return query(toilet_id, user_id, before, limit)
+    except KeyError as e:
+        raise RequestError(400, f"Unknown report id {e.args[0]}")
+
+
+def reports_headers(reports: list, limit: int) -> dict:
+    if len(reports) == limit:
+        return {"X-Next-Before": reports[-1]["id_"]}
+    return dict()
+
+
+def not_modified(if_none_match, if_modified_since, etag: str, last_modified, encodings) -> tuple:
+    # (whether the client's copy is current, the If-None-Match tag that matched if any).
+    # Compressed responses carry "<etag>-<encoding>", any representation of this version matches.
+    if if_none_match:
+        matched = [tag for tag in [etag] + [f"{etag}-{encoding}" for encoding in encodings]
+                   if if_none_match.contains(tag)]
+        return bool(matched), matched[0] if matched else None
+
+    return (last_modified is not None and if_modified_since is not None
+            and last_modified.replace(microsecond=0) <= if_modified_since), None
+
+
+def cached_response(response_class, cached: tuple, compressor, accept_encodings):
+    # A response from a payload_cache entry, in the best compressed snapshot the client accepts
+    body, headers, variants = cached
+    encoding = compressor.negotiate(accept_encodings, tuple(variants))
+    if not encoding:
+        return response_class(body, 200, headers=headers)
+
+    response = response_class(variants[encoding], 200, headers=headers)
+    response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def set_validators(response, etag: str, matched, last_modified):
+    # The ETag of the representation sent, or the one the client matched on a 304
+    encoding = response.headers.get("Content-Encoding")
+    response.set_etag(matched or (f"{etag}-{encoding}" if encoding else etag))
+    if last_modified is not None:
+        response.last_modified = last_modified
@@ -0,0 +1,295 @@
+import datetime
+import unittest
+
+from werkzeug.datastructures import Accept, ETags, MultiDict
+
+import api_common
+from api_common import RequestError
+from clustering import ClusterIndex
+from compression import Compressor
+from db_connector import DUPLICATE_VOTE
+from password_hashing import PasswordQueueFull
+from spatial_index import SpatialIndex
+
+
+class RequestErrorTests(unittest.TestCase):
+    def assertRequestError(self, status: int, function, *args):
+        with self.assertRaises(RequestError) as raised:
+            function(*args)
+        self.assertEqual(status, raised.exception.status)
+        return raised.exception.message
+
+
+class ArgumentTests(RequestErrorTests):
+    def test_listing_page(self):
+        self.assertIsNone(api_common.listing_page(MultiDict()))
+        self.assertEqual((0, 100), api_common.listing_page(MultiDict({"limit": "100"})))
+        self.assertEqual((7, 100), api_common.listing_page(MultiDict({"after_id": "7"})))
+        self.assertRequestError(400, api_common.listing_page, MultiDict({"limit": "0"}))
+        self.assertRequestError(400, api_common.listing_page, MultiDict({"limit": "1001"}))
+
+    def test_page_headers_only_for_full_pages(self):
+        page = [{"id_": 3}, {"id_": 9}]
+        self.assertEqual({"X-Next-After-Id": "9"}, api_common.page_headers(page, 2))
+        self.assertEqual(dict(), api_common.page_headers(page, 3))
+
+    def test_nearby_query(self):
+        self.assertEqual((55.7, 37.6, 10, None), api_common.nearby_query(MultiDict({"lat": "55.7", "lon": "37.6"})))
+        self.assertEqual((0.0, 0.0, 5, 300.0),
+                         api_common.nearby_query(MultiDict({"lat": "0", "lon": "0", "k": "5", "radius_m": "300"})))
+        self.assertRequestError(400, api_common.nearby_query, MultiDict({"lat": "55.7"}))
+        self.assertRequestError(400, api_common.nearby_query, MultiDict({"lat": "91", "lon": "0"}))
+        self.assertRequestError(400, api_common.nearby_query, MultiDict({"lat": "0", "lon": "0", "k": "101"}))
+
+    def test_search_query(self):
+        self.assertEqual(("cafe", 20, False), api_common.search_query(MultiDict({"q": "  cafe "})))
+        self.assertEqual(("cafe", 5, True),
+                         api_common.search_query(MultiDict({"q": "cafe", "limit": "5", "reviews": "True"})))
+        self.assertRequestError(400, api_common.search_query, MultiDict({"q": "   "}))
+        self.assertRequestError(400, api_common.search_query, MultiDict({"q": " ab "}))
+        self.assertEqual("abc", api_common.search_query(MultiDict({"q": "abc"}))[0])
+        self.assertRequestError(400, api_common.search_query, MultiDict({"q": "x" * 101}))
+        self.assertRequestError(400, api_common.search_query, MultiDict({"q": "cafe", "limit": "0"}))
+
+    def test_viewport_query(self):
+        args = {"min_lat": "55", "min_lon": "37", "max_lat": "56", "max_lon": "38", "zoom": "12"}
+        self.assertEqual(((55.0, 37.0, 56.0, 38.0), 12), api_common.viewport_query(MultiDict(args)))
+
+        message = self.assertRequestError(400, api_common.viewport_query, MultiDict({**args, "zoom": "close"}))
+        self.assertTrue(message.startswith("Invalid viewport: "))
+        self.assertRequestError(400, api_common.viewport_query, MultiDict({**args, "min_lat": "57"}))
+        self.assertRequestError(400, api_common.viewport_query, MultiDict({**args, "max_lon": "181"}))
+
+    def test_ids_query(self):
+        self.assertEqual([1, 2, 30], api_common.ids_query(MultiDict({"ids": "1, 2,,30"})))
+        self.assertRequestError(400, api_common.ids_query, MultiDict({"ids": "1,a"}))
+        self.assertRequestError(400, api_common.ids_query, MultiDict())
+        self.assertRequestError(400, api_common.ids_query,
+                                MultiDict({"ids": ",".join(map(str, range(api_common.MAX_BATCH_SIZE + 1)))}))
+
+    def test_sync_query(self):
+        self.assertEqual(((0, 0), 1000), api_common.sync_query(MultiDict()))
+        self.assertEqual(((12, 345), 50), api_common.sync_query(MultiDict({"since": "12_345", "limit": "50"})))
+        for since in ("12", "1_2_3", "a_b"):
+            self.assertRequestError(400, api_common.sync_query, MultiDict({"since": since}))
+        self.assertRequestError(400, api_common.sync_query, MultiDict({"limit": "5001"}))
+
+    def test_reports_query(self):
+        self.assertEqual((4, None, "abc", 50), api_common.reports_query(MultiDict({"toilet_id": "4", "before": "abc"})))
+        self.assertRequestError(400, api_common.reports_query, MultiDict({"limit": "501"}))
+
+    def test_listing_filters_turn_value_errors_into_400(self):
+        self.assertRequestError(400, api_common.listing_filters, MultiDict({"max_cost": "free"}), datetime.time(12))
+
+
+class BodyTests(RequestErrorTests):
+    def test_write_result(self):
+        self.assertEqual((201, {"Message": "Review created"}), api_common.write_result(None, "Review created"))
+        self.assertEqual((200, {"Message": "Display Name updated"}),
+                         api_common.write_result(None, "Display Name updated", 200))
+        self.assertEqual(409, api_common.write_result(DUPLICATE_VOTE, "Verification created")[0])
+        self.assertEqual((500, {"Message": "boom"}), api_common.write_result("boom", "User created"))
+
+    def test_password_busy_result(self):
+        status, body, headers = api_common.password_busy_result(PasswordQueueFull("Too many"))
+        self.assertEqual((503, {"Message": "Too many"}), (status, body))
+        self.assertTrue(int(headers["Retry-After"]) > 0)
+
+    def test_public_user_drops_credentials(self):
+        user = {"id_": 1, "login_": "kepper", "password_hashed_": "$argon2id$...", "display_name_": "Fedya"}
+        self.assertEqual({"id_": 1, "display_name_": "Fedya"}, api_common.public_user(user))
+
+    def test_with_distances_keeps_the_index_order(self):
+        nearest = [(12.345, 3), (40.0, 1), (99.0, 2)]
+        toilets = [{"id_": 1}, {"id_": 3}]  # 2 was deleted since it was indexed
+
+        self.assertEqual([{"id_": 3, "distance_m_": 12.3}, {"id_": 1, "distance_m_": 40.0}],
+                         api_common.with_distances(nearest, toilets))
+
+    def test_batch_items(self):
+        self.assertEqual([{}], api_common.batch_items([{}]))
+        self.assertRequestError(400, api_common.batch_items, None)
+        self.assertRequestError(400, api_common.batch_items, [])
+        self.assertRequestError(400, api_common.batch_items, {"toilet_id_": 1})
+        self.assertRequestError(413, api_common.batch_items, [{}] * (api_common.MAX_BATCH_SIZE + 1))
+
+    def test_batch_result(self):
+        created = {"index_": 0, "status_": "created", "id_": 5}
+        failed = {"index_": 1, "status_": "failed", "message_": "bad rating"}
+
+        self.assertEqual(([created], 201), api_common.batch_result([created]))
+        self.assertEqual(([created], 207), api_common.batch_result([created, failed]))
+        self.assertEqual(([], 207), api_common.batch_result([failed]))
+
+    def test_sync_result(self):
+        changes = [(10, 1, "toilet", 4), (10, 2, "review", 8), (11, 3, "toilet", 4)]
+        self.assertEqual({"toilet": {4}, "review": {8}, "verification": set(), "user": set()},
+                         api_common.changed_ids(changes))
+
+        res = api_common.sync_result(changes, (0, 0), 3, [], [], [], [])
+        self.assertEqual("11_3", res["next_cursor_"])
+        self.assertTrue(res["has_more_"])
+
+        res = api_common.sync_result([], (11, 3), 3, [], [], [], [])
+        self.assertEqual("11_3", res["next_cursor_"])
+        self.assertFalse(res["has_more_"])
+        self.assertFalse(res["full_resync_"])
+
+    def test_expired_sync_result(self):
+        # A new client is told where to sync from, one that fell behind the compaction too, with a 410
+        status, res = api_common.expired_sync_result((0, 0), (900, 52))
+        self.assertEqual(200, status)
+        self.assertEqual(("900_52", False, True), (res["next_cursor_"], res["has_more_"], res["full_resync_"]))
+        self.assertEqual(set(api_common.sync_result([], (0, 0), 1, [], [], [], [])), set(res))
+
+        self.assertEqual((410, {"Message": "Sync cursor expired, full resync required", "cursor_": "900_52"}),
+                         api_common.expired_sync_result((500, 1), (900, 52)))
+
+    def test_check_admin(self):
+        api_common.check_admin("Bearer s3cret", "s3cret")
+        api_common.check_admin("bearer  s3cret", "s3cret")
+
+        self.assertRequestError(403, api_common.check_admin, "Bearer s3cret", None)
+        for authorization in (None, "", "s3cret", "Bearer", "Bearer wrong", "Basic s3cret"):
+            self.assertRequestError(401, api_common.check_admin, authorization, "s3cret")
+
+    def test_query_reports_rejects_unknown_cursors(self):
+        def query(toilet_id, user_id, before, limit):
+            raise KeyError(before)
+
+        message = self.assertRequestError(400, api_common.query_reports, query, None, None, "gone:0", 50)
+        self.assertIn("gone:0", message)
+
+    def test_report_fields(self):
+        self.assertEqual((1, 2, "broken"),
+                         api_common.report_fields({"user_id_": 1, "toilet_id_": 2, "message_": "broken"}))
+        self.assertRequestError(500, api_common.report_fields, {"user_id_": 1})
+
+
+class ViewportTests(unittest.TestCase):
+    def setUp(self):
+        self.toilet_index = SpatialIndex()
+        self.cluster_index = ClusterIndex()
+        api_common.index_locations(self.toilet_index, self.cluster_index,
+                                   [(1, "(55.75, 37.61)", 4.0), (2, "(55.76, 37.62)", 0), (5, "nowhere", 0)])
+
+    def test_unreadable_coordinates_are_skipped(self):
+        self.assertEqual(2, len(self.toilet_index))
+        self.assertEqual(2, sum(cluster["count_"] for cluster in self.cluster_index.clusters(0, -90, -180, 90, 180)))
+
+    def test_indexed_toilets_are_not_added_twice(self):
+        api_common.index_locations(self.toilet_index, self.cluster_index, [(1, "(55.75, 37.61)", 4.0)])
+        self.assertEqual(2, len(self.toilet_index))
+        self.assertEqual(2, len(self.cluster_index))
+
+    def test_zoomed_out_viewports_are_clustered(self):
+        box = (55, 37, 56, 38)
+        self.assertIsNone(api_common.viewport_toilet_ids(self.toilet_index, self.cluster_index, box,
+                                                         self.cluster_index.max_zoom))
+        self.assertEqual({1, 2}, set(api_common.viewport_toilet_ids(self.toilet_index, self.cluster_index, box,
+                                                                    self.cluster_index.max_zoom + 1)))
+
+    def test_viewport_result(self):
+        self.assertEqual({"clustered_": True, "toilets_": [], "clusters_": [{}]},
+                         api_common.viewport_result(clusters=[{}]))
+        self.assertEqual({"clustered_": False, "toilets_": [], "clusters_": []}, api_common.viewport_result(toilets=[]))
+
+
+class IndexCursorTests(unittest.TestCase):
+    def test_loads_everything_first(self):
+        cursor = api_common.IndexCursor()
+        self.assertTrue(cursor.needs_sync(1))
+
+        cursor.start(1)
+        cursor.loaded((100, 7))
+        self.assertEqual((100, 7), cursor.cursor)
+        # Whatever was in flight while the locations were read
+        self.assertTrue(cursor.needs_sync(1))
+
+    def test_advances_over_committed_entries(self):
+        cursor = api_common.IndexCursor()
+        cursor.loaded((100, 7))
+        cursor.start(2)
+
+        self.assertEqual(([12, 9], False), cursor.advance([(101, 8, 12, True), (103, 11, 9, True)]))
+        self.assertEqual((103, 11), cursor.cursor)
+        self.assertFalse(cursor.needs_sync(2))
+        self.assertTrue(cursor.needs_sync(3))
+
+    def test_lower_id_committing_late_is_picked_up(self):
+        # Toilet 9 got its id first but committed after 12 was indexed
+        cursor = api_common.IndexCursor()
+        cursor.loaded((100, 7))
+        cursor.start(2)
+
+        self.assertEqual(([12], False), cursor.advance([(102, 8, 12, True), (105, 9, 9, False)]))
+        self.assertEqual((102, 8), cursor.cursor)
+        self.assertTrue(cursor.needs_sync(2))
+
+        cursor.start(2)
+        self.assertEqual(([9], False), cursor.advance([(105, 9, 9, True)]))
+        self.assertFalse(cursor.needs_sync(2))
+
+    def test_full_pages_ask_for_more(self):
+        cursor = api_common.IndexCursor()
+        cursor.loaded((0, 0))
+        cursor.start(1)
+
+        changes = [(1, change_id, change_id, True) for change_id in range(1, cursor.PAGE_SIZE + 1)]
+        toilet_ids, more = cursor.advance(changes)
+        self.assertEqual(cursor.PAGE_SIZE, len(toilet_ids))
+        self.assertTrue(more)
+
+    def test_compacted_past_the_cursor_loads_again(self):
+        cursor = api_common.IndexCursor()
+        cursor.loaded((100, 7))
+        cursor.start(2)
+
+        self.assertEqual((None, False), cursor.advance(None))
+        self.assertIsNone(cursor.cursor)
+        self.assertTrue(cursor.needs_sync(2))
+
+
+class ConditionalTests(unittest.TestCase):
+    last_modified = datetime.datetime(2026, 5, 1, 12, 0, 0, 500000, tzinfo=datetime.timezone.utc)
+
+    def test_if_none_match_matches_every_representation(self):
+        self.assertEqual((True, "abc"), api_common.not_modified(ETags(["abc"]), None, "abc", None, ("br", "gzip")))
+        self.assertEqual((True, "abc-gzip"),
+                         api_common.not_modified(ETags(["old", "abc-gzip"]), None, "abc", None, ("br", "gzip")))
+        self.assertEqual((False, None), api_common.not_modified(ETags(["old"]), None, "abc", None, ("gzip",)))
+
+    def test_if_none_match_wins_over_if_modified_since(self):
+        self.assertEqual((False, None), api_common.not_modified(ETags(["old"]), self.last_modified, "abc",
+                                                                self.last_modified, ("gzip",)))
+
+    def test_if_modified_since_to_the_second(self):
+        since = self.last_modified.replace(microsecond=0)
+        self.assertEqual((True, None), api_common.not_modified(None, since, "abc", self.last_modified, ()))
+        self.assertEqual((False, None), api_common.not_modified(None, since - datetime.timedelta(seconds=1), "abc",
+                                                                self.last_modified, ()))
+        self.assertEqual((False, None), api_common.not_modified(None, since, "abc", None, ()))
+
+    def test_clock_resource(self):
+        now = datetime.time(23, 59)
+        self.assertEqual(("/toilets?open_now=true@23:59", True),
+                         api_common.clock_resource("/toilets?open_now=true", MultiDict({"open_now": "true"}), now))
+        self.assertEqual(("/toilets?cost=0", False), api_common.clock_resource("/toilets?cost=0", MultiDict(), now))
+
+    def test_cached_response_negotiates_a_snapshot(self):
+        from flask import Response
+
+        compressor = Compressor(0, 6, 5, 9, 11)
+        cached = (b"[1]", [("Content-Type", "application/json")], {"gzip": b"gzipped"})
+
+        response = api_common.cached_response(Response, cached, compressor, Accept([("gzip", 1)]))
+        self.assertEqual(b"gzipped", response.get_data())
+        self.assertEqual("gzip", response.headers["Content-Encoding"])
+
+        api_common.set_validators(response, "abc", None, self.last_modified)
+        self.assertEqual(("abc-gzip", False), response.get_etag())
+        self.assertEqual(self.last_modified.replace(microsecond=0), response.last_modified)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,43 +1,298 @@
-import unittest, requests
+import gzip
+import os
+import tempfile
+import threading
+import unittest
 
+import psycopg2
 
-class MyTestCase(unittest.TestCase):
-    def test_something(self):
-        self.assertEqual(True, True)  # add assertion here
+import config
 
+# Route tests for api.py through the Flask test client, on the scratch database config.test_database_name
+# (same host and credentials as the app). Its tables are created from queries.txt when missing and emptied
+# once per run, before api is imported. Every test adds its own rows and only looks at those.
+# Skipped when the database can't be reached.
 
-if __name__ == '__main__':
-    unittest.main()
+api = None
+
+
+def connect_test_database():
+    return psycopg2.connect(host=config.host, dbname=config.test_database_name,
+                            user=config.username, password=config.password)
+
+
+def setUpModule():
+    # Also run by asgi_api_tests, only the first call empties the database
+    global api
+    if api is not None:
+        return
+
+    try:
+        conn = connect_test_database()
+    except psycopg2.OperationalError as e:
+        raise unittest.SkipTest(f"Test database {config.test_database_name} is not available: {e}")
+
+    try:
+        with conn, conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('users_')")
+            if cur.fetchone()[0] is None:
+                with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "queries.txt"),
+                          encoding="utf-8") as f:
+                    cur.execute(f.read())
+
+            cur.execute("TRUNCATE users_, toilets_, toilet_reviews_, toilet_verifications_, toilet_ratings_, "
+                        "toilet_verification_tallies_, change_log_, data_versions_, import_progress_ "
+                        "RESTART IDENTITY")
+            cur.execute("UPDATE change_log_horizon_ SET tx_ = 0, id_ = 0")
+    finally:
+        conn.close()
+
+    # api.py connects and starts its report writer on import
+    config.database_name = config.test_database_name
+    config.report_log_directory = tempfile.mkdtemp(prefix="toilet_reports_")
+    config.admin_token = "test-admin-token"
+
+    import api as api_module
+    api = api_module
+
+
+class ApiTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = api.app.test_client()
+
+    def get_json(self, path: str, status: int = 200, **kwargs):
+        response = self.client.get(path, **kwargs)
+        self.assertEqual(status, response.status_code, response.get_data(as_text=True))
+        return response.get_json()
+
+    def post_json(self, path: str, body, status: int = 201):
+        response = self.client.post(path, json=body)
+        self.assertEqual(status, response.status_code, response.get_data(as_text=True))
+        return response.get_json()
+
+    def add_user(self, display_name: str = "Tester") -> int:
+        login = f"test_{os.urandom(6).hex()}"
+        self.post_json("/users", {"login": login, "password": "secret", "display_name": display_name})
+        return self.query_one("SELECT id_ FROM users_ WHERE login_ = %s", (login,))[0]
+
+    def query_one(self, query: str, params=None) -> tuple:
+        # Straight to the database on a connection of its own, committed
+        conn = connect_test_database()
+        try:
+            with conn, conn.cursor() as cur:
+                cur.execute(query, params)
+                return cur.fetchone() if cur.description else None
+        finally:
+            conn.close()
+
+    def add_toilets(self, author_id: int, *toilets) -> list:
+        items = [{"author_id_": author_id, "coordinates_": "(55.75, 37.61)", "place_name_": "Test toilet",
+                  "is_public_": True, "disabled_access_": False, "baby_access_": False, "parking_nearby_": False,
+                  "opening_time_": "08:00", "closing_time_": "22:00", "cost_": 0, **toilet} for toilet in toilets]
+        statuses = self.post_json("/toilets/batch", items)
+        return [status["id_"] for status in statuses]
+
+    def sync_to_end(self, since: str = "0_0") -> tuple:
+        # (cursor after every change so far, changed toilets by id)
+        toilets = dict()
+        while True:
+            res = self.get_json(f"/sync?since={since}&limit=5000")
+            toilets.update((toilet["id_"], toilet) for toilet in res["toilets_"])
+            since = res["next_cursor_"]
+            if not res["has_more_"]:
+                return since, toilets
+
+    def add_reviews(self, toilet_id: int, user_id: int, *ratings):
+        self.post_json("/reviews/batch", [{"toilet_id_": toilet_id, "user_id_": user_id, "rating_": rating}
+                                          for rating in ratings])
+
+
+class ToiletListingTests(ApiTestCase):
+    def test_details_match_the_per_toilet_lookups(self):
+        # What GET /toilets computed per toilet before the joined query: author name and float mean, 0 without reviews
+        author = self.add_user("Author")
+        reviewed, unreviewed = self.add_toilets(author, {}, {})
+        self.add_reviews(reviewed, author, 5, 4, 4)
+
+        toilet = self.get_json(f"/toilets/{reviewed}")
+        self.assertEqual("Author", toilet["author_name_"])
+        self.assertEqual(3, toilet["review_count_"])
+        self.assertEqual(13 / 3, toilet["average_rating_"])
+
+        toilet = self.get_json(f"/toilets/{unreviewed}")
+        self.assertEqual(0, toilet["review_count_"])
+        self.assertIs(0, toilet["average_rating_"])
+
+    def test_missing_toilet_is_404(self):
+        self.get_json("/toilets/999999999", status=404)
+
+    def test_streamed_listing_is_the_encoded_list(self):
+        author = self.add_user()
+        self.add_toilets(author, {}, {}, {})
+
+        body = self.client.get("/toilets", headers={"Accept-Encoding": "identity"}).get_data()
+
+        self.addCleanup(api.db.release)
+        self.assertEqual(api.json_encoder.dumps(api.db.get_toilets_with_details()), body)
+
+    def test_streamed_listing_is_compressed(self):
+        author = self.add_user()
+        self.add_toilets(author, {}, {})
+
+        response = self.client.get("/toilets", headers={"Accept-Encoding": "gzip"})
+        self.assertTrue(response.is_streamed)
+        self.assertEqual("gzip", response.headers["Content-Encoding"])
+
+        plain = self.client.get("/toilets", headers={"Accept-Encoding": "identity"}).get_data()
+        self.assertEqual(plain, gzip.decompress(response.get_data()))
+
+    def test_streamed_listing_is_measured_once_sent(self):
+        def listings() -> int:
+            return api.request_metrics._statuses.get(("GET", "/toilets", 200), 0)
+
+        before = listings()
+        response = self.client.get("/toilets", headers={"Accept-Encoding": "identity"})
+        response.get_data()
+        response.close()
+
+        self.assertEqual(before + 1, listings())
+
+    def test_pages_add_up_to_the_listing(self):
+        author = self.add_user()
+        self.add_toilets(author, *[{} for _ in range(5)])
+
+        listing = self.get_json("/toilets", headers={"Accept-Encoding": "identity"})
 
+        pages = list()
+        after_id = 0
+        while True:
+            response = self.client.get(f"/toilets?limit=2&after_id={after_id}")
+            pages += response.get_json()
+            if "X-Next-After-Id" not in response.headers:
+                break
+            after_id = response.headers["X-Next-After-Id"]
 
-# TODO Write tests
-
-# class RestCalls():
-#
-#     def google_do_something(blahblah):
-#         url= blahblah
-#         try:
-#             r = requests.get(url,timeout=1)
-#             r.raise_for_status()
-#             return r.status_code
-#         except requests.exceptions.Timeout as errt:
-#             print (errt)
-#             raise
-#         except requests.exceptions.HTTPError as errh:
-#             print (errh)
-#             raise
-#         except requests.exceptions.ConnectionError as errc:
-#             print (errc)
-#             raise
-#         except requests.exceptions.RequestException as err:
-#             print (err)
-#             raise
-#
-#
-# class TestRESTMethods(unittest.TestCase):
-#
-#     def test_valid_url(self):
-#         self.assertEqual(200,RestCalls.google_do_something('http://www.google.com/search'))
-#
-#     def test_exception(self):
-#         self.assertRaises(requests.exceptions.Timeout,RestCalls.google_do_something,'http://localhost:28989')
+        self.assertEqual(listing, pages)
+
+    def test_open_now_has_no_last_modified(self):
+        response = self.client.get("/toilets?open_now=true&limit=1")
+        self.assertIsNotNone(response.headers.get("ETag"))
+        self.assertIsNone(response.headers.get("Last-Modified"))
+
+        # An If-Modified-Since from the listing without open_now doesn't answer for it
+        last_modified = self.client.get("/toilets?limit=1").headers["Last-Modified"]
+        response = self.client.get("/toilets?open_now=true&limit=1", headers={"If-Modified-Since": last_modified})
+        self.assertEqual(200, response.status_code)
+
+
+class NearbyTests(ApiTestCase):
+    def test_new_toilets_are_indexed(self):
+        author = self.add_user()
+        near, far = self.add_toilets(author, {"coordinates_": "(-41.2001, 174.7001)"},
+                                     {"coordinates_": "(-41.2101, 174.7101)"})
+
+        toilets = self.get_json("/toilets/nearby?lat=-41.2&lon=174.7&k=2")
+        self.assertEqual([near, far], [toilet["id_"] for toilet in toilets])
+        self.assertLess(toilets[0]["distance_m_"], toilets[1]["distance_m_"])
+
+        self.assertEqual([near], [toilet["id_"] for toilet in
+                                  self.get_json("/toilets/nearby?lat=-41.2&lon=174.7&radius_m=100")])
+
+
+class AdminTests(ApiTestCase):
+    admin = {"Authorization": "Bearer test-admin-token"}
+
+    def test_reports_need_the_admin_token(self):
+        self.get_json("/admin/reports", status=401)
+        self.get_json("/admin/reports", status=401, headers={"Authorization": "Bearer guess"})
+        self.get_json("/admin/reports", headers=self.admin)
+
+    def test_unknown_cursor_is_400(self):
+        self.get_json("/admin/reports?before=reports-0-0.jsonl:0", status=400, headers=self.admin)
+
+    def test_schema_refresh_needs_the_admin_token(self):
+        self.assertEqual(401, self.client.post("/schema/refresh").status_code)
+
+        response = self.client.post("/schema/refresh", headers=self.admin)
+        self.assertEqual(200, response.status_code)
+        self.assertIn("toilets_", response.get_json()["Tables"])
+
+
+class PasswordQueueTests(ApiTestCase):
+    def fill_password_queue(self):
+        # Every Argon2 worker busy and no room to wait, until the test ends
+        passwords = api.db.passwords
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        max_queue = passwords.max_queue
+        passwords.max_queue = 0
+        self.addCleanup(setattr, passwords, "max_queue", max_queue)
+
+        for _ in range(passwords.max_workers):
+            passwords._submit(release.wait)
+
+    def test_login_burst_is_503_not_404(self):
+        login = f"test_{os.urandom(6).hex()}"
+        self.post_json("/users", {"login": login, "password": "secret", "display_name": "Busy"})
+        self.fill_password_queue()
+
+        response = self.client.post("/users/login", json={"login": login, "password": "secret"})
+        self.assertEqual(503, response.status_code)
+        self.assertEqual(str(config.password_retry_after), response.headers["Retry-After"])
+
+        # An unknown login needs no hashing, it is still a 404
+        self.assertEqual(404, self.client.post("/users/login", json={"login": "nobody_" + login,
+                                                                     "password": "secret"}).status_code)
+
+    def test_sign_up_is_503(self):
+        self.fill_password_queue()
+
+        response = self.client.post("/users", json={"login": f"test_{os.urandom(6).hex()}", "password": "secret",
+                                                    "display_name": "Busy"})
+        self.assertEqual(503, response.status_code)
+        self.assertIn("Retry-After", response.headers)
+
+
+class VerificationSyncTests(ApiTestCase):
+    def test_votes_resync_the_toilet_tally(self):
+        author = self.add_user()
+        voters = [self.add_user() for _ in range(3)]
+        toilet_id, = self.add_toilets(author, {})
+        cursor, _ = self.sync_to_end()
+
+        self.post_json("/verifications", {"toilet_id": toilet_id, "user_id": voters[0], "vote": 1})
+        cursor, toilets = self.sync_to_end(cursor)
+        self.assertEqual(1, toilets[toilet_id]["verification_"]["upvotes_"])
+
+        self.post_json("/verifications/batch", [{"toilet_id": toilet_id, "user_id": voters[1], "vote": 1},
+                                                {"toilet_id": toilet_id, "user_id": voters[2], "vote": -1}])
+        _, toilets = self.sync_to_end(cursor)
+        self.assertEqual({"upvotes_": 2, "downvotes_": 1, "net_score_": 1},
+                         {key: toilets[toilet_id]["verification_"][key]
+                          for key in ("upvotes_", "downvotes_", "net_score_")})
+
+
+class CompactedSyncTests(ApiTestCase):
+    def test_sync_after_compaction(self):
+        author = self.add_user()
+        self.add_toilets(author, {})
+
+        self.addCleanup(api.db.release)
+        self.assertIsNone(api.db.compact_changes(0))
+        api.db.release()
+
+        # The default cursor bootstraps a new client instead of expiring
+        res = self.get_json("/sync")
+        self.assertEqual(([], False, True), (res["toilets_"], res["has_more_"], res["full_resync_"]))
+        cursor = res["next_cursor_"]
+
+        self.assertEqual(cursor, self.get_json("/sync?since=0_1", status=410)["cursor_"])
+
+        toilet_id, = self.add_toilets(author, {})
+        _, toilets = self.sync_to_end(cursor)
+        self.assertEqual([toilet_id], list(toilets))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,4 @@
+from asgi_api import app
+
+if __name__ == '__main__':
+    app.run()
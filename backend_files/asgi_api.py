@@ -0,0 +1,570 @@
+import asyncio
+import datetime
+import functools
+
+from quart import Quart, request, Response, g
+from quart.wrappers.response import DataBody, IterableBody
+
+from async_db_connector import AsyncDBManager
+from spatial_index import SpatialIndex
+from clustering import ClusterIndex
+from report_log import ReportSink
+from password_hashing import PasswordService, PasswordQueueFull
+from json_encoding import JSONEncoder
+from payload_cache import PayloadCache
+from compression import Compressor
+from log_setup import setup_logging
+from api_common import (RequestError, IndexCursor, check_admin, password_busy_result, write_result, public_user,
+                        opening_hours_now, clock_resource, index_locations, listing_page, page_headers, listing_filters,
+                        nearby_query, with_distances, search_query, viewport_query, viewport_toilet_ids,
+                        viewport_result, ids_query, batch_items, batch_result, sync_query, changed_ids, sync_result,
+                        expired_sync_result, report_fields, reports_query, query_reports, reports_headers, not_modified,
+                        cached_response, set_validators)
+from config import *
+
+# The API of api.py as an ASGI app on Quart, with the same routes and JSON contracts, on top of
+# AsyncDBManager. Idle and slow clients only cost a coroutine here instead of a thread. Argon2 runs on
+# the PasswordService pool, report queries and compression run in worker threads, off the event loop.
+# What the routes check and send comes from api_common, only the awaits and the Quart glue live here.
+# Run it with any ASGI server, e.g. `hypercorn asgi:app`, after `pip install -r requirements-asgi.txt`.
+
+setup_logging(log_level, log_sample_rate)
+
+json_encoder = JSONEncoder(json_backend)
+payload_cache = PayloadCache(payload_cache_max_bytes, payload_cache_max_entry_bytes)
+compressor = Compressor(compression_min_size, gzip_level, brotli_quality,
+                        snapshot_gzip_level, snapshot_brotli_quality)
+
+
+class Result:
+    def __init__(self, status: int, message, headers: dict = None):
+        self.status = status
+        self.message = message
+        self.headers = headers
+
+    def display(self):
+        return Response(json_encoder.dumps(self.message), self.status, headers=self.headers,
+                        mimetype='application/json')
+
+
+def store_payload(key: str, body: bytes, headers: list):
+    # Same as api.store_payload, the snapshots are made by a background task
+    payload_cache.put(key, body, headers)
+    app.add_background_task(store_snapshot, key, body)
+
+
+async def store_snapshot(key: str, body: bytes):
+    payload_cache.add_variants(key, body, await asyncio.to_thread(compressor.snapshot, body))
+
+
+async def compress_chunks(body, encoding: str):
+    # Same as Compressor.compress_chunks on a Quart response body, compressing off the event loop
+    stream = compressor.compressobj(encoding)
+    async with body as chunks:
+        async for chunk in chunks:
+            compressed = await asyncio.to_thread(stream.process, chunk)
+            if compressed:
+                yield compressed
+    yield await asyncio.to_thread(stream.finish)
+
+
+def stream_json_array(items, batch_size: int = 500, cache_key: str = None):
+    # Same bytes as api.stream_json_array, from an async iterator. With a cache_key the complete body
+    # is kept in the payload cache once the last chunk has been sent, by one request at a time.
+    async def generate():
+        claimed = cache_key is not None and payload_cache.claim(cache_key)
+        parts = list() if claimed else None
+        size = 0
+
+        try:
+            chunk = b"["
+            batch = list()
+            first = True
+            async for item in items:
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    chunk += json_encoder.array_items(batch, first)
+                    batch = list()
+                    first = False
+                    if parts is not None:
+                        parts.append(chunk)
+                        size += len(chunk)
+                        if size > payload_cache.max_entry_bytes:
+                            parts = None
+                    yield chunk
+                    chunk = b""
+            chunk += json_encoder.array_items(batch, first) + b"]"
+            yield chunk
+
+            if parts is not None:
+                parts.append(chunk)
+                store_payload(cache_key, b"".join(parts), [("Content-Type", "application/json")])
+        finally:
+            if claimed:
+                payload_cache.release(cache_key)
+
+    return Response(generate(), 200, mimetype='application/json')
+
+
+async def get_listing(listing: str, filters: dict = None):
+    # ?after_id=&limit= returns one keyset page, without them the whole listing is streamed
+    paging = listing_page(request.args)
+    if paging is None:
+        return stream_json_array(db.stream_listing(listing, filters=filters), cache_key=g.get("payload_cache_key"))
+
+    after_id, limit = paging
+    page = await db.get_listing_page(listing, after_id, limit, filters)
+
+    return Result(200, page, page_headers(page, limit)).display()
+
+
+app = Quart(__name__)
+
+
+@app.errorhandler(RequestError)
+async def request_error(e: RequestError):
+    return Result(e.status, {"Message": e.message}).display()
+
+
+@app.errorhandler(PasswordQueueFull)
+async def password_queue_full(e: PasswordQueueFull):
+    log.warning(e)
+    return Result(*password_busy_result(e)).display()
+
+
+db = AsyncDBManager(host, username, password, database_name,
+                    pool_min_size=pool_min_size, pool_max_size=pool_max_size, pool_timeout=pool_timeout,
+                    version_refresh_interval=version_refresh_interval,
+                    user_cache_size=user_cache_size, user_cache_ttl=user_cache_ttl,
+                    passwords=PasswordService(argon2_time_cost, argon2_memory_cost, argon2_parallelism,
+                                              password_workers, password_queue_size))
+
+
+def conditional(*keys, cache: bool = False, resource=None):
+    # Same as api.conditional
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(**kwargs):
+            path, clocked = resource() if resource is not None else (request.full_path, False)
+            etag, last_modified = await db.get_etag(path, [key.format(**kwargs) for key in keys])
+            if clocked:
+                last_modified = None
+
+            current, matched = not_modified(request.if_none_match, request.if_modified_since, etag, last_modified,
+                                            compressor.encodings)
+            cached = payload_cache.get(etag) if cache and not current else None
+
+            if current:
+                response = Response(b"", 304)
+            elif cached is not None:
+                response = cached_response(Response, cached, compressor, request.accept_encodings)
+            else:
+                if cache:
+                    g.payload_cache_key = etag
+                response = await view(**kwargs)
+                if response.status_code != 200:
+                    return response
+                if cache and isinstance(response.response, DataBody):
+                    headers = [(name, value) for name, value in response.headers if name.lower() != "content-length"]
+                    store_payload(etag, await response.get_data(), headers)
+
+            set_validators(response, etag, matched, last_modified)
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def request_time() -> datetime.time:
+    # opening_hours_now() once per request, the ETag and the open_now filter must see the same minute
+    if "opening_hours_now" not in g:
+        g.opening_hours_now = opening_hours_now()
+    return g.opening_hours_now
+
+
+def toilets_resource() -> tuple:
+    return clock_resource(request.full_path, request.args, request_time())
+
+
+report_sink = ReportSink(report_log_directory, report_queue_size, report_flush_interval,
+                         report_max_bytes, report_max_age, report_max_files)
+
+toilet_index = SpatialIndex()
+cluster_index = ClusterIndex()
+index_cursor = IndexCursor()
+toilet_index_lock = asyncio.Lock()
+
+
+async def sync_toilet_index():
+    # Same as api.sync_toilet_index
+    async with toilet_index_lock:
+        index_cursor.start(db.versions.get("toilets_")[0])
+
+        while True:
+            if index_cursor.cursor is None:
+                cursor = await db.get_sync_cursor()
+                index_locations(toilet_index, cluster_index, await db.get_toilet_locations())
+                index_cursor.loaded(cursor)
+                return
+
+            toilet_ids, more = index_cursor.advance(await db.get_toilet_changes(index_cursor.cursor,
+                                                                                index_cursor.PAGE_SIZE))
+            if toilet_ids:
+                index_locations(toilet_index, cluster_index, await db.get_toilet_locations(toilet_ids))
+            if toilet_ids is not None and not more:
+                return
+
+
+async def refresh_toilet_index():
+    if index_cursor.needs_sync(db.versions.get("toilets_")[0]):
+        await sync_toilet_index()
+
+
+@app.before_serving
+async def startup():
+    await db.open()
+    await sync_toilet_index()
+
+
+@app.after_serving
+async def shutdown():
+    await db.close()
+
+
+@app.after_request
+async def compress_response(response):
+    # Same as api.compress_response
+    streamed = isinstance(response.response, IterableBody)
+    if (response.mimetype != "application/json" or not (streamed or isinstance(response.response, DataBody))
+            or response.status_code in (204, 304) or "Content-Encoding" in response.headers):
+        return response
+
+    if not streamed:
+        body = await response.get_data()
+        if len(body) < compressor.min_size:
+            return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = compressor.negotiate(request.accept_encodings)
+    if encoding:
+        if streamed:
+            response.response = IterableBody(compress_chunks(response.response, encoding))
+        else:
+            response.set_data(await asyncio.to_thread(compressor.compress, body, encoding))
+        response.headers["Content-Encoding"] = encoding
+
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag(f"{etag}-{encoding}", weak)
+
+    return response
+
+
+@app.get('/')
+async def index():
+    return Result(200, {"Status": "Server online"}).display()
+
+
+@app.get('/stats/pool')
+async def get_pool_stats():
+    return Result(200, db.pool.get_stats()).display()
+
+
+@app.get('/stats/user_cache')
+async def get_user_cache_stats():
+    return Result(200, db.user_cache.metrics()).display()
+
+
+@app.get('/stats/payload_cache')
+async def get_payload_cache_stats():
+    return Result(200, {"json_backend": json_encoder.backend, **payload_cache.metrics()}).display()
+
+
+@app.get('/stats/compression')
+async def get_compression_stats():
+    return Result(200, compressor.metrics()).display()
+
+
+@app.post('/schema/refresh')
+async def refresh_schema():
+    check_admin(request.headers.get("Authorization"), admin_token)
+    await db.refresh_schema()
+
+    return Result(200, {"Message": "Schema refreshed", "Tables": db.schema.tables()}).display()
+
+
+@app.get('/users')
+@conditional("users_", cache=True)
+async def get_all_users():
+    return await get_listing("users_")
+
+
+@app.get('/users/<id>')
+@conditional("users_")
+async def get_user_by_id(id: int):
+    try:
+        user = await db.user_cache.get_async(int(id))
+    except ValueError:
+        user = None
+
+    if user:
+        return Result(200, user).display()
+    else:
+        return Result(404, {"Status": "Not found"}).display()
+
+
+@app.post('/users')
+async def add_user():
+    return Result(*write_result(await db.add_user(await request.get_json()), "User created")).display()
+
+
+@app.get('/user_exists/<login>')
+async def check_if_user_exists(login: str):
+    res = await db.check_if_user_exists(login)
+
+    return Result(200, {"UserExists": res}).display()
+
+
+@app.get('/toilets')
+@conditional("toilets_", "toilet_reviews_", "toilet_verifications_", "users_", cache=True, resource=toilets_resource)
+async def get_all_toilets():
+    return await get_listing("toilets_", listing_filters(request.args, request_time()))
+
+
+@app.get('/toilets/<int:id>')
+@conditional("toilets_", "toilet_reviews_:{id}", "toilet_verifications_", "users_", cache=True)
+async def get_toilet_by_id(id: int):
+    toilets = await db.get_toilets_with_details([id])
+
+    if toilets:
+        return Result(200, toilets[0]).display()
+    else:
+        return Result(404, {"Message": "Toilet not found!"}).display()
+
+
+@app.get('/toilets/nearby')
+@conditional("toilets_", "toilet_reviews_", "toilet_verifications_", "users_")
+async def get_nearby_toilets():
+    await refresh_toilet_index()
+
+    nearest = toilet_index.nearest(*nearby_query(request.args))
+    toilets = await db.get_toilets_with_details([toilet_id for _, toilet_id in nearest])
+
+    return Result(200, with_distances(nearest, toilets)).display()
+
+
+@app.get('/toilets/search')
+@conditional("toilets_", "toilet_reviews_", "toilet_verifications_", "users_")
+async def search_toilets():
+    text, limit, reviews = search_query(request.args)
+
+    return Result(200, await db.search_toilets(text, limit, reviews, search_rating_weight)).display()
+
+
+@app.get('/toilets/viewport')
+@conditional("toilets_", "toilet_reviews_", "toilet_verifications_", "users_")
+async def get_viewport_toilets():
+    await refresh_toilet_index()
+
+    box, zoom = viewport_query(request.args)
+
+    toilet_ids = viewport_toilet_ids(toilet_index, cluster_index, box, zoom)
+    if toilet_ids is None:
+        return Result(200, viewport_result(clusters=cluster_index.clusters(zoom, *box))).display()
+
+    toilets = await db.get_toilets_with_details(toilet_ids) if toilet_ids else []
+    return Result(200, viewport_result(toilets=toilets)).display()
+
+
+@app.get('/toilets/<int:id>/verification')
+@conditional("toilets_", "toilet_verifications_")
+async def get_toilet_verification(id: int):
+    tallies = await db.get_verification_tallies([id])
+    if tallies:
+        return Result(200, tallies[0]).display()
+    else:
+        return Result(404, {"Message": "Toilet not found!"}).display()
+
+
+@app.get('/toilets/verification')
+@conditional("toilets_", "toilet_verifications_")
+async def get_toilets_verification():
+    return Result(200, await db.get_verification_tallies(ids_query(request.args))).display()
+
+
+@app.post('/toilets')
+async def add_toilet():
+    insertion_res = await db.add_toilet(await request.get_json())
+    if not insertion_res:
+        await sync_toilet_index()
+
+    return Result(*write_result(insertion_res, "Toilet created")).display()
+
+
+async def add_batch(kind: str):
+    # (created statuses, the items, the response)
+    items = batch_items(await request.get_json(silent=True))
+
+    statuses = await db.add_batch(kind, items)
+    created, status_code = batch_result(statuses)
+
+    return created, items, Result(status_code, statuses).display()
+
+
+@app.post('/toilets/batch')
+async def add_toilets_batch():
+    created, _, response = await add_batch("toilets")
+    if created:
+        await sync_toilet_index()
+
+    return response
+
+
+@app.post('/users/login')
+async def check_login_and_password():
+    res = await db.check_password(await request.get_json())
+
+    if res:
+        return Result(200, public_user(res)).display()
+    else:
+        return Result(404, {}).display()
+
+
+@app.get('/reviews')
+@conditional("toilet_reviews_", "users_", cache=True)
+async def get_all_reviews():
+    return await get_listing("toilet_reviews_")
+
+
+@app.get('/reviews/<id>')
+@conditional("toilet_reviews_:{id}", "users_", cache=True)
+async def get_reviews_by_toilet_id(id: int):
+    try:
+        reviews = await db.get_reviews_by_toilet_id(int(id))
+    except ValueError:
+        reviews = None
+
+    if reviews:
+        users = await db.user_cache.get_many_async(review["user_id_"] for review in reviews)
+        for review in reviews:
+            user = users.get(review["user_id_"])
+            review["user_display_name_"] = user["display_name_"] if user else None
+
+        return Result(200, reviews).display()
+    else:
+        return Result(404, {"Message": "Reviews not found!"}).display()
+
+
+@app.post('/reviews')
+async def add_review():
+    review_data = await request.get_json()
+
+    insertion_res = await db.add_review(review_data)
+    if not insertion_res:
+        toilet_id = review_data["toilet_id_"]
+        cluster_index.set_rating(toilet_id, await db.get_toilet_rating(toilet_id))
+
+    return Result(*write_result(insertion_res, "Review created")).display()
+
+
+@app.post('/reviews/batch')
+async def add_reviews_batch():
+    created, items, response = await add_batch("reviews")
+    if created:
+        toilet_ids = {int(items[status["index_"]]["toilet_id_"]) for status in created}
+        for toilet_id, rating in (await db.get_toilet_ratings(toilet_ids)).items():
+            cluster_index.set_rating(toilet_id, rating)
+
+    return response
+
+
+@app.get('/verifications')
+@conditional("toilet_verifications_", cache=True)
+async def get_all_verifications():
+    return await get_listing("toilet_verifications_")
+
+
+@app.get('/verifications/<id>')
+@conditional("toilet_verifications_")
+async def get_verifications_by_id(id: int):
+    try:
+        verification = await db.get_verification(int(id))
+    except ValueError:
+        verification = None
+
+    if verification:
+        return Result(200, verification).display()
+    else:
+        return Result(404, {"Message": "Verification not found!"}).display()
+
+
+@app.post('/verifications')
+async def add_verification():
+    return Result(*write_result(await db.add_verification(await request.get_json()), "Verification created")).display()
+
+
+@app.post('/verifications/batch')
+async def add_verifications_batch():
+    _, _, response = await add_batch("verifications")
+
+    return response
+
+
+@app.get('/sync')
+async def sync_changes():
+    since, limit = sync_query(request.args)
+
+    changes = await db.get_changes(since, limit)
+    if changes is None:
+        return Result(*expired_sync_result(since, await db.get_sync_cursor())).display()
+
+    changed = changed_ids(changes)
+    res = sync_result(
+        changes, since, limit,
+        toilets=await db.get_listing_by_ids("toilets_", changed["toilet"]) if changed["toilet"] else [],
+        reviews=await db.get_listing_by_ids("toilet_reviews_", changed["review"]) if changed["review"] else [],
+        verifications=(await db.get_listing_by_ids("toilet_verifications_", changed["verification"])
+                       if changed["verification"] else []),
+        users=await db.get_users_summaries(changed["user"]) if changed["user"] else [])
+
+    return Result(200, res).display()
+
+
+@app.post('/users/change_name')
+async def change_display_name():
+    return Result(*write_result(await db.change_name(await request.get_json()), "Display Name updated", 200)).display()
+
+
+@app.post("/toilets/report")
+async def report_toilet():
+    user_id, toilet_id, message = report_fields(await request.get_json())
+
+    if report_sink.submit(user_id, toilet_id, message):
+        return Result(200, {"Message": "New report added"}).display()
+    else:
+        return Result(503, {"Message": "Too many reports, try again later"}).display()
+
+
+@app.get("/admin/reports")
+async def get_reports():
+    check_admin(request.headers.get("Authorization"), admin_token)
+    toilet_id, user_id, before, limit = reports_query(request.args)
+
+    reports = await asyncio.to_thread(query_reports, report_sink.query, toilet_id, user_id, before, limit)
+
+    return Result(200, reports, reports_headers(reports, limit)).display()
+
+
+@app.get("/stats/passwords")
+async def get_password_stats():
+    return Result(200, db.passwords.metrics()).display()
+
+
+@app.get("/stats/reports")
+async def get_report_stats():
+    return Result(200, report_sink.metrics()).display()
+
+
+if __name__ == '__main__':
+    app.run()
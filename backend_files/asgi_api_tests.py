@@ -0,0 +1,81 @@
+import asyncio
+import importlib
+import unittest
+
+import api_tests
+
+# Smoke tests for asgi_api.py: it serves the routes of api.py with the same answers. Rows are added through
+# the Flask app (see api_tests), then both apps are asked the same questions.
+# Skipped without the packages of requirements-asgi.txt or the test database.
+
+asgi_api = None
+
+# Served from what only DBManager has: request metrics, prepared statements and read replicas
+WSGI_ONLY_ROUTES = {"/metrics", "/stats/statements", "/stats/replicas"}
+
+
+def setUpModule():
+    global asgi_api
+
+    for module in ("quart", "psycopg_pool"):
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            raise unittest.SkipTest(f"{module} is not installed, see requirements-asgi.txt")
+
+    api_tests.setUpModule()
+
+    import asgi_api as asgi_api_module
+    asgi_api = asgi_api_module
+
+
+def routes(app) -> set:
+    return {(rule.rule, method) for rule in app.url_map.iter_rules() if rule.endpoint != "static"
+            for method in rule.methods - {"HEAD", "OPTIONS"}}
+
+
+async def asgi_get(paths: list) -> list:
+    # (status, body) per path, from a served app so that before_serving opened the pool
+    async with asgi_api.app.test_app() as test_app:
+        client = test_app.test_client()
+
+        res = list()
+        for path in paths:
+            response = await client.get(path, headers={"Accept-Encoding": "identity"})
+            res.append((response.status_code, await response.get_data()))
+        return res
+
+
+class AsgiApiTests(api_tests.ApiTestCase):
+    def test_same_routes(self):
+        wsgi_routes = {(rule, method) for rule, method in routes(api_tests.api.app) if rule not in WSGI_ONLY_ROUTES}
+        self.assertEqual(wsgi_routes, routes(asgi_api.app))
+
+    def test_same_answers(self):
+        author = self.add_user("Author")
+        first, second = self.add_toilets(author, {"coordinates_": "(10.5, 20.5)"},
+                                         {"coordinates_": "(10.51, 20.51)", "cost_": 50})
+        self.add_reviews(first, author, 4, 5)
+
+        paths = ["/", f"/toilets/{first}", f"/toilets/{second}/verification", f"/reviews/{first}",
+                 f"/users/{author}", f"/toilets?after_id={first - 1}&limit=2",
+                 f"/toilets/verification?ids={first},{second}",
+                 "/toilets/nearby?lat=10.5&lon=20.5&k=2&radius_m=5000",
+                 "/toilets/viewport?min_lat=10&min_lon=20&max_lat=11&max_lon=21&zoom=18",
+                 "/toilets/viewport?min_lat=10&min_lon=20&max_lat=11&max_lon=21&zoom=3",
+                 # Rejected requests
+                 "/toilets/999999999", "/toilets?max_cost=free", "/toilets/nearby?lat=10.5",
+                 "/toilets/viewport?zoom=3", "/toilets/verification?ids=a", "/sync?since=1"]
+
+        expected = list()
+        for path in paths:
+            response = self.client.get(path, headers={"Accept-Encoding": "identity"})
+            expected.append((response.status_code, response.get_data()))
+
+        for path, wsgi, asgi in zip(paths, expected, asyncio.run(asgi_get(paths))):
+            with self.subTest(path=path):
+                self.assertEqual(wsgi, asgi)
+
+
+if __name__ == '__main__':
+    unittest.main()
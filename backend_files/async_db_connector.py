@@ -0,0 +1,515 @@
+import logging
+import uuid
+
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool
+
+from db_connector import (DUPLICATE_VOTE, LISTINGS, SYNC_CURSOR_QUERY, TOILET_CHANGES_QUERY, TOILET_DETAILS_QUERY,
+                          TOILET_LOCATIONS_QUERY, average_rating, listing_where, map_rows, map_toilet_details,
+                          rank_search_results, search_statement, sync_cursor, toilet_locations, verification_tally)
+from db_schema import SchemaRegistry
+from versions import VersionTracker
+from user_cache import UserCache
+from password_hashing import PasswordService
+from validation import toilet_values, review_values, verification_values
+
+log = logging.getLogger("toilets.db")
+
+# DBManager for the ASGI app (asgi_api.py), on psycopg 3's async driver and pool.
+# Queries, row mappers, the version tracker, the user cache and the Argon2 pool are shared with the
+# synchronous DBManager, so both apps read and write the same data in the same way. There is no
+# per-request connection here: every method borrows a pooled connection for its own queries only,
+# and a write's transaction commits when its `async with self.pool.connection()` block ends.
+
+
+def _columns(cur) -> tuple:
+    return tuple(column.name for column in cur.description)
+
+
+class AsyncDBManager:
+    def __init__(self, db_host: str, db_username: str, db_password: str, db_name: str, db_port: int = 5432,
+                 pool_min_size: int = 1, pool_max_size: int = 10, pool_timeout: float = 30.0,
+                 version_refresh_interval: float = 1.0, user_cache_size: int = 10000, user_cache_ttl: float = 60.0,
+                 passwords: PasswordService = None):
+        # Quoted like DBManager._connector()
+        connector = make_conninfo(host=db_host, dbname=db_name, user=db_username, password=db_password,
+                                  port=db_port)
+
+        # Opened by open(), an async pool can only start inside the running event loop
+        self.pool = AsyncConnectionPool(connector, min_size=pool_min_size, max_size=pool_max_size,
+                                        timeout=pool_timeout, open=False)
+
+        self.schema = SchemaRegistry()
+        self.versions = VersionTracker(version_refresh_interval)
+        self.user_cache = UserCache(self.get_users_summaries, user_cache_size, user_cache_ttl,
+                                    version=lambda: self.versions.get("users_")[0])
+        self.passwords = passwords or PasswordService()
+
+    async def open(self):
+        log.info("Connecting to DB...")
+        await self.pool.open(wait=True)
+        log.info("Connection successful")
+
+        await self.load_schema()
+
+    async def close(self):
+        await self.pool.close()
+
+    async def _fetch(self, query: str, params=None) -> tuple:
+        # (column names, rows) of a read-only query
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute(query, params)
+            return _columns(cur), await cur.fetchall()
+
+    async def load_schema(self):
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await self.schema.load_async(cur)
+
+    async def refresh_schema(self):
+        # See DBManager.refresh_schema(), the schema_ bump reaches the prepared statements of WSGI workers
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await self.schema.load_async(cur)
+            versions = await self._bump_versions(cur, "schema_")
+
+        self.versions.update(versions)
+
+    async def _bump_versions(self, cur, *keys) -> list:
+        # Must run inside the write's transaction, pass the result to self.versions.update() after the commit
+        await cur.execute("INSERT INTO data_versions_ (key_, version_, modified_at_) "
+                          "SELECT key_, 1, now() FROM unnest(%s::varchar[]) AS key_ "
+                          "ON CONFLICT (key_) DO UPDATE "
+                          "SET version_ = data_versions_.version_ + 1, modified_at_ = now() "
+                          "RETURNING key_, version_, modified_at_", (list(keys),))
+
+        return await cur.fetchall()
+
+    async def _log_changes(self, cur, *changes):
+        await cur.execute("INSERT INTO change_log_ (entity_, entity_id_) "
+                          "SELECT * FROM unnest(%s::varchar[], %s::integer[])",
+                          ([entity for entity, _ in changes], [int(entity_id) for _, entity_id in changes]))
+
+    async def get_changes(self, since: tuple, limit: int = 1000):
+        # See DBManager.get_changes(), None means the cursor is older than the compaction horizon
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute("SELECT h.tx_, h.id_ FROM change_log_horizon_ h")
+            horizon = await cur.fetchone()
+            if horizon and tuple(since) < horizon:
+                return None
+
+            await cur.execute("SELECT tx_, id_, entity_, entity_id_ FROM change_log_ "
+                              "WHERE (tx_, id_) > (%s, %s) AND tx_ < txid_snapshot_xmin(txid_current_snapshot()) "
+                              "ORDER BY tx_, id_ "
+                              "LIMIT %s", (since[0], since[1], limit))
+
+            return await cur.fetchall()
+
+    async def get_toilet_changes(self, since: tuple, limit: int = 5000):
+        # See DBManager.get_toilet_changes()
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute("SELECT h.tx_, h.id_ FROM change_log_horizon_ h")
+            horizon = await cur.fetchone()
+            if horizon and tuple(since) < horizon:
+                return None
+
+            await cur.execute(TOILET_CHANGES_QUERY, (since[0], since[1], limit))
+
+            return await cur.fetchall()
+
+    async def get_sync_cursor(self) -> tuple:
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute(SYNC_CURSOR_QUERY)
+            return sync_cursor(await cur.fetchone())
+
+    async def get_etag(self, resource: str, keys: list) -> tuple:
+        if self.versions.needs_refresh():
+            async with self.pool.connection() as conn, conn.cursor() as cur:
+                await self.versions.refresh_async(cur)
+
+        return self.versions.etag(resource, keys)
+
+    async def get_users_summaries(self, ids: list) -> list:
+        columns, rows = await self._fetch("SELECT id_, display_name_, creation_date_ FROM users_ "
+                                          "WHERE id_ = ANY(%s) ORDER BY id_", ([int(user_id) for user_id in ids],))
+
+        return map_rows(columns, rows)
+
+    async def get_listing_by_ids(self, listing: str, ids: list) -> list:
+        query, alias, mapper = LISTINGS[listing]
+
+        columns, rows = await self._fetch(query + f"WHERE {alias}.id_ = ANY(%s) ORDER BY {alias}.id_", (list(ids),))
+
+        return mapper(columns, rows)
+
+    async def get_listing_page(self, listing: str, after_id: int = 0, limit: int = 100, filters: dict = None) -> list:
+        query, alias, mapper = LISTINGS[listing]
+        where, params = listing_where(alias, after_id, filters)
+
+        columns, rows = await self._fetch(query + where + f"ORDER BY {alias}.id_ LIMIT %s", (*params, limit))
+
+        return mapper(columns, rows)
+
+    async def stream_listing(self, listing: str, chunk_size: int = 2000, filters: dict = None):
+        # Async generator over a whole listing through a server-side cursor, one chunk in memory at a time
+        query, alias, mapper = LISTINGS[listing]
+        where, params = listing_where(alias, filters=filters)
+
+        async with self.pool.connection() as conn:
+            async with conn.cursor(name=f"stream_{uuid.uuid4().hex}") as cur:
+                await cur.execute(query + where + f"ORDER BY {alias}.id_", params)
+
+                while True:
+                    rows = await cur.fetchmany(chunk_size)
+                    if not rows:
+                        break
+
+                    for item in mapper(_columns(cur), rows):
+                        yield item
+
+    async def search_toilets(self, text: str, limit: int = 20, reviews: bool = False,
+                             rating_weight: float = 0.2) -> list:
+        _, scores = await self._fetch(*search_statement(text, limit, reviews, rating_weight))
+        if not scores:
+            return []
+
+        return rank_search_results(scores, await self.get_toilets_with_details([toilet_id for toilet_id, _ in scores]))
+
+    async def get_toilets_with_details(self, ids: list) -> list:
+        columns, rows = await self._fetch(TOILET_DETAILS_QUERY + "WHERE t.id_ = ANY(%s) ORDER BY t.id_", (list(ids),))
+
+        return map_toilet_details(columns, rows)
+
+    async def get_toilet_locations(self, ids: list = None) -> list:
+        if ids is None:
+            _, rows = await self._fetch(TOILET_LOCATIONS_QUERY + "ORDER BY t.id_")
+        else:
+            _, rows = await self._fetch(TOILET_LOCATIONS_QUERY + "WHERE t.id_ = ANY(%s) ORDER BY t.id_",
+                                        ([int(toilet_id) for toilet_id in ids],))
+
+        return toilet_locations(rows)
+
+    async def get_toilet_ratings(self, toilet_ids: list) -> dict:
+        _, rows = await self._fetch("SELECT toilet_id_, rating_sum_, review_count_ FROM toilet_ratings_ "
+                                    "WHERE toilet_id_ = ANY(%s)", ([int(toilet_id) for toilet_id in toilet_ids],))
+
+        return {toilet_id: average_rating(rating_sum, review_count) for toilet_id, rating_sum, review_count in rows}
+
+    async def get_toilet_rating(self, toilet_id: int):
+        return (await self.get_toilet_ratings([toilet_id])).get(int(toilet_id), 0)
+
+    async def get_verification_tallies(self, toilet_ids: list) -> list:
+        _, rows = await self._fetch("SELECT t.id_, COALESCE(v.upvotes_, 0), COALESCE(v.downvotes_, 0) "
+                                    "FROM toilets_ t "
+                                    "LEFT JOIN toilet_verification_tallies_ v ON v.toilet_id_ = t.id_ "
+                                    "WHERE t.id_ = ANY(%s) "
+                                    "ORDER BY t.id_", ([int(toilet_id) for toilet_id in toilet_ids],))
+
+        return [{"toilet_id_": toilet_id, **verification_tally(upvotes, downvotes)}
+                for toilet_id, upvotes, downvotes in rows]
+
+    async def get_reviews_by_toilet_id(self, id: int):
+        columns, rows = await self._fetch("SELECT * FROM toilet_reviews_ WHERE toilet_id_ = %s", (int(id),))
+
+        return map_rows(columns, rows) or None
+
+    async def get_verification(self, id: int):
+        columns, rows = await self._fetch("SELECT * FROM toilet_verifications_ WHERE id_ = %s", (int(id),))
+
+        return map_rows(columns, rows)[0] if rows else None
+
+    async def check_if_user_exists(self, user_login: str) -> bool:
+        _, rows = await self._fetch("SELECT id_ FROM users_ WHERE login_ = %s", (user_login,))
+
+        return bool(rows)
+
+    async def add_user(self, user_data: dict):
+        try:
+            login = user_data['login']
+            password = user_data['password']
+            display_name = user_data['display_name']
+
+        except Exception as e:
+            log.warning(e)
+            return "Error on data retrieve: " + str(e)
+
+        # PasswordQueueFull is left to the route, it answers 503
+        hashed_password = await self.passwords.hash_async(password)
+
+        try:
+            async with self.pool.connection() as conn, conn.cursor() as cur:
+                await cur.execute("INSERT INTO users_ (display_name_, login_, password_hashed_, creation_date_) "
+                                  "VALUES (%s, %s, %s, CURRENT_DATE)", (display_name, login, hashed_password))
+                versions = await self._bump_versions(cur, "users_")
+
+        except Exception as e:
+            log.warning(e)
+            return "Error on insert: " + str(e)
+
+        self.versions.update(versions)
+
+        return None
+
+    async def add_toilet(self, toilet_data: dict):
+        try:
+            values = (toilet_data["author_id_"], toilet_data["coordinates_"], toilet_data["place_name_"],
+                      toilet_data["is_public_"], toilet_data["disabled_access_"], toilet_data["baby_access_"],
+                      toilet_data["parking_nearby_"], toilet_data["opening_time_"], toilet_data["closing_time_"],
+                      toilet_data["cost_"])
+
+        except Exception as e:
+            log.warning(e)
+            return "Error on data retrieve: " + str(e)
+
+        try:
+            async with self.pool.connection() as conn, conn.cursor() as cur:
+                await cur.execute("INSERT INTO toilets_ (author_id_, coordinates_, place_name_, is_public_, "
+                                  "disabled_access_, baby_access_, parking_nearby_, creation_date_, opening_time_, "
+                                  "closing_time_, cost_) "
+                                  "VALUES (%s, %s, %s, %s, %s, %s, %s, CURRENT_DATE, %s, %s, %s) RETURNING id_", values)
+                toilet_id = (await cur.fetchone())[0]
+                await self._log_changes(cur, ("toilet", toilet_id))
+                versions = await self._bump_versions(cur, "toilets_")
+
+        except Exception as e:
+            log.warning(e)
+            return "Error on insert: " + str(e)
+
+        self.versions.update(versions)
+
+        return None
+
+    async def check_password(self, login_data):
+        login = login_data["login"]
+        password = login_data["password"]
+
+        columns, rows = await self._fetch("SELECT * FROM users_ WHERE login_ = %s", (login,))
+        if not rows:
+            return None  # if user wasn't even found
+
+        user = map_rows(columns, rows)[0]
+
+        # PasswordQueueFull is left to the route: the password wasn't checked, that's no wrong password
+        if not await self.passwords.verify_async(user["password_hashed_"], password):
+            return None
+
+        if self.passwords.needs_rehash(user["password_hashed_"]):
+            await self.rehash_password(user["id_"], password)
+
+        return user
+
+    async def rehash_password(self, user_id: int, password: str):
+        try:
+            hashed_password = await self.passwords.hash_async(password)
+            async with self.pool.connection() as conn:
+                await conn.execute("UPDATE users_ SET password_hashed_ = %s WHERE id_ = %s", (hashed_password, user_id))
+        except Exception as e:
+            log.warning(e)
+            return
+
+        self.passwords.rehashed()
+
+    async def add_review(self, review_data):
+        try:
+            toilet_id = review_data["toilet_id_"]
+            user_id = review_data["user_id_"]
+            rating = review_data["rating_"]
+            review_text = review_data.get("review_text_")
+
+        except Exception as e:
+            log.warning(e)
+            return "Error on data retrieve: " + str(e)
+
+        try:
+            async with self.pool.connection() as conn, conn.cursor() as cur:
+                await cur.execute("INSERT INTO toilet_reviews_ (toilet_id_, user_id_, rating_, review_text_) "
+                                  "VALUES (%s, %s, %s, %s) RETURNING id_", (toilet_id, user_id, rating, review_text))
+                review_id = (await cur.fetchone())[0]
+
+                await cur.execute("INSERT INTO toilet_ratings_ (toilet_id_, rating_sum_, review_count_) "
+                                  "VALUES (%s, %s, 1) "
+                                  "ON CONFLICT (toilet_id_) DO UPDATE "
+                                  "SET rating_sum_ = toilet_ratings_.rating_sum_ + EXCLUDED.rating_sum_, "
+                                  "review_count_ = toilet_ratings_.review_count_ + 1", (toilet_id, rating))
+                await self._log_changes(cur, ("review", review_id), ("toilet", toilet_id))
+                versions = await self._bump_versions(cur, "toilet_reviews_", f"toilet_reviews_:{toilet_id}")
+
+        except Exception as e:
+            log.warning(e)
+            return "Error on insert: " + str(e)
+
+        self.versions.update(versions)
+
+        return None
+
+    async def add_verification(self, verification_data):
+        try:
+            toilet_id = verification_data["toilet_id"]
+            user_id = verification_data["user_id"]
+            vote = verification_data["vote"]
+
+        except Exception as e:
+            log.warning(e)
+            return "Error on data retrieve: " + str(e)
+
+        try:
+            async with self.pool.connection() as conn, conn.cursor() as cur:
+                await cur.execute("INSERT INTO toilet_verifications_ (toilet_id_, user_id_, vote_) "
+                                  "VALUES (%s, %s, %s) "
+                                  "ON CONFLICT (toilet_id_, user_id_) DO NOTHING RETURNING id_",
+                                  (toilet_id, user_id, vote))
+                inserted = await cur.fetchone()
+                if not inserted:
+                    return DUPLICATE_VOTE
+
+                await self._update_verification_tallies(cur, [(toilet_id, vote)])
+                await self._log_changes(cur, ("verification", inserted[0]), ("toilet", toilet_id))
+                versions = await self._bump_versions(cur, "toilet_verifications_")
+
+        except Exception as e:
+            log.warning(e)
+            return "Error on insert: " + str(e)
+
+        self.versions.update(versions)
+
+        return None
+
+    async def _update_verification_tallies(self, cur, votes: list):
+        tallies = dict()
+        for toilet_id, vote in votes:
+            upvotes, downvotes = tallies.get(int(toilet_id), (0, 0))
+            tallies[int(toilet_id)] = (upvotes + (vote > 0), downvotes + (vote < 0))
+
+        await cur.execute("INSERT INTO toilet_verification_tallies_ (toilet_id_, upvotes_, downvotes_) "
+                          "SELECT * FROM unnest(%s::integer[], %s::integer[], %s::integer[]) "
+                          "ON CONFLICT (toilet_id_) DO UPDATE "
+                          "SET upvotes_ = toilet_verification_tallies_.upvotes_ + EXCLUDED.upvotes_, "
+                          "downvotes_ = toilet_verification_tallies_.downvotes_ + EXCLUDED.downvotes_",
+                          (list(tallies), [tally[0] for tally in tallies.values()],
+                           [tally[1] for tally in tallies.values()]))
+
+    async def change_name(self, name_change_data):
+        try:
+            user_id = name_change_data["user_id"]
+            new_name = name_change_data["new_name"]
+        except Exception as e:
+            log.warning(e)
+            return "Error on data retrieve: " + str(e)
+
+        try:
+            async with self.pool.connection() as conn, conn.cursor() as cur:
+                await cur.execute("UPDATE users_ SET display_name_ = %s WHERE id_ = %s", (new_name, user_id))
+                await self._log_changes(cur, ("user", user_id))
+                versions = await self._bump_versions(cur, "users_")
+
+        except Exception as e:
+            log.warning(e)
+            return "Error on update"
+
+        self.versions.update(versions)
+        self.user_cache.invalidate(int(user_id))
+        return None
+
+    async def add_batch(self, kind: str, items: list) -> list:
+        # Same contract as DBManager.add_batch(), one status per item in the order they were sent
+        validate, insert = {
+            "toilets": (toilet_values, self._insert_toilets),
+            "reviews": (review_values, self._insert_reviews),
+            "verifications": (verification_values, self._insert_verifications),
+        }[kind]
+
+        statuses = list()
+        rows = list()
+        positions = list()
+        for index, item in enumerate(items):
+            try:
+                rows.append(validate(item))
+                positions.append(index)
+                statuses.append(None)
+            except ValueError as e:
+                statuses.append({"index_": index, "status_": "invalid", "message_": str(e)})
+
+        if not rows:
+            return statuses
+
+        try:
+            async with self.pool.connection() as conn, conn.cursor() as cur:
+                ids, versions = await insert(cur, rows)
+
+        except Exception as e:
+            log.warning(e)
+            for index in positions:
+                statuses[index] = {"index_": index, "status_": "failed", "message_": "Error on insert: " + str(e)}
+            return statuses
+
+        self.versions.update(versions)
+
+        for index, new_id in zip(positions, ids):
+            if new_id is None:
+                statuses[index] = {"index_": index, "status_": "duplicate", "message_": DUPLICATE_VOTE}
+            else:
+                statuses[index] = {"index_": index, "status_": "created", "id_": new_id}
+
+        return statuses
+
+    @staticmethod
+    async def _insert_returning(cur, query: str, rows: list) -> list:
+        # executemany() pipelines the inserts in one round trip, every row's RETURNING is its own result set.
+        # Rows that inserted nothing (ON CONFLICT DO NOTHING) come back as None.
+        await cur.executemany(query, rows, returning=True)
+
+        ids = list()
+        while True:
+            row = await cur.fetchone()
+            ids.append(row[0] if row else None)
+            if not cur.nextset():
+                break
+
+        return ids
+
+    async def _insert_toilets(self, cur, rows: list) -> tuple:
+        ids = await self._insert_returning(cur,
+                                           "INSERT INTO toilets_ (author_id_, coordinates_, place_name_, is_public_, "
+                                           "disabled_access_, baby_access_, parking_nearby_, creation_date_, "
+                                           "opening_time_, closing_time_, cost_) "
+                                           "VALUES (%s, %s, %s, %s, %s, %s, %s, CURRENT_DATE, %s, %s, %s) RETURNING id_",
+                                           rows)
+
+        await self._log_changes(cur, *(("toilet", toilet_id) for toilet_id in ids))
+
+        return ids, await self._bump_versions(cur, "toilets_")
+
+    async def _insert_reviews(self, cur, rows: list) -> tuple:
+        ids = await self._insert_returning(cur,
+                                           "INSERT INTO toilet_reviews_ (toilet_id_, user_id_, rating_, review_text_) "
+                                           "VALUES (%s, %s, %s, %s) RETURNING id_", rows)
+
+        await cur.execute("INSERT INTO toilet_ratings_ (toilet_id_, rating_sum_, review_count_) "
+                          "SELECT v.toilet_id_, SUM(v.rating_), COUNT(*) "
+                          "FROM unnest(%s::integer[], %s::integer[]) AS v (toilet_id_, rating_) "
+                          "GROUP BY v.toilet_id_ "
+                          "ON CONFLICT (toilet_id_) DO UPDATE "
+                          "SET rating_sum_ = toilet_ratings_.rating_sum_ + EXCLUDED.rating_sum_, "
+                          "review_count_ = toilet_ratings_.review_count_ + EXCLUDED.review_count_",
+                          ([toilet_id for toilet_id, _, _, _ in rows], [rating for _, _, rating, _ in rows]))
+
+        toilet_ids = sorted({toilet_id for toilet_id, _, _, _ in rows})
+        await self._log_changes(cur, *(("review", review_id) for review_id in ids),
+                                *(("toilet", toilet_id) for toilet_id in toilet_ids))
+
+        return ids, await self._bump_versions(cur, "toilet_reviews_",
+                                              *(f"toilet_reviews_:{toilet_id}" for toilet_id in toilet_ids))
+
+    async def _insert_verifications(self, cur, rows: list) -> tuple:
+        ids = await self._insert_returning(cur,
+                                           "INSERT INTO toilet_verifications_ (toilet_id_, user_id_, vote_) "
+                                           "VALUES (%s, %s, %s) "
+                                           "ON CONFLICT (toilet_id_, user_id_) DO NOTHING RETURNING id_", rows)
+
+        votes = [(toilet_id, vote) for (toilet_id, _, vote), new_id in zip(rows, ids) if new_id is not None]
+        if votes:
+            await self._update_verification_tallies(cur, votes)
+        toilet_ids = sorted({toilet_id for toilet_id, _ in votes})
+        await self._log_changes(cur, *(("verification", verification_id)
+                                       for verification_id in ids if verification_id is not None),
+                                *(("toilet", toilet_id) for toilet_id in toilet_ids))
+
+        return ids, await self._bump_versions(cur, "toilet_verifications_")
@@ -0,0 +1,639 @@
+import argparse
+import concurrent.futures
+import datetime
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import re
+import resource
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+import config
+from bulk_io import copy_value
+
+# Endpoint benchmarks on synthetic data in a local PostgreSQL.
+#
+#   python benchmark.py generate --scale 100k
+#   python benchmark.py run --scale 100k --output results/100k.json
+#   python benchmark.py run --scale 100k --url http://localhost:5010/ --concurrency 32 --server-pid 1234
+#   python benchmark.py compare results/before.json results/after.json
+#   python benchmark.py statements --scale 100k --concurrency 8
+#
+# generate creates the schema from queries.txt when it is missing, empties the tables and fills them.
+# run drives every route of api.py, in-process through the Flask test client or, with --url, over HTTP
+# against a running server with a pool of concurrent clients. Each route reports throughput, latency
+# percentiles, database statements per request (from the pool's query counter) and peak RSS.
+# statements times DBManager's prepared lookups against the same SQL sent as plain parameterized queries.
+
+SCALES = {"1k": 1000, "100k": 100000, "1m": 1000000}
+
+BENCHMARK_PASSWORD = "benchmark"
+
+CITIES = [(55.751, 37.618), (59.939, 30.316), (56.838, 60.605), (55.030, 82.920), (43.585, 39.723)]
+
+
+def scale_counts(scale: str) -> dict:
+    toilets = SCALES[scale]
+    return {
+        "users": max(100, toilets // 10),
+        "toilets": toilets,
+        "reviews": toilets * 3,
+        "verifications": toilets * 2,
+    }
+
+
+def connect(args):
+    from db_connector import DBManager
+    return DBManager(args.host, args.user, args.password, args.database, pool_min_size=1, pool_max_size=1)
+
+
+def copy_rows(cur, table: str, columns: tuple, rows, chunk_rows: int = 50000):
+    buffer = io.StringIO()
+    count = 0
+    for row in rows:
+        buffer.write("\t".join(copy_value(value) for value in row) + "\n")
+        count += 1
+        if count % chunk_rows == 0:
+            buffer.seek(0)
+            cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+            buffer = io.StringIO()
+
+    buffer.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+
+    return count
+
+
+def generate(args):
+    from password_hashing import PasswordService
+
+    counts = scale_counts(args.scale)
+    rng = random.Random(args.seed)
+    db = connect(args)
+    cur = db.cur
+
+    cur.execute("SELECT to_regclass('users_')")
+    if cur.fetchone()[0] is None:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "queries.txt"), encoding="utf-8") as f:
+            cur.execute(f.read())
+        db.conn.commit()
+        db.refresh_schema()
+
+    cur.execute("TRUNCATE users_, toilets_, toilet_reviews_, toilet_verifications_, toilet_ratings_, "
+                "toilet_verification_tallies_, change_log_, data_versions_, import_progress_ RESTART IDENTITY")
+
+    started = time.monotonic()
+    today = datetime.date.today()
+
+    # Every user gets the same password, so /users/login can be driven with any of them
+    password_hash = PasswordService().hash(BENCHMARK_PASSWORD)
+    copy_rows(cur, "users_", ("id_", "display_name_", "login_", "password_hashed_", "creation_date_"),
+              ((user_id, f"Bench user {user_id}", f"bench_{user_id}", password_hash, today)
+               for user_id in range(1, counts["users"] + 1)))
+
+    def toilet_row(toilet_id):
+        lat, lon = rng.choice(CITIES)
+        opening = rng.choice((0, 6, 7, 8, 9, 10))
+        return (toilet_id, rng.randint(1, counts["users"]),
+                f"({lat + rng.gauss(0, 0.08):.6f}, {lon + rng.gauss(0, 0.12):.6f})", f"Toilet {toilet_id}",
+                rng.random() < 0.7, rng.random() < 0.3, rng.random() < 0.2, rng.random() < 0.4,
+                today - datetime.timedelta(days=rng.randint(0, 1000)),
+                datetime.time(opening), datetime.time(23, 59, 59) if opening == 0 else datetime.time(opening + 12),
+                rng.choice((0, 0, 0, 50, 100)))
+
+    copy_rows(cur, "toilets_", ("id_", "author_id_", "coordinates_", "place_name_", "is_public_", "disabled_access_",
+                                "baby_access_", "parking_nearby_", "creation_date_", "opening_time_",
+                                "closing_time_", "cost_"),
+              (toilet_row(toilet_id) for toilet_id in range(1, counts["toilets"] + 1)))
+
+    copy_rows(cur, "toilet_reviews_", ("id_", "toilet_id_", "user_id_", "rating_", "review_text_"),
+              ((review_id, rng.randint(1, counts["toilets"]), rng.randint(1, counts["users"]), rng.randint(1, 5),
+                rng.choice((None, "Clean", "Could be better", "Paper was missing")))
+               for review_id in range(1, counts["reviews"] + 1)))
+
+    votes_per_toilet = counts["verifications"] // counts["toilets"]
+
+    def verification_rows():
+        verification_id = itertools.count(1)
+        for toilet_id in range(1, counts["toilets"] + 1):
+            for user_id in rng.sample(range(1, counts["users"] + 1), votes_per_toilet):
+                yield next(verification_id), toilet_id, user_id, rng.choice((1, 1, 1, -1))
+
+    copy_rows(cur, "toilet_verifications_", ("id_", "toilet_id_", "user_id_", "vote_"), verification_rows())
+
+    copy_rows(cur, "change_log_", ("entity_", "entity_id_"),
+              (("toilet", toilet_id) for toilet_id in range(1, counts["toilets"] + 1)))
+
+    for table in ("users_", "toilets_", "toilet_reviews_", "toilet_verifications_"):
+        cur.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id_'), (SELECT max(id_) FROM {table}))")
+
+    db.bump_versions("users_", "toilets_")
+    db.conn.commit()
+
+    db.repair_rating_aggregates()
+    db.repair_verification_tallies()
+
+    cur.execute("ANALYZE")
+    db.conn.commit()
+    db.close()
+
+    print(f"Generated {args.scale} ({counts}) in {time.monotonic() - started:.1f}s")
+
+
+class Scenario:
+    # One route with the request to send. path, body and headers are callables, called before every request,
+    # so each request can hit a different id. prepare(driver) runs once before the timed requests.
+
+    def __init__(self, name: str, method: str, path, body=None, headers=None, heavy: bool = False, prepare=None):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.body = body or (lambda: None)
+        self.headers = headers or (lambda: dict())
+        self.heavy = heavy
+        self.prepare = prepare
+
+
+def scenarios(counts: dict, rng: random.Random, admin_token: str = None) -> list:
+    lock = threading.Lock()
+    run_id = uuid.uuid4().hex[:8]
+    sequence = itertools.count()
+    etags = dict()
+    admin = {"Authorization": f"Bearer {admin_token}"} if admin_token else dict()
+
+    def pick(count: int) -> int:
+        with lock:
+            return rng.randint(1, count)
+
+    def user():
+        return pick(counts["users"])
+
+    def toilet():
+        return pick(counts["toilets"])
+
+    def unique() -> str:
+        return f"{run_id}_{next(sequence)}"
+
+    def location() -> tuple:
+        with lock:
+            lat, lon = rng.choice(CITIES)
+            return lat + rng.gauss(0, 0.05), lon + rng.gauss(0, 0.05)
+
+    def new_toilet() -> dict:
+        lat, lon = location()
+        return {"author_id_": user(), "coordinates_": f"({lat:.6f}, {lon:.6f})", "place_name_": f"Bench {unique()}",
+                "is_public_": True, "disabled_access_": False, "baby_access_": True, "parking_nearby_": False,
+                "creation_date_": datetime.date.today().isoformat(), "opening_time_": "08:00:00",
+                "closing_time_": "22:00:00", "cost_": 0}
+
+    def new_review() -> dict:
+        return {"toilet_id_": toilet(), "user_id_": user(), "rating_": pick(5), "review_text_": "Benchmark review"}
+
+    def new_verification() -> dict:
+        return {"toilet_id": toilet(), "user_id": user(), "vote": 1}
+
+    def nearby() -> str:
+        lat, lon = location()
+        return f"/toilets/nearby?lat={lat:.5f}&lon={lon:.5f}&k=20"
+
+    def viewport(span: float, zoom: int):
+        def path() -> str:
+            lat, lon = location()
+            return (f"/toilets/viewport?min_lat={lat - span:.5f}&min_lon={lon - span:.5f}"
+                    f"&max_lat={lat + span:.5f}&max_lon={lon + span:.5f}&zoom={zoom}")
+        return path
+
+    def remember_etag(path: str):
+        def prepare(driver):
+            etags[path] = driver.request("GET", path, None, dict())[1].get("ETag", "")
+        return prepare
+
+    page = "/toilets?limit=100"
+
+    return [
+        # Reads first, the writes below change the versions the caches depend on
+        Scenario("index", "GET", lambda: "/"),
+        Scenario("stats_pool", "GET", lambda: "/stats/pool"),
+        Scenario("stats_statements", "GET", lambda: "/stats/statements"),
+        Scenario("stats_replicas", "GET", lambda: "/stats/replicas"),
+        Scenario("stats_user_cache", "GET", lambda: "/stats/user_cache"),
+        Scenario("stats_payload_cache", "GET", lambda: "/stats/payload_cache"),
+        Scenario("stats_compression", "GET", lambda: "/stats/compression"),
+        Scenario("stats_passwords", "GET", lambda: "/stats/passwords"),
+        Scenario("stats_reports", "GET", lambda: "/stats/reports"),
+        Scenario("users_all", "GET", lambda: "/users", heavy=True),
+        Scenario("users_page", "GET", lambda: f"/users?limit=100&after_id={user()}"),
+        Scenario("user_by_id", "GET", lambda: f"/users/{user()}"),
+        Scenario("user_exists", "GET", lambda: f"/user_exists/bench_{user()}"),
+        Scenario("toilets_all", "GET", lambda: "/toilets", heavy=True),
+        Scenario("toilets_page", "GET", lambda: f"/toilets?limit=100&after_id={toilet()}"),
+        Scenario("toilets_page_not_modified", "GET", lambda: page,
+                 headers=lambda: {"If-None-Match": etags.get(page, "")}, prepare=remember_etag(page)),
+        Scenario("toilets_filtered_page", "GET",
+                 lambda: f"/toilets?limit=100&after_id={toilet()}&is_public=true&max_cost=50&open_now=true"),
+        Scenario("toilet_by_id", "GET", lambda: f"/toilets/{toilet()}"),
+        Scenario("toilets_nearby", "GET", nearby),
+        Scenario("toilets_search", "GET", lambda: f"/toilets/search?q=Toilet%20{toilet() // 10}"),
+        Scenario("toilets_search_fuzzy", "GET", lambda: f"/toilets/search?q=Tolet%20{toilet()}&reviews=true"),
+        Scenario("toilets_viewport_city", "GET", viewport(0.3, 10)),
+        Scenario("toilets_viewport_street", "GET", viewport(0.005, 17)),
+        Scenario("toilet_verification", "GET", lambda: f"/toilets/{toilet()}/verification"),
+        Scenario("toilets_verification", "GET",
+                 lambda: "/toilets/verification?ids=" + ",".join(str(toilet()) for _ in range(50))),
+        Scenario("reviews_all", "GET", lambda: "/reviews", heavy=True),
+        Scenario("reviews_page", "GET", lambda: f"/reviews?limit=100&after_id={pick(counts['reviews'])}"),
+        Scenario("reviews_by_toilet", "GET", lambda: f"/reviews/{toilet()}"),
+        Scenario("verifications_all", "GET", lambda: "/verifications", heavy=True),
+        Scenario("verification_by_id", "GET", lambda: f"/verifications/{pick(counts['verifications'])}"),
+        Scenario("sync", "GET", lambda: "/sync?since=0_0&limit=1000"),
+        Scenario("admin_reports", "GET", lambda: "/admin/reports?limit=50", headers=lambda: admin),
+        # After the other reads, so it renders the series of every route and status seen so far
+        Scenario("metrics", "GET", lambda: "/metrics"),
+
+        Scenario("user_login", "POST", lambda: "/users/login", heavy=True,
+                 body=lambda: {"login": f"bench_{user()}", "password": BENCHMARK_PASSWORD}),
+        Scenario("user_add", "POST", lambda: "/users", heavy=True,
+                 body=lambda: {"login": f"bench_new_{unique()}", "password": BENCHMARK_PASSWORD,
+                               "display_name": "Bench"}),
+        Scenario("user_change_name", "POST", lambda: "/users/change_name",
+                 body=lambda: {"user_id": user(), "new_name": f"Bench {unique()}"}),
+        Scenario("toilet_add", "POST", lambda: "/toilets", body=new_toilet),
+        Scenario("toilets_batch", "POST", lambda: "/toilets/batch",
+                 body=lambda: [new_toilet() for _ in range(100)]),
+        Scenario("review_add", "POST", lambda: "/reviews", body=new_review),
+        Scenario("reviews_batch", "POST", lambda: "/reviews/batch", body=lambda: [new_review() for _ in range(100)]),
+        Scenario("verification_add", "POST", lambda: "/verifications", body=new_verification),
+        Scenario("verifications_batch", "POST", lambda: "/verifications/batch",
+                 body=lambda: [new_verification() for _ in range(100)]),
+        Scenario("toilet_report", "POST", lambda: "/toilets/report",
+                 body=lambda: {"user_id_": user(), "toilet_id_": toilet(), "message_": "Benchmark report"}),
+        Scenario("schema_refresh", "POST", lambda: "/schema/refresh", headers=lambda: admin),
+    ]
+
+
+class FlaskDriver:
+    # api.app in this process, through one Flask test client per thread
+    mode = "flask"
+
+    def __init__(self, accept_encoding: str):
+        import api
+
+        self.app = api.app
+        self.pool = api.db.pool
+        self.accept_encoding = accept_encoding
+        self._local = threading.local()
+
+    def request(self, method: str, path: str, body, headers: dict) -> tuple:
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+
+        response = client.open(path, method=method, json=body,
+                               headers={"Accept-Encoding": self.accept_encoding, **headers})
+        response.get_data()  # streamed bodies are only produced while they are read
+
+        return response.status_code, response.headers
+
+    def queries(self) -> int:
+        return self.pool.metrics()["queries"]
+
+    def peak_rss_kb(self) -> int:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class HTTPDriver:
+    # A running server, one requests.Session per client thread
+    mode = "http"
+
+    def __init__(self, base_url: str, accept_encoding: str, server_pid: int = None):
+        import requests
+
+        self.requests = requests
+        self.base_url = base_url.rstrip("/")
+        self.accept_encoding = accept_encoding
+        self.server_pid = server_pid
+        self._local = threading.local()
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = self.requests.Session()
+            session.headers["Accept-Encoding"] = self.accept_encoding
+        return session
+
+    def request(self, method: str, path: str, body, headers: dict) -> tuple:
+        response = self._session().request(method, self.base_url + path, json=body, headers=headers)
+        response.content  # read the whole body
+
+        return response.status_code, response.headers
+
+    def queries(self) -> int:
+        # Counts every worker's statements only when the server runs a single process
+        return self._session().get(self.base_url + "/stats/pool").json()["queries"]
+
+    def peak_rss_kb(self):
+        if self.server_pid is None:
+            return None
+
+        with open(f"/proc/{self.server_pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+        return None
+
+
+def percentile(sorted_values: list, share: float) -> float:
+    # Nearest-rank percentile
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, min(len(sorted_values) - 1, round(share * len(sorted_values)) - 1))]
+
+
+def run_scenario(driver, scenario: Scenario, iterations: int, concurrency: int, warmup: int) -> dict:
+    if scenario.prepare is not None:
+        scenario.prepare(driver)
+
+    def send():
+        status, _ = driver.request(scenario.method, scenario.path(), scenario.body(), scenario.headers())
+        return status
+
+    for _ in range(warmup):
+        send()
+
+    def worker(count: int) -> tuple:
+        latencies = list()
+        statuses = dict()
+        for _ in range(count):
+            started = time.perf_counter()
+            try:
+                status = send()
+            except Exception as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+        return latencies, statuses
+
+    shares = [iterations // concurrency + (i < iterations % concurrency) for i in range(concurrency)]
+
+    queries_before = driver.queries()
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(worker, [share for share in shares if share]))
+    elapsed = time.perf_counter() - started
+    queries = driver.queries() - queries_before
+
+    latencies = sorted(latency for worker_latencies, _ in results for latency in worker_latencies)
+    statuses = dict()
+    for _, worker_statuses in results:
+        for status, count in worker_statuses.items():
+            statuses[str(status)] = statuses.get(str(status), 0) + count
+
+    errors = sum(count for status, count in statuses.items() if not status.isdigit() or int(status) >= 500)
+
+    return {
+        "name": scenario.name,
+        "method": scenario.method,
+        "requests": len(latencies),
+        "errors": errors,
+        "statuses": statuses,
+        "seconds": round(elapsed, 4),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0,
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0,
+            "p50": round(percentile(latencies, 0.50) * 1000, 3),
+            "p95": round(percentile(latencies, 0.95) * 1000, 3),
+            "p99": round(percentile(latencies, 0.99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3) if latencies else 0,
+        },
+        "queries_per_request": round(queries / len(latencies), 2) if latencies else 0,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(args):
+    if args.url:
+        driver = HTTPDriver(args.url, args.accept_encoding, args.server_pid)
+    else:
+        # api.py connects on import, point it at the benchmark database first
+        config.host, config.username, config.password = args.host, args.user, args.password
+        config.database_name = args.database
+        config.admin_token = args.admin_token = args.admin_token or uuid.uuid4().hex
+        driver = FlaskDriver(args.accept_encoding)
+
+    counts = scale_counts(args.scale)
+    selected = [scenario for scenario in scenarios(counts, random.Random(args.seed), args.admin_token)
+                if not args.only or scenario.name in args.only]
+
+    report = {
+        "mode": driver.mode,
+        "scale": args.scale,
+        "counts": counts,
+        "iterations": args.iterations,
+        "concurrency": args.concurrency,
+        "accept_encoding": args.accept_encoding,
+        "git_commit": git_commit(),
+        "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "scenarios": list(),
+    }
+
+    for scenario in selected:
+        iterations = max(3, args.iterations // 50) if scenario.heavy else args.iterations
+        result = run_scenario(driver, scenario, iterations, args.concurrency, args.warmup)
+        report["scenarios"].append(result)
+
+        print(f"{result['name']:<28} {result['throughput_rps']:>10.1f} req/s  "
+              f"p50 {result['latency_ms']['p50']:>9.2f} ms  p99 {result['latency_ms']['p99']:>9.2f} ms  "
+              f"{result['queries_per_request']:>6.2f} q/req  {result['errors']} errors", file=sys.stderr)
+
+    report["peak_rss_kb"] = driver.peak_rss_kb()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+def latency_summary(latencies: list, elapsed: float) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "executions": len(latencies),
+        "throughput_qps": round(len(latencies) / elapsed, 2) if elapsed else 0,
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies) * 1000, 4) if latencies else 0,
+            "p50": round(percentile(latencies, 0.50) * 1000, 4),
+            "p99": round(percentile(latencies, 0.99) * 1000, 4),
+        },
+    }
+
+
+def statements(args):
+    # Every statement of PREPARED_STATEMENTS runs `iterations` times on `concurrency` connections at once,
+    # first as a plain parameterized query, parsed and planned on each call, then through
+    # PreparedStatements. Parameters are the same in both runs, the difference is the parse/plan work.
+    import psycopg2
+    from db_connector import PREPARED_STATEMENTS
+    from db_statements import PreparedStatements
+
+    counts = scale_counts(args.scale)
+    rng = random.Random(args.seed)
+    parameters = {
+        "user_by_id": lambda: (rng.randint(1, counts["users"]),),
+        "user_by_login": lambda: (f"bench_{rng.randint(1, counts['users'])}",),
+        "user_exists": lambda: (f"bench_{rng.randint(1, counts['users'])}",),
+        "toilet_by_id": lambda: (rng.randint(1, counts["toilets"]),),
+        "reviews_by_toilet_id": lambda: (rng.randint(1, counts["toilets"]),),
+    }
+
+    connections = [psycopg2.connect(host=args.host, dbname=args.database, user=args.user, password=args.password)
+                   for _ in range(args.concurrency)]
+
+    def measure(name: str, params: list, prepared: bool) -> dict:
+        registry = PreparedStatements({name: PREPARED_STATEMENTS[name]})
+        plain = re.sub(r"\$\d+", "%s", PREPARED_STATEMENTS[name])
+
+        def worker(conn, worker_params: list) -> list:
+            latencies = list()
+            with conn.cursor() as cur:
+                for values in worker_params:
+                    started = time.perf_counter()
+                    if prepared:
+                        registry.execute(cur, name, values)
+                    else:
+                        cur.execute(plain, values)
+                    cur.fetchall()
+                    latencies.append(time.perf_counter() - started)
+
+                conn.rollback()
+                cur.execute("DEALLOCATE ALL")
+            return latencies
+
+        started = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(args.concurrency) as executor:
+            results = list(executor.map(worker, connections, [params[i::args.concurrency]
+                                                              for i in range(args.concurrency)]))
+        elapsed = time.perf_counter() - started
+
+        return latency_summary([latency for latencies in results for latency in latencies], elapsed)
+
+    report = {
+        "mode": "statements",
+        "scale": args.scale,
+        "iterations": args.iterations,
+        "concurrency": args.concurrency,
+        "git_commit": git_commit(),
+        "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "statements": list(),
+    }
+
+    for name in PREPARED_STATEMENTS:
+        params = [parameters[name]() for _ in range(args.iterations)]
+        plain = measure(name, params, prepared=False)
+        prepared = measure(name, params, prepared=True)
+        report["statements"].append({"name": name, "plain": plain, "prepared": prepared})
+
+        print(f"{name:<22} plain {plain['throughput_qps']:>10.1f} q/s  p50 {plain['latency_ms']['p50']:>7.3f} ms   "
+              f"prepared {prepared['throughput_qps']:>10.1f} q/s  p50 {prepared['latency_ms']['p50']:>7.3f} ms",
+              file=sys.stderr)
+
+    for conn in connections:
+        conn.close()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+def compare(args):
+    with open(args.before, encoding="utf-8") as f:
+        before = {scenario["name"]: scenario for scenario in json.load(f)["scenarios"]}
+    with open(args.after, encoding="utf-8") as f:
+        after = json.load(f)["scenarios"]
+
+    def change(old: float, new: float) -> str:
+        return f"{(new - old) / old * 100:+7.1f}%" if old else "    n/a"
+
+    print(f"{'scenario':<28} {'req/s':>18} {'p50 ms':>18} {'p99 ms':>18} {'q/req':>12}")
+    for scenario in after:
+        old = before.get(scenario["name"])
+        if old is None:
+            continue
+        print(f"{scenario['name']:<28} "
+              f"{scenario['throughput_rps']:>9.1f} {change(old['throughput_rps'], scenario['throughput_rps'])} "
+              f"{scenario['latency_ms']['p50']:>9.2f} {change(old['latency_ms']['p50'], scenario['latency_ms']['p50'])} "
+              f"{scenario['latency_ms']['p99']:>9.2f} {change(old['latency_ms']['p99'], scenario['latency_ms']['p99'])} "
+              f"{old['queries_per_request']:>5.2f}->{scenario['queries_per_request']:<5.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Endpoint benchmarks on synthetic datasets")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def database_arguments(subparser):
+        subparser.add_argument("--host", default=config.host)
+        subparser.add_argument("--user", default=config.username)
+        subparser.add_argument("--password", default=config.password)
+        subparser.add_argument("--database", default=config.benchmark_database_name)
+        subparser.add_argument("--scale", choices=tuple(SCALES), default="1k")
+        subparser.add_argument("--seed", type=int, default=1)
+
+    generate_parser = subparsers.add_parser("generate", help="create and fill the benchmark database")
+    database_arguments(generate_parser)
+
+    run_parser = subparsers.add_parser("run", help="benchmark every route")
+    database_arguments(run_parser)
+    run_parser.add_argument("--url", help="benchmark a running server instead of the in-process app")
+    run_parser.add_argument("--server-pid", type=int, help="pid of the server, for its peak RSS")
+    run_parser.add_argument("--admin-token", default=config.admin_token, help="admin_token of the server")
+    run_parser.add_argument("--iterations", type=int, default=200, help="requests per route, heavy routes get 1/50")
+    run_parser.add_argument("--concurrency", type=int, default=1)
+    run_parser.add_argument("--warmup", type=int, default=3)
+    run_parser.add_argument("--accept-encoding", default="gzip")
+    run_parser.add_argument("--only", nargs="*", help="scenario names to run")
+    run_parser.add_argument("--output", help="JSON report path, defaults to stdout")
+
+    statements_parser = subparsers.add_parser("statements", help="prepared against plain hot lookups")
+    database_arguments(statements_parser)
+    statements_parser.add_argument("--iterations", type=int, default=5000, help="executions per statement")
+    statements_parser.add_argument("--concurrency", type=int, default=4)
+    statements_parser.add_argument("--output", help="JSON report path, defaults to stdout")
+
+    compare_parser = subparsers.add_parser("compare", help="compare two JSON reports")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "compare":
+        compare(args)
+        return
+
+    if args.command == "generate" and args.database == config.database_name:
+        parser.error("refusing to empty the application database, pick another --database")
+
+    {"generate": generate, "run": run, "statements": statements}[args.command](args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,294 @@
+import argparse
+import csv
+import datetime
+import io
+import json
+import os
+import sys
+import time
+
+from config import password, username, database_name, host
+from db_connector import DBManager
+from validation import toilet_values, review_values, verification_values
+
+# Bulk import / export of toilet datasets through PostgreSQL COPY.
+#
+#   python bulk_io.py import toilets moscow.csv --author-id 1
+#   python bulk_io.py import reviews reviews.ndjson
+#   python bulk_io.py export toilets toilets.csv
+#
+# Input is read and validated as a stream and sent in chunks, every chunk is one transaction that also
+# records how far the file got in import_progress_, so an interrupted import continues with --resume.
+# Rejected records are written to <input>.rejects with their record number and the reason.
+
+TABLES = {
+    "toilets": ("toilets_", "toilet", ("author_id_", "coordinates_", "place_name_", "is_public_", "disabled_access_",
+                                       "baby_access_", "parking_nearby_", "opening_time_", "closing_time_", "cost_",
+                                       "creation_date_")),
+    "reviews": ("toilet_reviews_", "review", ("toilet_id_", "user_id_", "rating_", "review_text_")),
+    "verifications": ("toilet_verifications_", "verification", ("toilet_id_", "user_id_", "vote_")),
+}
+
+TRUE_VALUES = ("true", "t", "1", "yes", "y")
+FALSE_VALUES = ("false", "f", "0", "no", "n", "")
+
+
+def read_records(path: str, file_format: str):
+    with open(path, newline="", encoding="utf-8") as f:
+        if file_format == "csv":
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def normalize_toilet(record: dict, author_id: int = None) -> dict:
+    # Open data lists come with lat/lon columns, "HH:MM-HH:MM" or "24/7" opening hours and text booleans
+    record = dict(record)
+
+    if "coordinates_" not in record and "lat" in record and "lon" in record:
+        record["coordinates_"] = f"({record['lat']}, {record['lon']})"
+
+    opening_hours = record.get("opening_hours")
+    if opening_hours is not None and "opening_time_" not in record:
+        if opening_hours.strip() == "24/7":
+            record["opening_time_"], record["closing_time_"] = "00:00:00", "23:59:59"
+        else:
+            record["opening_time_"], record["closing_time_"] = (part.strip() for part in opening_hours.split("-"))
+
+    if author_id is not None and not record.get("author_id_"):
+        record["author_id_"] = author_id
+
+    for key in ("is_public_", "disabled_access_", "baby_access_", "parking_nearby_"):
+        value = record.get(key)
+        if isinstance(value, str):
+            if value.strip().lower() not in TRUE_VALUES + FALSE_VALUES:
+                raise ValueError(f"{key} must be a boolean")
+            record[key] = value.strip().lower() in TRUE_VALUES
+
+    if record.get("cost_") in ("", None):
+        record["cost_"] = 0
+
+    return record
+
+
+def normalize_verification(record: dict) -> dict:
+    # Exports use the column names, the API uses toilet_id / user_id / vote
+    record = dict(record)
+    for column, field in (("toilet_id_", "toilet_id"), ("user_id_", "user_id"), ("vote_", "vote")):
+        if field not in record and column in record:
+            record[field] = record[column]
+    return record
+
+
+def normalize_review(record: dict) -> dict:
+    if record.get("review_text_") == "":
+        record = dict(record, review_text_=None)
+    return record
+
+
+def copy_value(value) -> str:
+    # One field in COPY text format
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+
+class Importer:
+    def __init__(self, db: DBManager, kind: str, path: str, file_format: str, chunk_rows: int = 50000,
+                 author_id: int = None, resume: bool = False):
+        self.db = db
+        self.kind = kind
+        self.path = path
+        self.file_format = file_format
+        self.chunk_rows = chunk_rows
+        self.author_id = author_id
+        self.resume = resume
+
+        self.table, self.entity, self.columns = TABLES[kind]
+        self.source = f"{kind}:{os.path.abspath(path)}"
+
+        self.imported = 0
+        self.rejected = 0
+
+    def _validate(self, record: dict) -> tuple:
+        if self.kind == "toilets":
+            creation_date = record.get("creation_date_") or datetime.date.today().isoformat()
+            return toilet_values(normalize_toilet(record, self.author_id)) + (datetime.date.fromisoformat(creation_date),)
+        if self.kind == "reviews":
+            return review_values(normalize_review(record))
+        return verification_values(normalize_verification(record))
+
+    def _rows_done(self) -> int:
+        self.db.cur.execute("SELECT rows_done_ FROM import_progress_ WHERE source_ = %s", (self.source,))
+        done = self.db.cur.fetchone()
+        self.db.conn.rollback()
+
+        return done[0] if done else 0
+
+    def _save_progress(self, rows_done: int):
+        self.db.cur.execute("INSERT INTO import_progress_ (source_, rows_done_, updated_at_) VALUES (%s, %s, now()) "
+                            "ON CONFLICT (source_) DO UPDATE SET rows_done_ = EXCLUDED.rows_done_, "
+                            "updated_at_ = now()", (self.source, rows_done))
+
+    def _copy_chunk(self, rows: list, rows_done: int) -> list:
+        # Returns the positions in `rows` that were not inserted: second votes by the same user
+        cur = self.db.cur
+        dropped = list()
+
+        # Ids are taken from the table's sequence up front, so the change log can be written with COPY as well
+        cur.execute(f"SELECT nextval(pg_get_serial_sequence('{self.table}', 'id_')) "
+                    "FROM generate_series(1, %s)", (len(rows),))
+        ids = [row[0] for row in cur.fetchall()]
+
+        buffer = io.StringIO()
+        for new_id, row in zip(ids, rows):
+            buffer.write("\t".join(copy_value(value) for value in (new_id,) + row) + "\n")
+        buffer.seek(0)
+
+        if self.kind == "verifications":
+            # Second votes by the same user are dropped, so these go through a staging table
+            cur.execute("CREATE TEMP TABLE IF NOT EXISTS verifications_import_ "
+                        "(LIKE toilet_verifications_ INCLUDING DEFAULTS) ON COMMIT DELETE ROWS")
+            cur.copy_expert(f"COPY verifications_import_ (id_, {', '.join(self.columns)}) FROM STDIN", buffer)
+            cur.execute("INSERT INTO toilet_verifications_ (id_, toilet_id_, user_id_, vote_) "
+                        "SELECT id_, toilet_id_, user_id_, vote_ FROM verifications_import_ ORDER BY id_ "
+                        "ON CONFLICT (toilet_id_, user_id_) DO NOTHING "
+                        "RETURNING id_, toilet_id_, vote_")
+            inserted = cur.fetchall()
+
+            inserted_ids = {new_id for new_id, _, _ in inserted}
+            dropped = [position for position, new_id in enumerate(ids) if new_id not in inserted_ids]
+            ids = [new_id for new_id, _, _ in inserted]
+            if inserted:
+                self.db.update_verification_tallies([(toilet_id, vote) for _, toilet_id, vote in inserted])
+        else:
+            cur.copy_expert(f"COPY {self.table} (id_, {', '.join(self.columns)}) FROM STDIN", buffer)
+
+        log = io.StringIO("".join(f"{self.entity}\t{new_id}\n" for new_id in ids))
+        cur.copy_expert("COPY change_log_ (entity_, entity_id_) FROM STDIN", log)
+
+        versions = [self.table]
+        if self.kind == "reviews":
+            totals = dict()
+            for toilet_id, _, rating, _ in rows:
+                rating_sum, review_count = totals.get(toilet_id, (0, 0))
+                totals[toilet_id] = (rating_sum + rating, review_count + 1)
+
+            cur.execute("INSERT INTO toilet_ratings_ (toilet_id_, rating_sum_, review_count_) "
+                        "SELECT * FROM unnest(%s::integer[], %s::bigint[], %s::integer[]) "
+                        "ON CONFLICT (toilet_id_) DO UPDATE "
+                        "SET rating_sum_ = toilet_ratings_.rating_sum_ + EXCLUDED.rating_sum_, "
+                        "review_count_ = toilet_ratings_.review_count_ + EXCLUDED.review_count_",
+                        (list(totals), [total[0] for total in totals.values()],
+                         [total[1] for total in totals.values()]))
+
+            cur.execute("INSERT INTO change_log_ (entity_, entity_id_) SELECT 'toilet', * FROM unnest(%s::integer[])",
+                        (list(totals),))
+            versions += [f"toilet_reviews_:{toilet_id}" for toilet_id in totals]
+
+        self.db.bump_versions(*versions)
+        self._save_progress(rows_done)
+
+        self.db.conn.commit()
+
+        return dropped
+
+    def _import_chunk(self, rows: list, record_numbers: list, rejects):
+        dropped = self._copy_chunk(rows, record_numbers[-1])
+        for position in dropped:
+            rejects.write(json.dumps({"record_": record_numbers[position], "error_": "Duplicate vote"}) + "\n")
+
+        self.imported += len(rows) - len(dropped)
+        self.rejected += len(dropped)
+
+    def run(self):
+        skip = self._rows_done() if self.resume else 0
+        if skip:
+            print(f"Resuming {self.source} after {skip} records")
+
+        started = time.monotonic()
+        rows = list()
+        record_numbers = list()
+        record_number = 0
+
+        with open(self.path + ".rejects", "a", encoding="utf-8") as rejects:
+            for record_number, record in enumerate(read_records(self.path, self.file_format), 1):
+                if record_number <= skip:
+                    continue
+
+                try:
+                    rows.append(self._validate(record))
+                    record_numbers.append(record_number)
+                except (ValueError, TypeError, AttributeError) as e:
+                    rejects.write(json.dumps({"record_": record_number, "error_": str(e)}) + "\n")
+                    self.rejected += 1
+
+                if len(rows) >= self.chunk_rows:
+                    self._import_chunk(rows, record_numbers, rejects)
+                    rows = list()
+                    record_numbers = list()
+                    print(f"{record_number} records read, {self.imported} imported, {self.rejected} rejected, "
+                          f"{self.imported / (time.monotonic() - started):.0f} rows/s")
+
+            if rows:
+                self._import_chunk(rows, record_numbers, rejects)
+            if record_number > skip:
+                # Also past trailing rejected records, so --resume doesn't write them to .rejects again
+                self._save_progress(record_number)
+                self.db.conn.commit()
+
+        print(f"Done: {self.imported} imported, {self.rejected} rejected in {time.monotonic() - started:.1f}s")
+
+
+def export(db: DBManager, kind: str, path: str, file_format: str):
+    table, _, columns = TABLES[kind]
+    columns = ("id_",) + columns
+
+    started = time.monotonic()
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        if file_format == "csv":
+            db.cur.copy_expert(f"COPY (SELECT {', '.join(columns)} FROM {table} ORDER BY id_) "
+                               "TO STDOUT WITH (FORMAT csv, HEADER true)", f)
+        else:
+            query = f"SELECT {', '.join(columns)} FROM {table} ORDER BY id_"
+            # Same streaming path as the list endpoints, a server-side cursor read in chunks
+            with db.conn.cursor(name=f"export_{kind}") as cur:
+                cur.itersize = 10000
+                cur.execute(query)
+                for row in cur:
+                    f.write(json.dumps(dict(zip(columns, row)), default=str) + "\n")
+    db.conn.rollback()
+
+    print(f"Exported {kind} to {path} in {time.monotonic() - started:.1f}s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import and export of toilets, reviews and verifications")
+    parser.add_argument("action", choices=("import", "export"))
+    parser.add_argument("kind", choices=tuple(TABLES))
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=("csv", "ndjson"), help="defaults to the file extension")
+    parser.add_argument("--chunk-rows", type=int, default=50000)
+    parser.add_argument("--author-id", type=int, help="author_id_ for toilets that don't have one")
+    parser.add_argument("--resume", action="store_true", help="skip the records a previous run already imported")
+    args = parser.parse_args(argv)
+
+    file_format = args.format or ("csv" if args.path.lower().endswith(".csv") else "ndjson")
+
+    db = DBManager(host, username, password, database_name, pool_min_size=1, pool_max_size=1)
+    try:
+        if args.action == "import":
+            Importer(db, args.kind, args.path, file_format, args.chunk_rows, args.author_id, args.resume).run()
+        else:
+            export(db, args.kind, args.path, file_format)
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,72 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import api_tests
+from bulk_io import Importer
+
+# Imports into the test database of api_tests, skipped like those when it can't be reached
+
+
+def setUpModule():
+    api_tests.setUpModule()
+
+
+class VerificationImportTests(api_tests.ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp(prefix="toilet_import_")
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        self.addCleanup(api_tests.api.db.release)
+
+        self.voter = self.add_user("Voter")
+        self.toilet, = self.add_toilets(self.voter, {})
+
+    def write_records(self, *records) -> str:
+        path = os.path.join(self.directory, "verifications.ndjson")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("".join(json.dumps(record) + "\n" for record in records))
+        return path
+
+    def rejects(self, path: str) -> list:
+        with open(path + ".rejects", encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+
+    def votes(self) -> int:
+        return self.query_one("SELECT count(*) FROM toilet_verifications_ WHERE toilet_id_ = %s", (self.toilet,))[0]
+
+    def test_duplicate_vote_is_rejected(self):
+        vote = {"toilet_id": self.toilet, "user_id": self.voter, "vote": 1}
+        path = self.write_records(vote, dict(vote, vote=-1))
+
+        importer = Importer(api_tests.api.db, "verifications", path, "ndjson")
+        importer.run()
+
+        self.assertEqual((1, 1), (importer.imported, importer.rejected))
+        self.assertEqual(1, self.votes())
+        self.assertEqual([{"record_": 2, "error_": "Duplicate vote"}], self.rejects(path))
+
+        # The same file again: every vote is already there
+        importer = Importer(api_tests.api.db, "verifications", path, "ndjson")
+        importer.run()
+        self.assertEqual((0, 2), (importer.imported, importer.rejected))
+        self.assertEqual(1, self.votes())
+
+    def test_trailing_rejects_are_not_written_again_on_resume(self):
+        path = self.write_records({"toilet_id": self.toilet, "user_id": self.voter, "vote": 1},
+                                  {"toilet_id": self.toilet, "vote": 1}, {"toilet_id": self.toilet, "vote": 5})
+
+        # One row per chunk: the rejected records come after the last chunk
+        Importer(api_tests.api.db, "verifications", path, "ndjson", chunk_rows=1).run()
+        self.assertEqual([2, 3], [reject["record_"] for reject in self.rejects(path)])
+
+        importer = Importer(api_tests.api.db, "verifications", path, "ndjson", resume=True)
+        importer.run()
+        self.assertEqual((0, 0), (importer.imported, importer.rejected))
+        self.assertEqual([2, 3], [reject["record_"] for reject in self.rejects(path)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,18 @@
-import requests as r
+import concurrent.futures
+import json
+import threading
+import urllib.parse
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 BASE_URL = "http://79.120.9.3:5010/"
 
+# Largest batch the /*/batch routes accept, see MAX_BATCH_SIZE in api_common.py
+MAX_BATCH_SIZE = 1000
+
 
 class User:
     def __init__(self, login, password, display_name):
@@ -9,6 +20,13 @@ class User:
         self.password = password
         self.display_name = display_name
 
+    def to_json(self) -> dict:
+        return {
+            "login": self.login,
+            "password": self.password,
+            "display_name": self.display_name,
+        }
+
 
 class Toilet:
     def __init__(self, author_id, coordinates, place_name, is_public, disabled_access, baby_access, parking_nearby,
@@ -25,120 +43,267 @@ class Toilet:
         self.closing_time = closing_time
         self.cost = cost
 
+    def to_json(self) -> dict:
+        # coordinates may be a (lat, lon) pair, the server stores and parses them as "(lat, lon)"
+        coordinates = self.coordinates
+        if isinstance(coordinates, (tuple, list)):
+            coordinates = "(%s, %s)" % tuple(coordinates)
+
+        return {
+            "author_id_": self.author_id,
+            "coordinates_": coordinates,
+            "place_name_": self.place_name,
+            "is_public_": self.is_public,
+            "disabled_access_": self.disabled_access,
+            "baby_access_": self.baby_access,
+            "parking_nearby_": self.parking_nearby,
+            "creation_date_": None if self.creation_date is None else str(self.creation_date),
+            "opening_time_": str(self.opening_time),
+            "closing_time_": str(self.closing_time),
+            "cost_": self.cost,
+        }
+
+
 class Review:
-    def __init__(self, toilet_id, user_id, stars_number, review_text):
+    def __init__(self, toilet_id, user_id, rating, review_text=None):
         self.toilet_id = toilet_id
         self.user_id = user_id
-        self.stars_number = stars_number
+        self.rating = rating
         self.review_text = review_text
 
+    def to_json(self) -> dict:
+        review = {
+            "toilet_id_": self.toilet_id,
+            "user_id_": self.user_id,
+            "rating_": self.rating,
+        }
+        if self.review_text is not None:
+            review["review_text_"] = self.review_text
+        return review
+
+
 class Verification:
     def __init__(self, toilet_id, user_id, vote):
         self.toilet_id = toilet_id
         self.user_id = user_id
         self.vote = vote
-def test():
-    res = r.get(BASE_URL)
-    if res.status_code != 200:
-        print(f"Error: {res.status_code}, content: {res.content}")
-        exit()
-
-    try:
-        res_json = res.json()
-        print(res_json)
-    except:
-        print("Json Error, printing contents")
-        print(res.content)
-
-
-def get_users():
-    res = r.get(BASE_URL + "users")
-    print(res.content)
-
-
-def add_user(user: User):
-    json = {
-        "login": user.login,
-        "password": user.password,
-        "display_name": user.display_name
-    }
-    res = r.post(BASE_URL + "users", json=json)
-    print(res, res.text)
-
-
-def check_if_user_exists(user_login: str):
-    res = r.get(BASE_URL + f"user_exists/{user_login}")
-    print(res)
-
-
-def add_toilet(toilet: Toilet):
-    json = {
-        "author_id": toilet.author_id,
-        "coordinates": toilet.coordinates,
-        "place_name": toilet.place_name,
-        "is_public": toilet.is_public,
-        "disabled_access": toilet.disabled_access,
-        "baby_access": toilet.baby_access,
-        "parking_nearby": toilet.parking_nearby,
-        "creation_date": toilet.creation_date,
-        "opening_time": toilet.opening_time,
-        "closing_time": toilet.closing_time,
-        "cost": toilet.cost
-    }
-    res = r.post(BASE_URL + "toilets", json=json)
-    print(res, res.text)
-
-
-def check_password(login, password):
-    json = {
-        "login": login,
-        "password": password
-    }
-    res = r.post(BASE_URL + 'users/login', json=json)
-    print(res, res.text, res.status_code)
-
-
-def add_review(review: Review):
-    json = {
-        "toilet_id": review.toilet_id,
-        "user_id": review.user_id,
-        "stars_number": review.stars_number,
-        "review_text": review.review_text,
-    }
-
-    res = r.post(BASE_URL + 'reviews', json=json)
-    print(res, res.text, res.status_code)
-
-
-def add_verification(verification: Verification):
-    json = {
-        "toilet_id": verification.toilet_id,
-        "user_id": verification.user_id,
-        "vote": verification.vote,
-    }
-
-    res = r.post(BASE_URL + 'verifications', json=json)
-    print(res, res.text, res.status_code)
-
-
-def send_report(user_id, toilet_id, message):
-    json = {
-        "toilet_id_": toilet_id,
-        "user_id_": user_id,
-        "message_": message,
-    }
-
-    res = r.post(BASE_URL + 'toilets/report', json=json)
-    print(res, res.text, res.status_code)
-
-
-# get_users()
-# add_user(User("kepper", "pass_test", "fedya"))
-# add_toilet(Toilet(1, (55.69, 37.56), 'Home toilet', False, False, False, True, None, '01:00:00', '23:00:00', 999))
-
-# check_password("kepper104", "pass1d23")
-# add_review(Review(3, 6, 5, "Best toilet i've ever visited"))
-
-# add_verification(Verification(1, 2, -1))
 
-send_report(2, 3, "doesnt exist")
\ No newline at end of file
+    def to_json(self) -> dict:
+        return {
+            "toilet_id": self.toilet_id,
+            "user_id": self.user_id,
+            "vote": self.vote,
+        }
+
+
+class ApiError(Exception):
+    def __init__(self, status: int, body):
+        self.status = status
+        self.body = body
+        message = body.get("Message") if isinstance(body, dict) else None
+        super().__init__(f"{status}: {message or body}")
+
+
+class ToiletClient:
+    # Client for api.py on one keep-alive session, safe to share between threads.
+    # GETs are cached locally by ETag: a repeated GET sends If-None-Match and a 304 is answered from
+    # the cache, so unchanged listings cost a round trip but no transfer. The batch helpers split
+    # any number of items into /*/batch requests and send `workers` of them at a time.
+
+    def __init__(self, base_url: str = BASE_URL, timeout: tuple = (3.05, 30.0), pool_size: int = 10,
+                 retries: int = 3, cache_size: int = 256):
+        self.base_url = base_url.rstrip("/") + "/"
+        self.timeout = timeout
+        self.cache_size = cache_size
+
+        # Only idempotent requests are retried, a POST that timed out may still have gone through
+        retry = Retry(total=retries, backoff_factor=0.2, status_forcelist=(502, 503, 504),
+                      allowed_methods=frozenset(("GET", "HEAD")))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()  # (path, params) -> (ETag, response body), least recently used first
+        self._cache_hits = 0
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _parse(self, response: requests.Response):
+        try:
+            body = response.json()
+        except ValueError:
+            body = response.text
+
+        if response.status_code >= 400:
+            raise ApiError(response.status_code, body)
+        return body
+
+    def get(self, path: str, params: dict = None):
+        key = (path, tuple(sorted((params or dict()).items())))
+        with self._lock:
+            cached = self._cache.get(key)
+
+        headers = {"If-None-Match": cached[0]} if cached else None
+        response = self.session.get(self.base_url + path, params=params, headers=headers, timeout=self.timeout)
+
+        if response.status_code == 304 and cached:
+            with self._lock:
+                self._cache_hits += 1
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+            # Parsed again on every hit, callers are free to modify what they get
+            return json.loads(cached[1])
+
+        body = self._parse(response)
+
+        etag = response.headers.get("ETag")
+        with self._lock:
+            if etag:
+                self._cache[key] = (etag, response.content)
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            else:
+                self._cache.pop(key, None)
+
+        return body
+
+    def post(self, path: str, body):
+        response = self.session.post(self.base_url + path, json=body, timeout=self.timeout)
+        return self._parse(response)
+
+    def cache_metrics(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._cache), "hits": self._cache_hits}
+
+    def status(self) -> dict:
+        return self.get("")
+
+    def get_users(self) -> list:
+        return self.get("users")
+
+    def get_user(self, user_id: int) -> dict:
+        return self.get(f"users/{user_id}")
+
+    def user_exists(self, login: str) -> bool:
+        return self.get(f"user_exists/{urllib.parse.quote(login, safe='')}")["UserExists"]
+
+    def add_user(self, user: User):
+        return self.post("users", user.to_json())
+
+    def check_password(self, login: str, password: str):
+        # The user without login_ and password_hashed_, None when the login or password is wrong
+        try:
+            return self.post("users/login", {"login": login, "password": password})
+        except ApiError as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def change_name(self, user_id: int, new_name: str):
+        return self.post("users/change_name", {"user_id": user_id, "new_name": new_name})
+
+    def get_toilets(self, **filters) -> list:
+        # Filters and paging as GET /toilets takes them, e.g. open_now="true", max_cost=0, limit=100
+        return self.get("toilets", filters or None)
+
+    def get_toilet(self, toilet_id: int) -> dict:
+        return self.get(f"toilets/{toilet_id}")
+
+    def get_nearby_toilets(self, lat: float, lon: float, k: int = 10, radius_m: float = None) -> list:
+        params = {"lat": lat, "lon": lon, "k": k}
+        if radius_m is not None:
+            params["radius_m"] = radius_m
+        return self.get("toilets/nearby", params)
+
+    def get_viewport_toilets(self, min_lat: float, min_lon: float, max_lat: float, max_lon: float, zoom: int):
+        return self.get("toilets/viewport", {"min_lat": min_lat, "min_lon": min_lon,
+                                             "max_lat": max_lat, "max_lon": max_lon, "zoom": zoom})
+
+    def get_verification(self, toilet_id: int) -> dict:
+        return self.get(f"toilets/{toilet_id}/verification")
+
+    def add_toilet(self, toilet: Toilet):
+        return self.post("toilets", toilet.to_json())
+
+    def get_reviews(self) -> list:
+        return self.get("reviews")
+
+    def get_reviews_by_toilet_id(self, toilet_id: int) -> list:
+        return self.get(f"reviews/{toilet_id}")
+
+    def add_review(self, review: Review):
+        return self.post("reviews", review.to_json())
+
+    def get_verifications(self) -> list:
+        return self.get("verifications")
+
+    def add_verification(self, verification: Verification):
+        return self.post("verifications", verification.to_json())
+
+    def send_report(self, user_id: int, toilet_id: int, message: str):
+        return self.post("toilets/report", {"toilet_id_": toilet_id, "user_id_": user_id, "message_": message})
+
+    def sync(self, since: str = "0_0", limit: int = 1000) -> dict:
+        # With full_resync_ set, or an ApiError 410 whose body holds cursor_, the change log was compacted past
+        # `since`: download the listings again, then sync from next_cursor_ / cursor_
+        return self.get("sync", {"since": since, "limit": limit})
+
+    def _add_batches(self, path: str, items: list, batch_size: int, workers: int) -> list:
+        # One status per item in the order given, index_ counts across all batches. A batch whose request
+        # failed doesn't hide the others: its items get a "failed" status with the error as message_.
+        # After a timeout or a dropped connection such a batch may still have gone in.
+        if not 1 <= batch_size <= MAX_BATCH_SIZE:
+            raise ValueError(f"batch_size must be between 1 and {MAX_BATCH_SIZE}")
+
+        batches = [[item.to_json() for item in items[start:start + batch_size]]
+                   for start in range(0, len(items), batch_size)]
+
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            futures = [executor.submit(self.post, path, batch) for batch in batches]
+
+        statuses = list()
+        for number, (batch, future) in enumerate(zip(batches, futures)):
+            try:
+                batch_statuses = future.result()
+            except (ApiError, requests.RequestException) as e:
+                batch_statuses = [{"index_": index, "status_": "failed", "message_": str(e)}
+                                  for index in range(len(batch))]
+
+            for status in batch_statuses:
+                status["index_"] += number * batch_size
+                statuses.append(status)
+        return statuses
+
+    def add_toilets(self, toilets: list, batch_size: int = 500, workers: int = 4) -> list:
+        return self._add_batches("toilets/batch", toilets, batch_size, workers)
+
+    def add_reviews(self, reviews: list, batch_size: int = 500, workers: int = 4) -> list:
+        return self._add_batches("reviews/batch", reviews, batch_size, workers)
+
+    def add_verifications(self, verifications: list, batch_size: int = 500, workers: int = 4) -> list:
+        return self._add_batches("verifications/batch", verifications, batch_size, workers)
+
+
+if __name__ == '__main__':
+    with ToiletClient() as client:
+        print(client.status())
+
+        # client.add_user(User("kepper", "pass_test", "fedya"))
+        # client.add_toilet(Toilet(1, (55.69, 37.56), 'Home toilet', False, False, False, True, None,
+        #                          '01:00:00', '23:00:00', 999))
+        # client.check_password("kepper104", "pass1d23")
+        # client.add_review(Review(3, 6, 5, "Best toilet i've ever visited"))
+        # client.add_verification(Verification(1, 2, -1))
+        # client.add_toilets([Toilet(1, (55.69, 37.56), f'Toilet {i}', True, False, False, False, None,
+        #                            '08:00', '22:00', 0) for i in range(5000)])
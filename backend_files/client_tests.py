@@ -0,0 +1,97 @@
+import json
+import unittest
+
+import requests
+
+from client import ApiError, Review, ToiletClient
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, body=None, headers: dict = None):
+        self.status_code = status_code
+        self.content = json.dumps(body).encode() if body is not None else b""
+        self.text = self.content.decode()
+        self.headers = headers or dict()
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class FakeSession:
+    # Answers from `handler(method, url, **kwargs)` and records every request
+    def __init__(self, handler):
+        self.handler = handler
+        self.requests = list()
+
+    def get(self, url, **kwargs):
+        self.requests.append(("GET", url, kwargs))
+        return self.handler("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        self.requests.append(("POST", url, kwargs))
+        return self.handler("POST", url, **kwargs)
+
+    def close(self):
+        pass
+
+
+def fake_client(handler) -> ToiletClient:
+    client = ToiletClient("http://toilets.test/")
+    client.session = FakeSession(handler)
+    return client
+
+
+class ToiletClientTests(unittest.TestCase):
+    def test_not_modified_is_answered_from_the_cache(self):
+        def handler(method, url, headers=None, **kwargs):
+            if headers and headers.get("If-None-Match") == '"v1"':
+                return FakeResponse(304)
+            return FakeResponse(200, [{"id_": 1}], {"ETag": '"v1"'})
+
+        client = fake_client(handler)
+
+        self.assertEqual([{"id_": 1}], client.get_users())
+        self.assertEqual([{"id_": 1}], client.get_users())
+        self.assertEqual({"entries": 1, "hits": 1}, client.cache_metrics())
+
+    def test_errors_raise_api_error(self):
+        client = fake_client(lambda method, url, **kwargs: FakeResponse(404, {"Message": "Toilet not found!"}))
+
+        with self.assertRaises(ApiError) as raised:
+            client.get_toilet(5)
+        self.assertEqual(404, raised.exception.status)
+
+    def test_login_is_quoted(self):
+        client = fake_client(lambda method, url, **kwargs: FakeResponse(200, {"UserExists": False}))
+
+        client.user_exists("a/b?c d#")
+
+        self.assertEqual("http://toilets.test/user_exists/a%2Fb%3Fc%20d%23", client.session.requests[0][1])
+
+    def test_failed_batch_keeps_the_other_statuses(self):
+        def handler(method, url, json=None, **kwargs):
+            if json[0]["rating_"] == 2:
+                return FakeResponse(500, {"Message": "Error on insert"})
+            if json[0]["rating_"] == 3:
+                raise requests.ConnectionError("connection reset")
+            return FakeResponse(201, [{"index_": index, "status_": "created", "id_": 100 + index}
+                                      for index in range(len(json))])
+
+        client = fake_client(handler)
+        reviews = [Review(1, 1, 1 + index // 2) for index in range(7)]
+
+        statuses = client.add_reviews(reviews, batch_size=2, workers=3)
+
+        self.assertEqual(list(range(7)), [status["index_"] for status in statuses])
+        self.assertEqual(["created", "created", "failed", "failed", "failed", "failed", "created"],
+                         [status["status_"] for status in statuses])
+        self.assertIn("Error on insert", statuses[2]["message_"])
+        self.assertIn("connection reset", statuses[4]["message_"])
+
+    def test_batch_size_is_checked(self):
+        with self.assertRaises(ValueError):
+            fake_client(None).add_reviews([], batch_size=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
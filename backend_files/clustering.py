@@ -0,0 +1,152 @@
+import math
+import threading
+
+
+def in_box(lat: float, lon: float, min_lat: float, min_lon: float, max_lat: float, max_lon: float) -> bool:
+    if not min_lat <= lat <= max_lat:
+        return False
+
+    if min_lon <= max_lon:
+        return min_lon <= lon <= max_lon
+    # The box crosses the antimeridian
+    return lon >= min_lon or lon <= max_lon
+
+
+class Cluster:
+    __slots__ = ("count", "lat_sum", "lon_sum", "members", "best_rating", "dirty")
+
+    def __init__(self):
+        self.count = 0
+        self.lat_sum = 0.0
+        self.lon_sum = 0.0
+        self.members = set()
+        self.best_rating = 0
+        self.dirty = False
+
+
+class ClusterIndex:
+    # One grid of clusters per zoom tier. A cell is roughly `cell_px` screen pixels wide at its zoom
+    # level, so a viewport never covers more than a screenful of cells, however dense the city is.
+
+    def __init__(self, min_zoom: int = 0, max_zoom: int = 14, cell_px: int = 64):
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.cell_size = {zoom: 360 / 2 ** zoom * cell_px / 256 for zoom in range(min_zoom, max_zoom + 1)}
+        self.rows = {zoom: math.ceil(180 / size) for zoom, size in self.cell_size.items()}
+        self.columns = {zoom: math.ceil(360 / size) for zoom, size in self.cell_size.items()}
+
+        self._lock = threading.Lock()
+        self._tiers = {zoom: dict() for zoom in self.cell_size}
+        self._points = dict()  # toilet_id -> (lat, lon)
+        self._ratings = dict()  # toilet_id -> average rating
+
+    def __len__(self):
+        return len(self._points)
+
+    def _cell(self, zoom: int, lat: float, lon: float) -> tuple:
+        # lat 90 goes into the top row, lon 180 into the first column, next to -180 where it belongs
+        size = self.cell_size[zoom]
+        return min(int((lat + 90) // size), self.rows[zoom] - 1), int((lon + 180) // size) % self.columns[zoom]
+
+    def add(self, toilet_id: int, lat: float, lon: float, rating=0):
+        with self._lock:
+            if toilet_id in self._points:
+                return
+
+            self._points[toilet_id] = (lat, lon)
+            self._ratings[toilet_id] = rating
+
+            for zoom, tier in self._tiers.items():
+                cell = self._cell(zoom, lat, lon)
+                cluster = tier.get(cell)
+                if cluster is None:
+                    cluster = tier[cell] = Cluster()
+
+                cluster.count += 1
+                cluster.lat_sum += lat
+                cluster.lon_sum += lon
+                cluster.members.add(toilet_id)
+                if rating > cluster.best_rating:
+                    cluster.best_rating = rating
+
+    def set_rating(self, toilet_id: int, rating):
+        with self._lock:
+            point = self._points.get(toilet_id)
+            if point is None:
+                return
+
+            old_rating = self._ratings[toilet_id]
+            self._ratings[toilet_id] = rating
+
+            for zoom, tier in self._tiers.items():
+                cluster = tier[self._cell(zoom, *point)]
+                if rating >= cluster.best_rating:
+                    cluster.best_rating = rating
+                elif old_rating == cluster.best_rating:
+                    # The best toilet got worse, the new best is found when the cluster is next read
+                    cluster.dirty = True
+
+    def _best_rating(self, cluster: Cluster):
+        if cluster.dirty:
+            cluster.best_rating = max(self._ratings[toilet_id] for toilet_id in cluster.members)
+            cluster.dirty = False
+        return cluster.best_rating
+
+    def _box_range(self, zoom: int, min_lat: float, min_lon: float, max_lat: float, max_lon: float) -> tuple:
+        first_row, first_column = self._cell(zoom, min_lat, min_lon)
+        last_row, last_column = self._cell(zoom, max_lat, max_lon)
+        columns = self.columns[zoom]
+
+        if max_lon >= 180 and first_column == 0 and min_lon < max_lon:
+            # The whole width, without the first column a second time
+            last_column = columns - 1
+        elif last_column < first_column:
+            last_column += columns
+
+        return first_row, first_column, last_row, last_column, columns
+
+    def _box_cells(self, zoom: int, min_lat: float, min_lon: float, max_lat: float, max_lon: float) -> int:
+        first_row, first_column, last_row, last_column, _ = self._box_range(zoom, min_lat, min_lon, max_lat, max_lon)
+        return (last_row - first_row + 1) * (last_column - first_column + 1)
+
+    def _cells_in_box(self, zoom: int, min_lat: float, min_lon: float, max_lat: float, max_lon: float):
+        tier = self._tiers[zoom]
+        first_row, first_column, last_row, last_column, columns = self._box_range(zoom, min_lat, min_lon,
+                                                                                 max_lat, max_lon)
+
+        if (last_row - first_row + 1) * (last_column - first_column + 1) > len(tier):
+            # Cheaper to walk the occupied cells than every cell of a huge box
+            for (row, column), cluster in tier.items():
+                if first_row <= row <= last_row and (first_column <= column <= last_column
+                                                     or first_column <= column + columns <= last_column):
+                    yield (row, column), cluster
+            return
+
+        for row in range(first_row, last_row + 1):
+            for column in range(first_column, last_column + 1):
+                cluster = tier.get((row, column % columns))
+                if cluster is not None:
+                    yield (row, column % columns), cluster
+
+    def clusters(self, zoom: int, min_lat: float, min_lon: float, max_lat: float, max_lon: float,
+                 max_cells: int = 1024) -> list:
+        zoom = min(max(zoom, self.min_zoom), self.max_zoom)
+
+        # A box far bigger than the screen at this zoom is served from a coarser tier
+        while zoom > self.min_zoom and self._box_cells(zoom, min_lat, min_lon, max_lat, max_lon) > max_cells:
+            zoom -= 1
+
+        res = list()
+        with self._lock:
+            for _, cluster in self._cells_in_box(zoom, min_lat, min_lon, max_lat, max_lon):
+                element = {
+                    "count_": cluster.count,
+                    "latitude_": cluster.lat_sum / cluster.count,
+                    "longitude_": cluster.lon_sum / cluster.count,
+                    "best_rating_": self._best_rating(cluster),
+                }
+                if cluster.count == 1:
+                    element["toilet_id_"] = next(iter(cluster.members))
+                res.append(element)
+
+        return res
@@ -0,0 +1,91 @@
+import unittest
+
+from clustering import ClusterIndex, in_box
+
+
+def total(clusters: list) -> int:
+    return sum(cluster["count_"] for cluster in clusters)
+
+
+class InBoxTests(unittest.TestCase):
+    def test_plain_box(self):
+        self.assertTrue(in_box(55.7, 37.6, 55, 37, 56, 38))
+        self.assertFalse(in_box(55.7, 38.1, 55, 37, 56, 38))
+
+    def test_box_across_the_antimeridian(self):
+        self.assertTrue(in_box(0, 179.5, -1, 179, 1, -179))
+        self.assertTrue(in_box(0, -179.5, -1, 179, 1, -179))
+        self.assertFalse(in_box(0, 0, -1, 179, 1, -179))
+
+
+class ClusterIndexTests(unittest.TestCase):
+    def test_every_zoom_counts_every_toilet(self):
+        index = ClusterIndex()
+        for toilet_id in range(50):
+            index.add(toilet_id, 55.7 + toilet_id * 0.001, 37.6 + toilet_id * 0.001, rating=toilet_id % 5)
+
+        for zoom in range(index.min_zoom, index.max_zoom + 1):
+            self.assertEqual(50, total(index.clusters(zoom, 55, 37, 56, 38)), zoom)
+
+    def test_single_toilet_cluster_carries_its_id(self):
+        index = ClusterIndex()
+        index.add(7, 55.7, 37.6, rating=4.5)
+
+        cluster, = index.clusters(index.max_zoom, 55, 37, 56, 38)
+        self.assertEqual({"count_": 1, "latitude_": 55.7, "longitude_": 37.6, "best_rating_": 4.5, "toilet_id_": 7},
+                         cluster)
+
+    def test_edges_of_the_map_stay_on_the_grid(self):
+        index = ClusterIndex()
+        for toilet_id, (lat, lon) in enumerate([(0, 180), (0, -180), (90, 0), (-90, 0), (90, 180)]):
+            index.add(toilet_id, lat, lon)
+
+        for zoom, tier in index._tiers.items():
+            for row, column in tier:
+                self.assertTrue(0 <= row < index.rows[zoom] and 0 <= column < index.columns[zoom], (zoom, row, column))
+
+        # 180 and -180 are the same meridian
+        self.assertEqual(index._cell(5, 0, 180), index._cell(5, 0, -180))
+
+    def test_whole_world_box(self):
+        index = ClusterIndex()
+        for toilet_id, (lat, lon) in enumerate([(0, 180), (0, -180), (0, 0), (55.7, 37.6), (-33.9, 151.2)]):
+            index.add(toilet_id, lat, lon)
+
+        for zoom in range(index.min_zoom, index.max_zoom + 1):
+            self.assertEqual(5, total(index.clusters(zoom, -90, -180, 90, 180)), zoom)
+
+    def test_box_across_the_antimeridian(self):
+        index = ClusterIndex()
+        index.add(1, 0, 179.9)
+        index.add(2, 0, -179.9)
+        index.add(3, 0, 180)
+        index.add(4, 0, 0)
+
+        self.assertEqual(3, total(index.clusters(10, -1, 179, 1, -179)))
+        self.assertEqual(2, total(index.clusters(10, -1, 179, 1, 180)))
+
+    def test_best_rating_follows_rating_changes(self):
+        index = ClusterIndex()
+        index.add(1, 55.7, 37.6, rating=5)
+        index.add(2, 55.7001, 37.6001, rating=3)
+
+        index.set_rating(1, 2)
+        cluster, = index.clusters(index.min_zoom, 55, 37, 56, 38)
+        self.assertEqual(3, cluster["best_rating_"])
+
+        index.set_rating(2, 4.5)
+        cluster, = index.clusters(index.min_zoom, 55, 37, 56, 38)
+        self.assertEqual(4.5, cluster["best_rating_"])
+
+    def test_huge_box_falls_back_to_a_coarser_zoom(self):
+        index = ClusterIndex()
+        for toilet_id in range(20):
+            index.add(toilet_id, -60 + toilet_id * 6, -170 + toilet_id * 17)
+
+        clusters = index.clusters(index.max_zoom, -90, -180, 90, 180, max_cells=64)
+        self.assertEqual(20, total(clusters))
+
+
+if __name__ == '__main__':
+    unittest.main()
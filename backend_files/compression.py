@@ -0,0 +1,126 @@
+import gzip
+import threading
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class Compressor:
+    # gzip and, when the brotli package is installed, br for JSON bodies of at least `min_size` bytes.
+    # Bodies compressed per request use fast settings, snapshots (made once per data version for the
+    # payload cache) use the slower `snapshot_*` ones since their cost is shared by every later request.
+
+    def __init__(self, min_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 4,
+                 snapshot_gzip_level: int = 9, snapshot_brotli_quality: int = 9):
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.snapshot_gzip_level = snapshot_gzip_level
+        self.snapshot_brotli_quality = snapshot_brotli_quality
+
+        # Preferred first when the client accepts both with the same quality
+        self.encodings = ("br", "gzip") if brotli is not None else ("gzip",)
+
+        self._lock = threading.Lock()
+        self.compressed = 0
+        self.snapshots = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def _compress(self, body: bytes, encoding: str, snapshot: bool) -> bytes:
+        if encoding == "br":
+            return brotli.compress(body, quality=self.snapshot_brotli_quality if snapshot else self.brotli_quality)
+        return gzip.compress(body, self.snapshot_gzip_level if snapshot else self.gzip_level, mtime=0)
+
+    def compressobj(self, encoding: str):
+        # Incremental compressor for streamed bodies, see StreamCompressor
+        return StreamCompressor(self, encoding)
+
+    def compress_chunks(self, chunks, encoding: str):
+        # Compressed chunks of a streamed body, each one decodable as soon as it is sent
+        stream = self.compressobj(encoding)
+        try:
+            for chunk in chunks:
+                compressed = stream.process(chunk)
+                if compressed:
+                    yield compressed
+            yield stream.finish()
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+
+    def negotiate(self, accept_encodings, available=None):
+        # Best encoding from the request's Accept-Encoding, None means send the body as it is
+        return accept_encodings.best_match(available if available is not None else self.encodings)
+
+    def compress(self, body: bytes, encoding: str) -> bytes:
+        compressed = self._compress(body, encoding, False)
+        self._count(len(body), len(compressed))
+        return compressed
+
+    def _count(self, bytes_in: int, bytes_out: int):
+        with self._lock:
+            self.compressed += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def snapshot(self, body: bytes) -> dict:
+        # encoding -> compressed body, for every supported encoding
+        if len(body) < self.min_size:
+            return dict()
+
+        variants = {encoding: self._compress(body, encoding, True) for encoding in self.encodings}
+
+        with self._lock:
+            self.snapshots += 1
+
+        return variants
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "encodings": list(self.encodings),
+                "min_size": self.min_size,
+                "compressed": self.compressed,
+                "snapshots": self.snapshots,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "ratio": self.bytes_out / self.bytes_in if self.bytes_in else 0,
+            }
+
+
+class StreamCompressor:
+    # gzip or br over a body that arrives in chunks, with the per request settings of `compressor`.
+    # process() returns everything the client can decode up to the end of the chunk, so a stream isn't
+    # held back until the compressor's buffers fill. finish() ends the stream and counts it in the metrics.
+
+    def __init__(self, compressor: Compressor, encoding: str):
+        self.compressor = compressor
+        self.encoding = encoding
+        if encoding == "br":
+            self._stream = brotli.Compressor(quality=compressor.brotli_quality)
+        else:
+            self._stream = zlib.compressobj(compressor.gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def process(self, chunk: bytes) -> bytes:
+        if self.encoding == "br":
+            compressed = self._stream.process(chunk) + self._stream.flush()
+        else:
+            compressed = self._stream.compress(chunk) + self._stream.flush(zlib.Z_SYNC_FLUSH)
+
+        self.bytes_in += len(chunk)
+        self.bytes_out += len(compressed)
+        return compressed
+
+    def finish(self) -> bytes:
+        compressed = self._stream.finish() if self.encoding == "br" else self._stream.flush()
+
+        self.bytes_out += len(compressed)
+        self.compressor._count(self.bytes_in, self.bytes_out)
+        return compressed
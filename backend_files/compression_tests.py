@@ -0,0 +1,52 @@
+import gzip
+import unittest
+import zlib
+
+import compression
+from compression import Compressor
+
+
+class CompressChunksTests(unittest.TestCase):
+    def setUp(self):
+        self.compressor = Compressor(min_size=0)
+        self.chunks = [b"[", b'{"id_": 1},' * 200, b'{"id_": 2}', b"]"]
+
+    def test_gzip_stream_is_the_body(self):
+        compressed = list(self.compressor.compress_chunks(iter(self.chunks), "gzip"))
+
+        self.assertEqual(b"".join(self.chunks), gzip.decompress(b"".join(compressed)))
+        metrics = self.compressor.metrics()
+        self.assertEqual((1, sum(map(len, self.chunks)), sum(map(len, compressed))),
+                         (metrics["compressed"], metrics["bytes_in"], metrics["bytes_out"]))
+
+    def test_every_chunk_can_be_decoded_when_sent(self):
+        decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        compressed = self.compressor.compress_chunks(iter(self.chunks), "gzip")
+
+        self.assertEqual(b"[", decoder.decompress(next(compressed)))
+        self.assertEqual(self.chunks[1], decoder.decompress(next(compressed)))
+
+    @unittest.skipIf(compression.brotli is None, "brotli is not installed")
+    def test_brotli_stream_is_the_body(self):
+        compressed = b"".join(self.compressor.compress_chunks(iter(self.chunks), "br"))
+        self.assertEqual(b"".join(self.chunks), compression.brotli.decompress(compressed))
+
+    def test_closing_closes_the_body(self):
+        closed = list()
+
+        def body():
+            try:
+                yield from self.chunks
+            finally:
+                closed.append(True)
+
+        compressed = self.compressor.compress_chunks(body(), "gzip")
+        next(compressed)
+        compressed.close()
+
+        self.assertEqual([True], closed)
+        self.assertEqual(0, self.compressor.metrics()["compressed"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,3 +2,66 @@ username = ""
 password = ""
 database_name = ""
 host = ""
+
+pool_min_size = 1
+pool_max_size = 10
+pool_timeout = 30.0
+
+version_refresh_interval = 1.0
+
+change_log_retention_days = 30
+
+user_cache_size = 10000
+user_cache_ttl = 60.0
+
+report_log_directory = "reports"
+report_queue_size = 10000
+report_flush_interval = 1.0
+report_max_bytes = 10 * 1024 * 1024
+report_max_age = 24 * 60 * 60
+report_max_files = 50
+
+# Bearer token of the admin routes (/admin/reports, /schema/refresh), they answer 403 while it is None
+admin_token = None
+
+argon2_time_cost = 3
+argon2_memory_cost = 65536
+argon2_parallelism = 4
+password_workers = 2
+password_queue_size = 64
+# Seconds in the Retry-After of the 503 answered while the Argon2 pool is saturated
+password_retry_after = 1
+
+json_backend = "auto"
+payload_cache_max_bytes = 64 * 1024 * 1024
+payload_cache_max_entry_bytes = 16 * 1024 * 1024
+
+compression_min_size = 1024
+gzip_level = 6
+brotli_quality = 4
+snapshot_gzip_level = 9
+snapshot_brotli_quality = 9
+
+benchmark_database_name = "toilets_benchmark"
+
+# Scratch database for the route tests in api_tests.py, same host and credentials, emptied by every run
+test_database_name = "toilets_test"
+
+# Read replicas of the database above, same name and credentials
+replica_hosts = []
+replica_max_lag = 5.0
+replica_check_interval = 2.0
+read_your_writes_seconds = 5.0
+
+# GET /toilets/search: score = text relevance (0-1) + search_rating_weight * average rating / 5
+search_rating_weight = 0.2
+
+# Opening hours are stored as local times, GET /toilets?open_now= compares them with the time here
+opening_hours_timezone = "Europe/Moscow"
+
+log_level = "INFO"
+# Share of INFO/DEBUG records that are written, warnings and errors always are
+log_sample_rate = 0.01
+# Requests slower than this are logged with the statements they sent
+slow_request_seconds = 1.0
+slow_request_max_queries = 100
@@ -1,63 +1,532 @@
+import functools
+import logging
+import math
+import sys
+import threading
+import uuid
+
 import psycopg2
-from argon2.exceptions import VerifyMismatchError, VerificationError, InvalidHashError
-from argon2 import PasswordHasher
+from psycopg2 import sql
+from psycopg2.extensions import make_dsn
+from psycopg2.extras import execute_values
 from config import password, username, database_name, host
-import argon2
+from db_pool import ConnectionPool, PoolTimeout
+from db_replicas import Replica, ReplicaSet
+from db_schema import SchemaRegistry
+from db_statements import PreparedStatements
+from versions import VersionTracker
+from user_cache import UserCache
+from password_hashing import PasswordService
+from validation import toilet_values, review_values, verification_values
+from log_setup import setup_logging
+
+log = logging.getLogger("toilets.db")
+
+
+def average_rating(rating_sum: int, review_count: int):
+    # Same arithmetic the API always used: the float mean, or integer 0 without reviews
+    return rating_sum / review_count if review_count else 0
+
+
+DUPLICATE_VOTE = "User already voted for this toilet"
+
+# The hottest lookups, prepared once per connection, see PreparedStatements
+PREPARED_STATEMENTS = {
+    "user_by_id": "SELECT * FROM users_ WHERE id_ = $1",
+    "user_by_login": "SELECT * FROM users_ WHERE login_ = $1",
+    "user_exists": "SELECT id_ FROM users_ WHERE login_ = $1",
+    "toilet_by_id": "SELECT * FROM toilets_ WHERE id_ = $1",
+    "reviews_by_toilet_id": "SELECT * FROM toilet_reviews_ WHERE toilet_id_ = $1",
+}
+
+
+def verification_tally(upvotes: int, downvotes: int) -> dict:
+    # confidence_ is the lower bound of the 95% Wilson score interval for the share of upvotes,
+    # so a couple of lucky votes don't outrank a toilet that hundreds of people have confirmed
+    votes = upvotes + downvotes
+    if votes:
+        z = 1.96
+        share = upvotes / votes
+        confidence = ((share + z * z / (2 * votes)
+                       - z * math.sqrt((share * (1 - share) + z * z / (4 * votes)) / votes))
+                      / (1 + z * z / votes))
+    else:
+        confidence = 0
+
+    return {
+        "upvotes_": upvotes,
+        "downvotes_": downvotes,
+        "net_score_": upvotes - downvotes,
+        "confidence_": round(confidence, 4),
+    }
+
+
+def map_toilet_details(columns, rows) -> list:
+    # Rows of TOILET_DETAILS_QUERY, the last five columns become the enriched fields
+    columns = columns[:-5]
+
+    res = list()
+    for row in rows:
+        toilet = dict(zip(columns, row))
+        author_name, rating_sum, review_count, upvotes, downvotes = row[-5:]
+
+        toilet["average_rating_"] = average_rating(rating_sum, review_count)
+        toilet["author_name_"] = author_name
+        toilet["review_count_"] = review_count
+        toilet["verification_"] = verification_tally(upvotes, downvotes)
+        res.append(toilet)
+
+    return res
+
+
+def map_rows(columns, rows) -> list:
+    return [dict(zip(columns, row)) for row in rows]
+
+
+# One query instead of a user lookup and a reviews lookup per toilet. Ratings come from the
+# toilet_ratings_ aggregates and are divided in python, so the served average stays exactly the same.
+TOILET_DETAILS_QUERY = ("SELECT t.*, u.display_name_, COALESCE(r.rating_sum_, 0), COALESCE(r.review_count_, 0), "
+                        "COALESCE(v.upvotes_, 0), COALESCE(v.downvotes_, 0) "
+                        "FROM toilets_ t "
+                        "LEFT JOIN users_ u ON u.id_ = t.author_id_ "
+                        "LEFT JOIN toilet_ratings_ r ON r.toilet_id_ = t.id_ "
+                        "LEFT JOIN toilet_verification_tallies_ v ON v.toilet_id_ = t.id_ ")
+
+# Listing name -> (query, alias of the table whose id_ is paged on, row mapper)
+LISTINGS = {
+    "users_": ("SELECT * FROM users_ x ", "x", map_rows),
+    "toilets_": (TOILET_DETAILS_QUERY, "t", map_toilet_details),
+    "toilet_reviews_": ("SELECT x.*, u.display_name_ AS user_display_name_ "
+                        "FROM toilet_reviews_ x "
+                        "LEFT JOIN users_ u ON u.id_ = x.user_id_ ", "x", map_rows),
+    "toilet_verifications_": ("SELECT * FROM toilet_verifications_ x ", "x", map_rows),
+}
+
+# The compaction horizon and the newest change log entry whose transaction, and every one before it, has committed
+SYNC_CURSOR_QUERY = ("SELECT h.tx_, h.id_, l.tx_, l.id_ FROM change_log_horizon_ h "
+                     "LEFT JOIN LATERAL (SELECT tx_, id_ FROM change_log_ "
+                     "WHERE tx_ < txid_snapshot_xmin(txid_current_snapshot()) "
+                     "ORDER BY tx_ DESC, id_ DESC LIMIT 1) l ON true")
+
+
+# Toilet entries of the change log after a cursor. The last column says whether the entry's transaction, and
+# every one before it, has committed. The ones that haven't come last, see DBManager.get_changes().
+TOILET_CHANGES_QUERY = ("SELECT tx_, id_, entity_id_, tx_ < txid_snapshot_xmin(txid_current_snapshot()) "
+                        "FROM change_log_ "
+                        "WHERE (tx_, id_) > (%s, %s) AND entity_ = 'toilet' "
+                        "ORDER BY tx_, id_ "
+                        "LIMIT %s")
+
+TOILET_LOCATIONS_QUERY = ("SELECT t.id_, t.coordinates_, COALESCE(r.rating_sum_, 0), COALESCE(r.review_count_, 0) "
+                          "FROM toilets_ t "
+                          "LEFT JOIN toilet_ratings_ r ON r.toilet_id_ = t.id_ ")
+
+
+def toilet_locations(rows) -> list:
+    return [(toilet_id, coordinates, average_rating(rating_sum, review_count))
+            for toilet_id, coordinates, rating_sum, review_count in rows]
+
+
+def sync_cursor(row) -> tuple:
+    # (tx_, id_) from a SYNC_CURSOR_QUERY row. Listings read after it was taken hold every change up to it,
+    # so a client that downloads them and then syncs from this cursor misses nothing.
+    horizon_tx, horizon_id, tx, change_id = row
+    if tx is None:
+        return horizon_tx, horizon_id
+    return max((horizon_tx, horizon_id), (tx, change_id))
+
+
+# Filter name (see validation.toilet_filters) -> boolean column of toilets_
+TOILET_FLAG_COLUMNS = {
+    "is_public": "is_public_",
+    "disabled_access": "disabled_access_",
+    "baby_access": "baby_access_",
+    "parking": "parking_nearby_",
+}
+
+
+def toilet_conditions(alias: str, filters: dict) -> tuple:
+    # (SQL conditions, params) of validation.toilet_filters() on the toilets_ table `alias`.
+    # A window whose closing time is before its opening time runs past midnight, equal times mean
+    # open around the clock. Toilets without opening hours match neither open_now=true nor false.
+    conditions = list()
+    params = list()
+
+    for name, column in TOILET_FLAG_COLUMNS.items():
+        if name in filters:
+            conditions.append(f"{alias}.{column} = %s")
+            params.append(filters[name])
+
+    if "max_cost" in filters:
+        conditions.append(f"{alias}.cost_ <= %s")
+        params.append(filters["max_cost"])
+
+    if "open_now" in filters:
+        opening, closing = f"{alias}.opening_time_", f"{alias}.closing_time_"
+        is_open = (f"CASE WHEN {opening} < {closing} THEN {opening} <= %s AND %s < {closing} "
+                   f"WHEN {opening} > {closing} THEN {opening} <= %s OR %s < {closing} "
+                   f"ELSE {opening} = {closing} END")
+        conditions.append(is_open if filters["open_now"] else f"NOT ({is_open})")
+        params += [filters["open_at"]] * 4
+
+    return conditions, params
+
+
+def listing_where(alias: str, after_id: int = None, filters: dict = None) -> tuple:
+    # (WHERE clause, params) for a listing page after `after_id` or a whole listing, filters are toilets_ only
+    conditions, params = toilet_conditions(alias, filters) if filters else (list(), list())
+    if after_id is not None:
+        conditions.insert(0, f"{alias}.id_ > %s")
+        params.insert(0, after_id)
+
+    if not conditions:
+        return "", params
+    return "WHERE " + " AND ".join(conditions) + " ", params
+
+
+def search_statement(text: str, limit: int, reviews: bool = False, rating_weight: float = 0.2) -> tuple:
+    # (query, params) giving (toilet id, score) of the best matches for `text`, best first.
+    # A place name starting with the text is a full match, otherwise word_similarity() finds names with
+    # a word close to it, typos included. With reviews=True matching review text counts at half weight.
+    # score = relevance + rating_weight * average rating / 5. Both <% and ILIKE use the trigram indexes.
+    matches = ("SELECT id_ AS toilet_id_, "
+               "CASE WHEN place_name_ ILIKE %(prefix)s THEN 1.0 ELSE word_similarity(%(text)s, place_name_) END "
+               "AS relevance_ "
+               "FROM toilets_ "
+               "WHERE place_name_ ILIKE %(prefix)s OR %(text)s <%% place_name_ ")
+    if reviews:
+        matches += ("UNION ALL "
+                    "SELECT toilet_id_, 0.5 * word_similarity(%(text)s, review_text_) "
+                    "FROM toilet_reviews_ "
+                    "WHERE %(text)s <%% review_text_ ")
+
+    query = ("SELECT m.toilet_id_, max(m.relevance_) "
+             "+ %(rating_weight)s * COALESCE(max(r.rating_sum_)::float / NULLIF(max(r.review_count_), 0), 0) / 5 "
+             "AS score_ "
+             f"FROM ({matches}) m "
+             "LEFT JOIN toilet_ratings_ r ON r.toilet_id_ = m.toilet_id_ "
+             "GROUP BY m.toilet_id_ "
+             "ORDER BY score_ DESC, m.toilet_id_ "
+             "LIMIT %(limit)s")
+
+    prefix = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+    return query, {"text": text, "prefix": prefix, "rating_weight": rating_weight, "limit": limit}
+
+
+def rank_search_results(scores: list, toilets: list) -> list:
+    # Toilets in the order of their (toilet id, score) rows, with the score as search_score_
+    toilets = {toilet["id_"]: toilet for toilet in toilets}
+
+    res = list()
+    for toilet_id, score in scores:
+        toilet = toilets.get(toilet_id)
+        if toilet:
+            toilet["search_score_"] = round(float(score), 4)
+            res.append(toilet)
+
+    return res
+
+
+def replica_read(method):
+    # Runs the method on the request's replica when reads may go to one (see DBManager.route_reads),
+    # self.conn / self.cur point at the replica connection meanwhile. If the replica fails,
+    # it is ejected and the method runs again on the primary.
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        replica = self._request_replica()
+        if replica is None or getattr(self._local, "reading", None) is not None:
+            return method(self, *args, **kwargs)
+
+        self._local.reading = replica
+        try:
+            return method(self, *args, **kwargs)
+        except (psycopg2.OperationalError, PoolTimeout) as e:
+            if isinstance(e, psycopg2.OperationalError):
+                self.replicas.eject(replica, e)
+            self._release_replica()
+            self._local.replica_allowed = False
+        finally:
+            self._local.reading = None
+
+        return method(self, *args, **kwargs)
+
+    return wrapper
 
 
 class DBManager:
-    def __init__(self, db_host: str, db_username: str, db_password: str, db_name: str, db_port: int = 5432):
+    def __init__(self, db_host: str, db_username: str, db_password: str, db_name: str, db_port: int = 5432,
+                 pool_min_size: int = 1, pool_max_size: int = 10, pool_timeout: float = 30.0,
+                 version_refresh_interval: float = 1.0, user_cache_size: int = 10000, user_cache_ttl: float = 60.0,
+                 passwords: PasswordService = None, replica_hosts: list = None, replica_max_lag: float = 5.0,
+                 replica_check_interval: float = 2.0):
         self.db_host = db_host
         self.db_name = db_name
         self.db_username = db_username
         self.db_password = db_password
         self.db_port = db_port
 
-        print("Connecting to DB...")
+        log.info("Connecting to DB...")
+
+        self.pool = ConnectionPool(self._connector(self.db_host), pool_min_size, pool_max_size, pool_timeout)
+
+        # Same database name and credentials on every replica, each gets a pool of its own
+        self.replicas = None
+        if replica_hosts:
+            self.replicas = ReplicaSet([
+                Replica(replica_host,
+                        ConnectionPool(self._connector(replica_host), 0, pool_max_size, pool_timeout),
+                        version_refresh_interval)
+                for replica_host in replica_hosts], replica_max_lag, replica_check_interval)
+
+        log.info("Connection successful")
+
+        # Every thread works on its own pooled connection, taken on first use and given back by release()
+        self._local = threading.local()
+
+        self.versions = VersionTracker(version_refresh_interval)
+
+        self.schema = SchemaRegistry()
+        self.statements = PreparedStatements(PREPARED_STATEMENTS, version=lambda: self.versions.get("schema_")[0])
+        self.load_schema()
+
+        self.user_cache = UserCache(self.get_users_summaries, user_cache_size, user_cache_ttl,
+                                    version=lambda: self.versions.get("users_")[0])
+
+        self.passwords = passwords or PasswordService()
+
+    def _connector(self, db_host: str) -> str:
+        # make_dsn quotes the values, an empty host (the local socket) or a password with spaces stays one field
+        return make_dsn(host=db_host, dbname=self.db_name, user=self.db_username, password=self.db_password,
+                        port=self.db_port)
+
+    @property
+    def conn(self):
+        replica = getattr(self._local, "reading", None)
+        if replica is not None:
+            conn = getattr(self._local, "replica_conn", None)
+            if conn is None:
+                conn = replica.pool.getconn()
+                self._local.replica_conn = conn
+                self._local.replica_cur = conn.cursor()
+            return conn
+
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self.pool.getconn()
+            self._local.conn = conn
+            self._local.cur = conn.cursor()
+        return conn
+
+    @property
+    def cur(self):
+        if getattr(self._local, "reading", None) is not None:
+            self.conn
+            return self._local.replica_cur
+
+        if getattr(self._local, "conn", None) is None:
+            self.conn
+        return self._local.cur
+
+    def route_reads(self, allowed: bool):
+        # Called at the start of a request, with allowed=True the replica_read methods of this thread
+        # go to one replica (the same one for the whole request) until release()
+        self._local.replica_allowed = allowed and self.replicas is not None
+        self._local.replica = None
+
+    def _request_replica(self):
+        if not getattr(self._local, "replica_allowed", None):
+            return None
 
-        connector = (f"host={self.db_host} "
-                     f"dbname={self.db_name} "
-                     f"user={self.db_username} "
-                     f"password={self.db_password} "
-                     f"port={self.db_port}")
+        replica = getattr(self._local, "replica", None)
+        if replica is None:
+            replica = self._local.replica = self.replicas.choose()
+            if replica is None:
+                # Nothing healthy, the rest of the request stays on the primary
+                self._local.replica_allowed = False
+        return replica
+
+    def _release_replica(self):
+        conn = getattr(self._local, "replica_conn", None)
+        if conn is None:
+            return
+
+        replica = self._local.replica
+        self._local.replica_cur.close()
+        self._local.replica_conn = None
+        self._local.replica_cur = None
+
+        replica.pool.putconn(conn)
+
+    def release(self):
+        self._release_replica()
+        self._local.replica_allowed = False
+        self._local.replica = None
+
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            return
+
+        self._local.cur.close()
+        self._local.conn = None
+        self._local.cur = None
+
+        self.pool.putconn(conn)
+
+    def set_query_listener(self, listener):
+        # listener(statement, seconds) is called for every statement sent on the primary or a replica
+        self.pool.query_listener = listener
+        if self.replicas is not None:
+            for replica in self.replicas.replicas:
+                replica.pool.query_listener = listener
+
+    def close(self):
+        self.release()
+        self.pool.closeall()
+        if self.replicas is not None:
+            self.replicas.close()
+
+    def load_schema(self, *bump_keys) -> list:
+        # Uses its own connection so it is safe to call in the middle of a request, `bump_keys` are bumped
+        # in the same transaction and their new versions returned
+        conn = self.pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                self.schema.load(cur)
+                versions = self.bump_versions(*bump_keys, cur=cur) if bump_keys else []
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn)
+
+        return versions
+
+    def refresh_schema(self):
+        # After a migration. Bumping schema_ makes the other worker processes deallocate their prepared
+        # statements too, once their versions are refreshed.
+        self.versions.update(self.load_schema("schema_"))
+        self.statements.invalidate()
+
+    def bump_versions(self, *keys, cur=None):
+        # Must run inside the write's transaction, pass the result to self.versions.update() after the commit
+        cur = cur or self.cur
+        cur.execute("INSERT INTO data_versions_ (key_, version_, modified_at_) "
+                    "SELECT key_, 1, now() FROM unnest(%s::varchar[]) AS key_ "
+                    "ON CONFLICT (key_) DO UPDATE "
+                    "SET version_ = data_versions_.version_ + 1, modified_at_ = now() "
+                    "RETURNING key_, version_, modified_at_", (list(keys),))
+
+        return cur.fetchall()
+
+    def log_changes(self, *changes):
+        # (entity, entity id) pairs for /sync, must run inside the write's transaction.
+        # tx_ defaults to txid_current(), which is what keeps the sync cursor safe, see get_changes().
+        self.cur.execute("INSERT INTO change_log_ (entity_, entity_id_) "
+                         "SELECT * FROM unnest(%s::varchar[], %s::integer[])",
+                         ([entity for entity, _ in changes], [int(entity_id) for _, entity_id in changes]))
+
+    def get_changes(self, since: tuple, limit: int = 1000):
+        # Changes after the (tx_, id_) cursor, in commit-safe order. Only transactions older than every
+        # transaction still running are returned, so a slow writer can never commit behind the cursor.
+        self.cur.execute("SELECT h.tx_, h.id_ FROM change_log_horizon_ h")
+        horizon = self.cur.fetchone()
+        if horizon and tuple(since) < horizon:
+            return None
 
-        self.conn = psycopg2.connect(connector)
+        self.cur.execute("SELECT tx_, id_, entity_, entity_id_ FROM change_log_ "
+                         "WHERE (tx_, id_) > (%s, %s) AND tx_ < txid_snapshot_xmin(txid_current_snapshot()) "
+                         "ORDER BY tx_, id_ "
+                         "LIMIT %s", (since[0], since[1], limit))
 
-        print("Connection successful")
+        return self.cur.fetchall()
 
-        self.cur = self.conn.cursor()
+    def get_toilet_changes(self, since: tuple, limit: int = 5000):
+        # TOILET_CHANGES_QUERY rows, None when the cursor is older than the compaction horizon
+        self.cur.execute("SELECT h.tx_, h.id_ FROM change_log_horizon_ h")
+        horizon = self.cur.fetchone()
+        if horizon and tuple(since) < horizon:
+            return None
 
-    def get_columns(self, table_name_: str):
+        self.cur.execute(TOILET_CHANGES_QUERY, (since[0], since[1], limit))
+
+        return self.cur.fetchall()
+
+    def get_sync_cursor(self) -> tuple:
+        # Where a client starts syncing once it downloaded the listings, see sync_cursor()
+        self.cur.execute(SYNC_CURSOR_QUERY)
+        return sync_cursor(self.cur.fetchone())
 
-        # maybe add this AND table_schema = 'your_schema_name'
+    def compact_changes(self, retention_days: int):
+        # Drops change log entries older than the retention, clients behind them have to resync from scratch
+        try:
+            self.cur.execute("WITH deleted AS ("
+                             "DELETE FROM change_log_ WHERE created_at_ < now() - make_interval(days => %s) "
+                             "RETURNING tx_, id_) "
+                             "SELECT tx_, id_ FROM deleted ORDER BY tx_ DESC, id_ DESC LIMIT 1", (retention_days,))
+            last_deleted = self.cur.fetchone()
+
+            if last_deleted:
+                self.cur.execute("UPDATE change_log_horizon_ SET tx_ = %s, id_ = %s WHERE (tx_, id_) < (%s, %s)",
+                                 last_deleted * 2)
 
-        self.cur.execute("SELECT column_name "
-                         "FROM information_schema.columns "
-                         f"WHERE table_schema = 'public' AND table_name = '{table_name_}';")
+        except Exception as e:
+            log.warning(e)
+            self.conn.rollback()
+            return "Error on compaction: " + str(e)
 
-        res = self.cur.fetchall()
+        self.conn.commit()
+        log.info("Change log compacted up to %s", last_deleted)
 
-        columns = list(map(lambda x: x[0], res))
+        return None
 
-        return columns
+    def get_users_summaries(self, ids: list) -> list:
+        # Public fields only, this is what /users/<id> and the user cache serve
+        self.cur.execute("SELECT id_, display_name_, creation_date_ FROM users_ WHERE id_ = ANY(%s) ORDER BY id_",
+                         ([int(user_id) for user_id in ids],))
 
-    def map_columns_and_data(self, columns, data):
-        res = list()
+        return self.map_columns_and_data(self.get_result_columns(), self.cur.fetchall())
+
+    def get_listing_by_ids(self, listing: str, ids: list) -> list:
+        query, alias, mapper = LISTINGS[listing]
+
+        self.cur.execute(query + f"WHERE {alias}.id_ = ANY(%s) ORDER BY {alias}.id_", (list(ids),))
+
+        return mapper(self.get_result_columns(), self.cur.fetchall())
+
+    @replica_read
+    def get_etag(self, resource: str, keys: list) -> tuple:
+        # On a replica the versions are the replica's own, the ETag must not be newer than the data read there
+        replica = getattr(self._local, "reading", None)
+        versions = replica.versions if replica is not None else self.versions
+
+        if versions.needs_refresh():
+            versions.refresh(self.cur)
 
+        return versions.etag(resource, keys)
+
+    def get_columns(self, table_name_: str):
+        return list(self.schema.columns(table_name_))
+
+    def get_result_columns(self):
+        # Column names of the last query, straight from the cursor metadata
+        return tuple(column[0] for column in self.cur.description)
+
+    def map_columns_and_data(self, columns, data):
         if type(data) != list:
             data = [data]
-        for entry in data:
-            element = dict()
-            for index, item in enumerate(columns):
-                element[item] = entry[index]
-            res.append(element)
 
-        return res
+        return [dict(zip(columns, entry)) for entry in data]
 
+    @replica_read
     def get_table_contents(self, table_name: str) -> list:
-        self.cur.execute(f"SELECT * FROM {table_name}")
+        if table_name not in self.schema:
+            raise ValueError(f"Unknown table {table_name}")
+
+        self.cur.execute(sql.SQL("SELECT * FROM {}").format(sql.Identifier(table_name)))
         data = self.cur.fetchall()
-        columns = self.get_columns(table_name)
+        columns = self.get_result_columns()
 
         res = self.map_columns_and_data(columns, data)
 
@@ -66,63 +535,67 @@ class DBManager:
     def get_all_users(self):
         return self.get_table_contents("users_")
 
+    @replica_read
     def get_user_by_id(self, id: int):
-        self.cur.execute(f"SELECT * FROM users_ WHERE id_={id}")
+        self.statements.execute(self.cur, "user_by_id", (id,))
 
         user = self.cur.fetchone()
         if not user:
             return None
 
         data = user
-        columns = self.get_columns("users_")
+        columns = self.get_result_columns()
 
         res = self.map_columns_and_data(columns, data)[0]
 
         return res
 
     def get_user_by_login(self, login: str):
-        self.cur.execute(f"SELECT * FROM users_ WHERE login_='{login}'")
+        self.cur.execute("SELECT * FROM users_ WHERE login_ = %s", (login,))
 
         user = self.cur.fetchone()
         if not user:
             return None
 
         data = user
-        columns = self.get_columns("users_")
+        columns = self.get_result_columns()
 
         res = self.map_columns_and_data(columns, data)[0]
 
         return res
 
     def add_user(self, user_data: dict):
-        ph = PasswordHasher()
         try:
             login = user_data['login']
             password = user_data['password']
             display_name = user_data['display_name']
 
         except Exception as e:
-            print(e)
+            log.warning(e)
             return "Error on data retrieve: " + str(e)
 
-        hashed_password = ph.hash(password)
-        # hashed_password = password
+        # PasswordQueueFull is left to the route, it answers 503
+        hashed_password = self.passwords.hash(password)
 
         try:
-            self.cur.execute(f"INSERT INTO users_ "
-                             f"(display_name_, login_, password_hashed_, creation_date_) "
-                             f"VALUES ('{display_name}', '{login}', '{hashed_password}', CURRENT_DATE)")
+            self.cur.execute("INSERT INTO users_ "
+                             "(display_name_, login_, password_hashed_, creation_date_) "
+                             "VALUES (%s, %s, %s, CURRENT_DATE)", (display_name, login, hashed_password))
+            versions = self.bump_versions("users_")
 
         except Exception as e:
-            print(e)
+            log.warning(e)
+            self.conn.rollback()
             return "Error on insert: " + str(e)
 
         self.conn.commit()
+        self.versions.update(versions)
 
         return None
 
+    @replica_read
     def check_if_user_exists(self, user_login) -> bool:
-        self.cur.execute(f"SELECT id_ FROM users_ WHERE login_ = '{user_login}'")
+        self.statements.execute(self.cur, "user_exists", (user_login,))
         res = self.cur.fetchone()
         if res:
             return True
@@ -134,20 +607,120 @@ class DBManager:
 
         return toilets
 
+    @replica_read
     def get_toilet(self, id: int):
-        self.cur.execute(f"SELECT * FROM toilets_ WHERE id_={id}")
+        self.statements.execute(self.cur, "toilet_by_id", (id,))
 
         toilet = self.cur.fetchone()
         if not toilet:
             return None
 
         data = toilet
-        columns = self.get_columns("toilets_")
+        columns = self.get_result_columns()
 
         res = self.map_columns_and_data(columns, data)[0]
 
         return res
 
+    @replica_read
+    def search_toilets(self, text: str, limit: int = 20, reviews: bool = False, rating_weight: float = 0.2) -> list:
+        self.cur.execute(*search_statement(text, limit, reviews, rating_weight))
+        scores = self.cur.fetchall()
+        if not scores:
+            return []
+
+        return rank_search_results(scores, self.get_toilets_with_details([toilet_id for toilet_id, _ in scores]))
+
+    @replica_read
+    def get_toilets_with_details(self, ids: list = None):
+        if ids is None:
+            self.cur.execute(TOILET_DETAILS_QUERY + "ORDER BY t.id_")
+        else:
+            self.cur.execute(TOILET_DETAILS_QUERY + "WHERE t.id_ = ANY(%s) ORDER BY t.id_", (list(ids),))
+
+        return map_toilet_details(self.get_result_columns(), self.cur.fetchall())
+
+    @replica_read
+    def get_listing_page(self, listing: str, after_id: int = 0, limit: int = 100, filters: dict = None) -> list:
+        # Keyset pagination, the next page starts after the last id_ of this one
+        query, alias, mapper = LISTINGS[listing]
+        where, params = listing_where(alias, after_id, filters)
+
+        self.cur.execute(query + where + f"ORDER BY {alias}.id_ LIMIT %s", (*params, limit))
+
+        return mapper(self.get_result_columns(), self.cur.fetchall())
+
+    def stream_listing(self, listing: str, chunk_size: int = 2000, filters: dict = None):
+        # The pool is picked now, on the request's thread, the rows are read later while the response is sent
+        replica = self._request_replica()
+
+        return self._stream_listing(replica.pool if replica is not None else self.pool, listing, chunk_size, filters)
+
+    def _stream_listing(self, pool: ConnectionPool, listing: str, chunk_size: int, filters: dict):
+        # Generator over a whole listing through a server-side cursor, so only one chunk is in memory at a time.
+        # It uses its own connection because the response is streamed after the request has been torn down.
+        query, alias, mapper = LISTINGS[listing]
+        where, params = listing_where(alias, filters=filters)
+
+        conn = pool.getconn()
+        try:
+            with conn.cursor(name=f"stream_{uuid.uuid4().hex}") as cur:
+                cur.execute(query + where + f"ORDER BY {alias}.id_", params)
+
+                while True:
+                    rows = cur.fetchmany(chunk_size)
+                    if not rows:
+                        break
+
+                    yield from mapper(tuple(column[0] for column in cur.description), rows)
+        finally:
+            pool.putconn(conn)
+
+    def get_toilet_locations(self, ids: list = None):
+        # (id_, coordinates_, average rating) of the given toilets, of every toilet without ids
+        if ids is None:
+            self.cur.execute(TOILET_LOCATIONS_QUERY + "ORDER BY t.id_")
+        else:
+            self.cur.execute(TOILET_LOCATIONS_QUERY + "WHERE t.id_ = ANY(%s) ORDER BY t.id_",
+                             ([int(toilet_id) for toilet_id in ids],))
+
+        return toilet_locations(self.cur.fetchall())
+
+    def get_toilet_rating(self, toilet_id: int):
+        return self.get_toilet_ratings([toilet_id]).get(int(toilet_id), 0)
+
+    def get_toilet_ratings(self, toilet_ids: list) -> dict:
+        self.cur.execute("SELECT toilet_id_, rating_sum_, review_count_ FROM toilet_ratings_ WHERE toilet_id_ = ANY(%s)",
+                         ([int(toilet_id) for toilet_id in toilet_ids],))
+
+        return {toilet_id: average_rating(rating_sum, review_count)
+                for toilet_id, rating_sum, review_count in self.cur.fetchall()}
+
+    def repair_rating_aggregates(self):
+        # Rebuilds toilet_ratings_ from toilet_reviews_, used for the initial backfill and after manual edits
+        try:
+            self.cur.execute("CREATE TABLE IF NOT EXISTS toilet_ratings_ ("
+                             "toilet_id_ INTEGER PRIMARY KEY REFERENCES toilets_ (id_), "
+                             "rating_sum_ BIGINT NOT NULL DEFAULT 0, "
+                             "review_count_ INTEGER NOT NULL DEFAULT 0)")
+            self.cur.execute("LOCK TABLE toilet_reviews_ IN SHARE MODE")
+            self.cur.execute("DELETE FROM toilet_ratings_")
+            self.cur.execute("INSERT INTO toilet_ratings_ (toilet_id_, rating_sum_, review_count_) "
+                             "SELECT toilet_id_, SUM(rating_), COUNT(*) FROM toilet_reviews_ GROUP BY toilet_id_")
+            repaired = self.cur.rowcount
+            versions = self.bump_versions("toilet_reviews_")
+
+        except Exception as e:
+            log.warning(e)
+            self.conn.rollback()
+            return "Error on repair: " + str(e)
+
+        self.conn.commit()
+        self.versions.update(versions)
+        log.info("Rating aggregates rebuilt for %d toilets", repaired)
+
+        return None
+
     def add_toilet(self, toilet_data: dict):
         try:
             author_id = toilet_data["author_id_"]
@@ -163,49 +736,71 @@ class DBManager:
             cost = toilet_data["cost_"]
 
         except Exception as e:
-            print(e)
+            log.warning(e)
             return "Error on data retrieve: " + str(e)
 
         try:
             self.cur.execute(
                 "INSERT INTO toilets_ (author_id_, coordinates_, place_name_, is_public_, disabled_access_, baby_access_, parking_nearby_, creation_date_ ,opening_time_, closing_time_, cost_) "
-                f"VALUES ({author_id}, '{coordinates}', '{place_name}', {is_public}, {disabled_access}, {baby_access}, {parking_nearby}, CURRENT_DATE, '{opening_time}', '{closing_time}', {cost});")
+                "VALUES (%s, %s, %s, %s, %s, %s, %s, CURRENT_DATE, %s, %s, %s) RETURNING id_",
+                (author_id, coordinates, place_name, is_public, disabled_access, baby_access, parking_nearby,
+                 opening_time, closing_time, cost))
+            toilet_id = self.cur.fetchone()[0]
+            self.log_changes(("toilet", toilet_id))
+            versions = self.bump_versions("toilets_")
 
         except Exception as e:
-            print(e)
+            log.warning(e)
+            self.conn.rollback()
             return "Error on insert: " + str(e)
 
         self.conn.commit()
+        self.versions.update(versions)
 
         return None
 
     def check_password(self, login_data):
-        ph = PasswordHasher()
         login = login_data["login"]
         password = login_data["password"]
 
-        # hashed_password = password
-
-        self.cur.execute(f"SELECT password_hashed_ FROM users_ WHERE login_ = '{login}'")
-        try:
-            res = self.cur.fetchone()[0]
-        except TypeError:
+        self.statements.execute(self.cur, "user_by_login", (login,))
+        user = self.cur.fetchone()
+        if not user:
             return None  # if user wasn't even found
 
-        try:
-            ph.verify(res, password)
-            user = self.get_user_by_login(login)
-            return user
+        user = self.map_columns_and_data(self.get_result_columns(), user)[0]
+
+        # Don't hold a pooled connection while Argon2 runs
+        self.release()
 
-        except (VerifyMismatchError, VerificationError, InvalidHashError) as e:
-            print(e)
+        # PasswordQueueFull is left to the route: the password wasn't checked, that's no wrong password
+        if not self.passwords.verify(user["password_hashed_"], password):
             return None
 
+        if self.passwords.needs_rehash(user["password_hashed_"]):
+            self.rehash_password(user["id_"], password)
+
+        return user
+
+    def rehash_password(self, user_id: int, password: str):
+        # The Argon2 parameters changed since this hash was made, upgrade it now that we know the password
+        try:
+            hashed_password = self.passwords.hash(password)
+            self.cur.execute("UPDATE users_ SET password_hashed_ = %s WHERE id_ = %s", (hashed_password, user_id))
+        except Exception as e:
+            log.warning(e)
+            self.conn.rollback()
+            return
+
+        self.conn.commit()
+        self.passwords.rehashed()
+
     def get_all_reviews(self):
         return self.get_table_contents("toilet_reviews_")
 
+    @replica_read
     def get_reviews_by_toilet_id(self, id: int):
-        self.cur.execute(f"SELECT * FROM toilet_reviews_ WHERE toilet_id_={id}")
+        self.statements.execute(self.cur, "reviews_by_toilet_id", (id,))
 
         reviews = self.cur.fetchall()
 
@@ -213,7 +808,7 @@ class DBManager:
             return None
 
         data = reviews
-        columns = self.get_columns("toilet_reviews_")
+        columns = self.get_result_columns()
 
         res = self.map_columns_and_data(columns, data)
 
@@ -227,42 +822,56 @@ class DBManager:
             if "review_text_" not in review_data:
                 review_text = None
             else:
-                review_text = review_data["review_text_"].replace("'", "").replace('"', "")
+                review_text = review_data["review_text_"]
 
         except Exception as e:
-            print(e)
+            log.warning(e)
             return "Error on data retrieve: " + str(e)
 
         try:
             if review_text is None:
                 self.cur.execute(
                     "INSERT INTO toilet_reviews_ (toilet_id_, user_id_, rating_) "
-                    f"VALUES ({toilet_id}, {user_id}, {rating})")
+                    "VALUES (%s, %s, %s) RETURNING id_", (toilet_id, user_id, rating))
             else:
                 self.cur.execute(
                     "INSERT INTO toilet_reviews_ (toilet_id_, user_id_, rating_, review_text_) "
-                    f"VALUES ({toilet_id}, {user_id}, {rating}, '{review_text}')")
+                    "VALUES (%s, %s, %s, %s) RETURNING id_", (toilet_id, user_id, rating, review_text))
+            review_id = self.cur.fetchone()[0]
+
+            # Keep the per-toilet aggregates in the same transaction as the review itself
+            self.cur.execute("INSERT INTO toilet_ratings_ (toilet_id_, rating_sum_, review_count_) "
+                             "VALUES (%s, %s, 1) "
+                             "ON CONFLICT (toilet_id_) DO UPDATE "
+                             "SET rating_sum_ = toilet_ratings_.rating_sum_ + EXCLUDED.rating_sum_, "
+                             "review_count_ = toilet_ratings_.review_count_ + 1", (toilet_id, rating))
+            # The toilet is logged too, its average_rating_ and review_count_ have changed
+            self.log_changes(("review", review_id), ("toilet", toilet_id))
+            versions = self.bump_versions("toilet_reviews_", f"toilet_reviews_:{toilet_id}")
 
         except Exception as e:
-            print(e)
+            log.warning(e)
+            self.conn.rollback()
             return "Error on insert: " + str(e)
 
         self.conn.commit()
+        self.versions.update(versions)
 
         return None
 
     def get_all_verifications(self):
         return self.get_table_contents("toilet_verifications_")
 
+    @replica_read
     def get_verification(self, id: int):
-        self.cur.execute(f"SELECT * FROM toilet_verifications_ WHERE id_={id}")
+        self.cur.execute("SELECT * FROM toilet_verifications_ WHERE id_ = %s", (id,))
 
         verification = self.cur.fetchone()
         if not verification:
             return None
 
         data = verification
-        columns = self.get_columns("toilet_verifications_")
+        columns = self.get_result_columns()
 
         res = self.map_columns_and_data(columns, data)[0]
 
@@ -275,18 +884,80 @@ class DBManager:
             vote = verification_data["vote"]
 
         except Exception as e:
-            print(e)
+            log.warning(e)
             return "Error on data retrieve: " + str(e)
 
         try:
-            self.cur.execute(f"INSERT INTO toilet_verifications_ (toilet_id_, user_id_, vote_)"
-                             f"VALUES ({toilet_id}, {user_id}, {vote})")
+            # One vote per user per toilet, enforced by the unique index on (toilet_id_, user_id_)
+            self.cur.execute("INSERT INTO toilet_verifications_ (toilet_id_, user_id_, vote_) "
+                             "VALUES (%s, %s, %s) "
+                             "ON CONFLICT (toilet_id_, user_id_) DO NOTHING RETURNING id_", (toilet_id, user_id, vote))
+            inserted = self.cur.fetchone()
+            if not inserted:
+                self.conn.rollback()
+                return DUPLICATE_VOTE
+
+            self.update_verification_tallies([(toilet_id, vote)])
+            # The toilet is logged too, its verification_ tally has changed
+            self.log_changes(("verification", inserted[0]), ("toilet", toilet_id))
+            versions = self.bump_versions("toilet_verifications_")
 
         except Exception as e:
-            print(e)
+            log.warning(e)
+            self.conn.rollback()
             return "Error on insert: " + str(e)
 
         self.conn.commit()
+        self.versions.update(versions)
+
+        return None
+
+    def update_verification_tallies(self, votes: list):
+        # (toilet id, vote) pairs of newly inserted votes, must run inside the insert's transaction
+        tallies = dict()
+        for toilet_id, vote in votes:
+            upvotes, downvotes = tallies.get(int(toilet_id), (0, 0))
+            tallies[int(toilet_id)] = (upvotes + (vote > 0), downvotes + (vote < 0))
+
+        self.cur.execute("INSERT INTO toilet_verification_tallies_ (toilet_id_, upvotes_, downvotes_) "
+                         "SELECT * FROM unnest(%s::integer[], %s::integer[], %s::integer[]) "
+                         "ON CONFLICT (toilet_id_) DO UPDATE "
+                         "SET upvotes_ = toilet_verification_tallies_.upvotes_ + EXCLUDED.upvotes_, "
+                         "downvotes_ = toilet_verification_tallies_.downvotes_ + EXCLUDED.downvotes_",
+                         (list(tallies), [tally[0] for tally in tallies.values()],
+                          [tally[1] for tally in tallies.values()]))
+
+    @replica_read
+    def get_verification_tallies(self, toilet_ids: list) -> list:
+        # Toilets that don't exist are left out, toilets without votes get a zero tally
+        self.cur.execute("SELECT t.id_, COALESCE(v.upvotes_, 0), COALESCE(v.downvotes_, 0) "
+                         "FROM toilets_ t "
+                         "LEFT JOIN toilet_verification_tallies_ v ON v.toilet_id_ = t.id_ "
+                         "WHERE t.id_ = ANY(%s) "
+                         "ORDER BY t.id_", ([int(toilet_id) for toilet_id in toilet_ids],))
+
+        return [{"toilet_id_": toilet_id, **verification_tally(upvotes, downvotes)}
+                for toilet_id, upvotes, downvotes in self.cur.fetchall()]
+
+    def repair_verification_tallies(self):
+        # Rebuilds toilet_verification_tallies_ from toilet_verifications_
+        try:
+            self.cur.execute("LOCK TABLE toilet_verifications_ IN SHARE MODE")
+            self.cur.execute("DELETE FROM toilet_verification_tallies_")
+            self.cur.execute("INSERT INTO toilet_verification_tallies_ (toilet_id_, upvotes_, downvotes_) "
+                             "SELECT toilet_id_, COUNT(*) FILTER (WHERE vote_ > 0), COUNT(*) FILTER (WHERE vote_ < 0) "
+                             "FROM toilet_verifications_ GROUP BY toilet_id_")
+            repaired = self.cur.rowcount
+            versions = self.bump_versions("toilet_verifications_")
+
+        except Exception as e:
+            log.warning(e)
+            self.conn.rollback()
+            return "Error on repair: " + str(e)
+
+        self.conn.commit()
+        self.versions.update(versions)
+        log.info("Verification tallies rebuilt for %d toilets", repaired)
 
         return None
 
@@ -295,23 +966,142 @@ class DBManager:
             user_id = name_change_data["user_id"]
             new_name = name_change_data["new_name"]
         except Exception as e:
-            print(e)
+            log.warning(e)
             return "Error on data retrieve: " + str(e)
 
         try:
-            self.cur.execute(f"UPDATE users_ SET display_name_ = '{new_name}' WHERE id_ = {user_id}")
+            self.cur.execute("UPDATE users_ SET display_name_ = %s WHERE id_ = %s", (new_name, user_id))
+            self.log_changes(("user", user_id))
+            versions = self.bump_versions("users_")
 
         except Exception as e:
-            print(e)
+            log.warning(e)
+            self.conn.rollback()
             return "Error on update"
 
         self.conn.commit()
+        self.versions.update(versions)
+        self.user_cache.invalidate(int(user_id))
         return None
 
+    def add_batch(self, kind: str, items: list) -> list:
+        # Validates every item, then inserts all valid ones with multi-row statements in one transaction.
+        # Returns one status per item, in the order they were sent.
+        validate, insert = {
+            "toilets": (toilet_values, self._insert_toilets),
+            "reviews": (review_values, self._insert_reviews),
+            "verifications": (verification_values, self._insert_verifications),
+        }[kind]
+
+        statuses = list()
+        rows = list()
+        positions = list()
+        for index, item in enumerate(items):
+            try:
+                rows.append(validate(item))
+                positions.append(index)
+                statuses.append(None)
+            except ValueError as e:
+                statuses.append({"index_": index, "status_": "invalid", "message_": str(e)})
+
+        if not rows:
+            return statuses
+
+        try:
+            ids, versions = insert(rows)
+
+        except Exception as e:
+            log.warning(e)
+            self.conn.rollback()
+            for index in positions:
+                statuses[index] = {"index_": index, "status_": "failed", "message_": "Error on insert: " + str(e)}
+            return statuses
+
+        self.conn.commit()
+        self.versions.update(versions)
+
+        for index, new_id in zip(positions, ids):
+            if new_id is None:
+                statuses[index] = {"index_": index, "status_": "duplicate", "message_": DUPLICATE_VOTE}
+            else:
+                statuses[index] = {"index_": index, "status_": "created", "id_": new_id}
+
+        return statuses
+
+    def _insert_toilets(self, rows: list) -> tuple:
+        ids = execute_values(self.cur,
+                             "INSERT INTO toilets_ (author_id_, coordinates_, place_name_, is_public_, disabled_access_, "
+                             "baby_access_, parking_nearby_, creation_date_, opening_time_, closing_time_, cost_) "
+                             "VALUES %s RETURNING id_", rows,
+                             template="(%s, %s, %s, %s, %s, %s, %s, CURRENT_DATE, %s, %s, %s)", fetch=True)
+        ids = [row[0] for row in ids]
+
+        self.log_changes(*(("toilet", toilet_id) for toilet_id in ids))
+
+        return ids, self.bump_versions("toilets_")
+
+    def _insert_reviews(self, rows: list) -> tuple:
+        ids = execute_values(self.cur,
+                             "INSERT INTO toilet_reviews_ (toilet_id_, user_id_, rating_, review_text_) "
+                             "VALUES %s RETURNING id_", rows, fetch=True)
+        ids = [row[0] for row in ids]
+
+        execute_values(self.cur,
+                       "INSERT INTO toilet_ratings_ (toilet_id_, rating_sum_, review_count_) "
+                       "SELECT v.toilet_id_, SUM(v.rating_), COUNT(*) FROM (VALUES %s) AS v (toilet_id_, rating_) "
+                       "GROUP BY v.toilet_id_ "
+                       "ON CONFLICT (toilet_id_) DO UPDATE "
+                       "SET rating_sum_ = toilet_ratings_.rating_sum_ + EXCLUDED.rating_sum_, "
+                       "review_count_ = toilet_ratings_.review_count_ + EXCLUDED.review_count_",
+                       [(toilet_id, rating) for toilet_id, _, rating, _ in rows], page_size=len(rows))
+
+        toilet_ids = sorted({toilet_id for toilet_id, _, _, _ in rows})
+        self.log_changes(*(("review", review_id) for review_id in ids),
+                         *(("toilet", toilet_id) for toilet_id in toilet_ids))
+
+        return ids, self.bump_versions("toilet_reviews_", *(f"toilet_reviews_:{toilet_id}" for toilet_id in toilet_ids))
+
+    def _insert_verifications(self, rows: list) -> tuple:
+        # Votes that would be a second vote by the same user are skipped and come back as None
+        inserted = execute_values(self.cur,
+                                  "INSERT INTO toilet_verifications_ (toilet_id_, user_id_, vote_) VALUES %s "
+                                  "ON CONFLICT (toilet_id_, user_id_) DO NOTHING "
+                                  "RETURNING toilet_id_, user_id_, id_", rows, fetch=True)
+        inserted = {(toilet_id, user_id): new_id for toilet_id, user_id, new_id in inserted}
+
+        ids = list()
+        votes = list()
+        for toilet_id, user_id, vote in rows:
+            new_id = inserted.pop((toilet_id, user_id), None)
+            ids.append(new_id)
+            if new_id is not None:
+                votes.append((toilet_id, vote))
+
+        if votes:
+            self.update_verification_tallies(votes)
+
+        # The toilets are logged too, their verification_ tallies have changed
+        toilet_ids = sorted({toilet_id for toilet_id, _ in votes})
+        self.log_changes(*(("verification", verification_id) for verification_id in ids if verification_id is not None),
+                         *(("toilet", toilet_id) for toilet_id in toilet_ids))
+
+        return ids, self.bump_versions("toilet_verifications_")
+
 
 if __name__ == '__main__':
+    setup_logging()
     db = DBManager(host, username, password, database_name)
 
+    if sys.argv[1:] == ["repair_ratings"]:
+        db.repair_rating_aggregates()
+
+    if sys.argv[1:] == ["repair_verifications"]:
+        db.repair_verification_tallies()
+
+    if sys.argv[1:] == ["compact_changes"]:
+        from config import change_log_retention_days
+        db.compact_changes(change_log_retention_days)
+
     # print(db.get_all_users())
 
     # print(db.get_user(1))
@@ -0,0 +1,134 @@
+import datetime
+import sqlite3
+import unittest
+
+from db_connector import map_toilet_details, search_statement, sync_cursor, toilet_conditions, verification_tally
+from validation import toilet_filters
+
+TOILET_COLUMNS = ("id_", "author_id_", "place_name_", "cost_")
+DETAIL_COLUMNS = TOILET_COLUMNS + ("display_name_", "coalesce", "coalesce", "coalesce", "coalesce")
+
+
+def legacy_details(toilet: dict, author_name: str, ratings: list) -> dict:
+    # What GET /toilets did per toilet before the joined query
+    avg = 0
+    count = 0
+    for rating in ratings:
+        avg += rating
+        count += 1
+    if count:
+        avg = avg / count
+
+    toilet = dict(toilet)
+    toilet["average_rating_"] = avg
+    toilet["author_name_"] = author_name
+    toilet["review_count_"] = count
+    return toilet
+
+
+class MapToiletDetailsTests(unittest.TestCase):
+    def test_matches_the_per_toilet_averages(self):
+        cases = [([], "Ann"), ([5], "Bob"), ([5, 4, 4], None), ([1, 2, 2, 5, 3, 4, 1], "Eve")]
+
+        for number, (ratings, author_name) in enumerate(cases):
+            toilet = {"id_": number, "author_id_": 7, "place_name_": "Somewhere", "cost_": 0}
+            row = (*toilet.values(), author_name, sum(ratings), len(ratings), 0, 0)
+
+            mapped = map_toilet_details(DETAIL_COLUMNS, [row])[0]
+            del mapped["verification_"]
+
+            expected = legacy_details(toilet, author_name, ratings)
+            self.assertEqual(expected, mapped)
+            self.assertEqual(list(expected), list(mapped))
+            self.assertIs(type(expected["average_rating_"]), type(mapped["average_rating_"]))
+
+
+class VerificationTallyTests(unittest.TestCase):
+    def test_counts(self):
+        tally = verification_tally(7, 3)
+        self.assertEqual((7, 3, 4), (tally["upvotes_"], tally["downvotes_"], tally["net_score_"]))
+
+    def test_no_votes(self):
+        self.assertEqual({"upvotes_": 0, "downvotes_": 0, "net_score_": 0, "confidence_": 0}, verification_tally(0, 0))
+
+    def test_wilson_lower_bound(self):
+        # (p + z²/2n - z * sqrt((p(1-p) + z²/4n) / n)) / (1 + z²/n) with z = 1.96
+        self.assertEqual(0.2065, verification_tally(1, 0)["confidence_"])
+        self.assertEqual(0.0, verification_tally(0, 5)["confidence_"])
+        self.assertEqual(0.2366, verification_tally(5, 5)["confidence_"])
+
+    def test_many_votes_outrank_a_few_lucky_ones(self):
+        self.assertLess(verification_tally(2, 0)["confidence_"], verification_tally(180, 20)["confidence_"])
+        self.assertLess(verification_tally(180, 20)["confidence_"], verification_tally(1800, 200)["confidence_"])
+        self.assertLess(verification_tally(5, 5)["confidence_"], 0.5)
+
+
+class SyncCursorTests(unittest.TestCase):
+    def test_newest_committed_change(self):
+        self.assertEqual((900, 52), sync_cursor((700, 40, 900, 52)))
+
+    def test_horizon_when_the_log_is_empty(self):
+        self.assertEqual((700, 40), sync_cursor((700, 40, None, None)))
+        self.assertEqual((0, 0), sync_cursor((0, 0, None, None)))
+
+    def test_never_behind_the_horizon(self):
+        self.assertEqual((700, 40), sync_cursor((700, 40, 700, 12)))
+
+
+class OpenNowTests(unittest.TestCase):
+    # toilet_conditions() run by SQLite on "HH:MM:SS" text, which orders like the time type
+    WINDOWS = {1: ("08:00:00", "20:00:00"), 2: ("22:00:00", "06:00:00"), 3: ("00:00:00", "00:00:00"), 4: (None, None)}
+
+    def setUp(self):
+        self.db = sqlite3.connect(":memory:")
+        self.addCleanup(self.db.close)
+        self.db.execute("CREATE TABLE toilets_ (id_ INTEGER, opening_time_ TEXT, closing_time_ TEXT)")
+        self.db.executemany("INSERT INTO toilets_ VALUES (?, ?, ?)",
+                            [(toilet_id, *window) for toilet_id, window in self.WINDOWS.items()])
+
+    def open_at(self, open_now: str, hour: int, minute: int = 0) -> list:
+        now = datetime.time(hour, minute)
+        conditions, params = toilet_conditions("t", toilet_filters({"open_now": open_now}, now))
+        query = f"SELECT id_ FROM toilets_ t WHERE {' AND '.join(conditions)} ORDER BY id_".replace("%s", "?")
+        return [toilet_id for toilet_id, in self.db.execute(query, [f"{param:%H:%M:%S}" for param in params])]
+
+    def test_daytime_window(self):
+        self.assertEqual([1, 3], self.open_at("true", 8))
+        self.assertEqual([1, 3], self.open_at("true", 19, 59))
+        self.assertEqual([3], self.open_at("true", 20))
+
+    def test_window_past_midnight(self):
+        self.assertEqual([2, 3], self.open_at("true", 23, 59))
+        self.assertEqual([2, 3], self.open_at("true", 0))
+        self.assertEqual([2, 3], self.open_at("true", 5, 59))
+        self.assertEqual([3], self.open_at("true", 6))
+        self.assertEqual([3], self.open_at("true", 21, 59))
+
+    def test_closed_excludes_unknown_hours(self):
+        self.assertEqual([1], self.open_at("false", 23))
+        self.assertEqual([2], self.open_at("false", 12))
+
+
+class SearchStatementTests(unittest.TestCase):
+    def test_prefix_is_escaped(self):
+        query, params = search_statement("50%_off\\", 10)
+        self.assertEqual("50\\%\\_off\\\\%", params["prefix"])
+        self.assertEqual(("50%_off\\", 10, 0.2), (params["text"], params["limit"], params["rating_weight"]))
+
+    def test_reviews_are_matched_on_request(self):
+        query, _ = search_statement("cafe", 10)
+        self.assertNotIn("toilet_reviews_", query)
+
+        query, _ = search_statement("cafe", 10, reviews=True, rating_weight=0.5)
+        self.assertIn("UNION ALL", query)
+        self.assertIn("%(text)s <%% review_text_", query)
+
+    def test_every_placeholder_has_a_param(self):
+        for reviews in (False, True):
+            query, params = search_statement("cafe", 10, reviews)
+            # psycopg2 formats with the % operator, a missing key or a stray % would raise here
+            self.assertIn("'cafe' <% place_name_", query % {key: repr(value) for key, value in params.items()})
+
+
+if __name__ == '__main__':
+    unittest.main()
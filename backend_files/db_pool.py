@@ -0,0 +1,195 @@
+import threading
+import time
+from collections import deque
+
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, cursor
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+def counting_cursor(record):
+    # Cursor class that reports every statement it sends, including COPY, as record(statement, seconds)
+    class CountingCursor(cursor):
+        def execute(self, query, vars=None):
+            started = time.perf_counter()
+            try:
+                return super().execute(query, vars)
+            finally:
+                record(query, time.perf_counter() - started)
+
+        def executemany(self, query, vars_list):
+            started = time.perf_counter()
+            try:
+                return super().executemany(query, vars_list)
+            finally:
+                record(query, time.perf_counter() - started)
+
+        def copy_expert(self, sql, file, size=8192):
+            started = time.perf_counter()
+            try:
+                return super().copy_expert(sql, file, size)
+            finally:
+                record(sql, time.perf_counter() - started)
+
+    return CountingCursor
+
+
+class ConnectionPool:
+    # Unlike psycopg2.pool.ThreadedConnectionPool, getconn() waits for a free connection
+    # instead of failing straight away, and the waits are recorded for sizing the pool.
+
+    def __init__(self, connector: str, min_size: int = 1, max_size: int = 10, timeout: float = 30.0,
+                 health_check_interval: float = 30.0):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f"Invalid pool size: min {min_size}, max {max_size}")
+
+        self.connector = connector
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._idle = deque()  # (connection, last time it was returned)
+
+        self._in_use = 0
+        self._acquired = 0
+        self._timeouts = 0
+        self._discarded = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._queries = 0
+        self._query_seconds = 0.0
+
+        # Every cursor on the pool's connections counts its statements into metrics()["queries"],
+        # and passes them on to query_listener(statement, seconds) when one is set
+        self.query_listener = None
+        self._cursor_factory = counting_cursor(self._record_query)
+
+        for _ in range(min_size):
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        return psycopg2.connect(self.connector, cursor_factory=self._cursor_factory)
+
+    def _record_query(self, query, seconds: float):
+        with self._lock:
+            self._queries += 1
+            self._query_seconds += seconds
+
+        if self.query_listener is not None:
+            self.query_listener(query, seconds)
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _is_healthy(self, conn, last_used: float) -> bool:
+        if conn.closed:
+            return False
+
+        # Only ping connections that have been sitting idle for a while, hot ones are trusted
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _take(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, last_used = self._idle.pop()  # LIFO, so the most recently used connection is reused
+
+            if self._is_healthy(conn, last_used):
+                return conn
+
+            self._close(conn)
+            with self._lock:
+                self._discarded += 1
+
+        return self._connect()
+
+    def getconn(self):
+        start = time.monotonic()
+
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self._timeouts += 1
+            raise PoolTimeout(f"No database connection available after {self.timeout} seconds")
+
+        waited = time.monotonic() - start
+
+        try:
+            conn = self._take()
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._in_use += 1
+            self._acquired += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+
+        return conn
+
+    def putconn(self, conn):
+        keep = not conn.closed
+
+        if keep and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            # Never hand out a connection that is still inside a (possibly aborted) transaction
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                keep = False
+
+        with self._lock:
+            self._in_use -= 1
+            if keep and len(self._idle) < self.max_size:
+                self._idle.append((conn, time.monotonic()))
+                conn = None
+            else:
+                self._discarded += 1
+
+        if conn is not None:
+            self._close(conn)
+
+        self._slots.release()
+
+    def closeall(self):
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+
+        for conn, _ in idle:
+            self._close(conn)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "acquired": self._acquired,
+                "timeouts": self._timeouts,
+                "discarded": self._discarded,
+                "wait_seconds_total": self._wait_total,
+                "wait_seconds_max": self._wait_max,
+                "wait_seconds_avg": self._wait_total / self._acquired if self._acquired else 0,
+                "queries": self._queries,
+                "query_seconds": self._query_seconds,
+            }
@@ -0,0 +1,131 @@
+import threading
+import unittest
+from unittest import mock
+
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INERROR
+
+import db_pool
+from db_pool import ConnectionPool, PoolTimeout
+
+
+class Connection:
+    # Enough of a psycopg2 connection for the pool: its state and what was done to it
+    def __init__(self):
+        self.closed = 0
+        self.status = TRANSACTION_STATUS_IDLE
+        self.rollbacks = 0
+        self.fail_rollback = False
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        if self.fail_rollback:
+            raise psycopg2.OperationalError("server closed the connection")
+        self.rollbacks += 1
+        self.status = TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+class ConnectionPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.connections = list()
+        patcher = mock.patch.object(db_pool.psycopg2, "connect", side_effect=self.connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def connect(self, connector, cursor_factory=None):
+        conn = Connection()
+        self.connections.append(conn)
+        return conn
+
+    def test_invalid_sizes(self):
+        for min_size, max_size in ((-1, 1), (0, 0), (3, 2)):
+            with self.assertRaises(ValueError):
+                ConnectionPool("dbname=test", min_size, max_size)
+
+    def test_opens_min_size_and_reuses_the_latest(self):
+        pool = ConnectionPool("dbname=test", min_size=2, max_size=3)
+        self.assertEqual(2, len(self.connections))
+
+        conn = pool.getconn()
+        pool.putconn(conn)
+        self.assertIs(conn, pool.getconn())
+
+        self.assertEqual(2, len(self.connections))
+        self.assertEqual((1, 1), (pool.metrics()["in_use"], pool.metrics()["idle"]))
+
+    def test_waits_for_a_free_connection(self):
+        pool = ConnectionPool("dbname=test", min_size=0, max_size=1, timeout=5)
+        conn = pool.getconn()
+
+        got = list()
+        waiter = threading.Thread(target=lambda: got.append(pool.getconn()))
+        waiter.start()
+        waiter.join(0.05)
+        self.assertEqual([], got)
+
+        pool.putconn(conn)
+        waiter.join()
+        self.assertEqual([conn], got)
+        self.assertGreater(pool.metrics()["wait_seconds_max"], 0)
+
+    def test_times_out(self):
+        pool = ConnectionPool("dbname=test", min_size=0, max_size=1, timeout=0.01)
+        pool.getconn()
+
+        with self.assertRaises(PoolTimeout):
+            pool.getconn()
+        self.assertEqual(1, pool.metrics()["timeouts"])
+
+    def test_open_transactions_are_rolled_back(self):
+        pool = ConnectionPool("dbname=test", min_size=0, max_size=2)
+        conn = pool.getconn()
+        conn.status = TRANSACTION_STATUS_INERROR
+
+        pool.putconn(conn)
+        self.assertEqual(1, conn.rollbacks)
+        self.assertIs(conn, pool.getconn())
+
+    def test_broken_connections_are_replaced(self):
+        pool = ConnectionPool("dbname=test", min_size=0, max_size=2)
+        conn = pool.getconn()
+        conn.status = TRANSACTION_STATUS_INERROR
+        conn.fail_rollback = True
+        pool.putconn(conn)
+
+        self.assertTrue(conn.closed)
+        self.assertIsNot(conn, pool.getconn())
+
+        closed = pool.getconn()
+        closed.closed = 1
+        pool.putconn(closed)
+        self.assertIsNot(closed, pool.getconn())
+        self.assertEqual(2, pool.metrics()["discarded"])
+
+    def test_failed_connect_frees_the_slot(self):
+        pool = ConnectionPool("dbname=test", min_size=0, max_size=1, timeout=0.01)
+
+        with mock.patch.object(db_pool.psycopg2, "connect", side_effect=psycopg2.OperationalError("refused")):
+            with self.assertRaises(psycopg2.OperationalError):
+                pool.getconn()
+
+        pool.getconn()
+        self.assertEqual(0, pool.metrics()["timeouts"])
+
+    def test_statements_are_reported(self):
+        pool = ConnectionPool("dbname=test", min_size=0, max_size=1)
+        heard = list()
+        pool.query_listener = lambda query, seconds: heard.append(query)
+
+        pool._record_query("SELECT 1", 0.5)
+
+        self.assertEqual(["SELECT 1"], heard)
+        self.assertEqual((1, 0.5), (pool.metrics()["queries"], pool.metrics()["query_seconds"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import psycopg2
+
+from db_pool import ConnectionPool, PoolTimeout
+from versions import VersionTracker
+
+log = logging.getLogger("toilets.replicas")
+
+
+class Replica:
+    # A read replica with its own pool and its own copy of data_versions_, so ETags for reads served here
+    # never claim a version the replica hasn't replayed yet
+
+    def __init__(self, name: str, pool: ConnectionPool, version_refresh_interval: float = 1.0):
+        self.name = name
+        self.pool = pool
+        self.versions = VersionTracker(version_refresh_interval)
+
+        self.healthy = True
+        self.lag = None
+        self.last_error = None
+        self.ejections = 0
+        self.reads = 0
+
+
+class ReplicaSet:
+    # Round-robin over the healthy replicas. A background thread checks every replica each `check_interval`
+    # seconds and ejects the ones that can't be reached or replay more than `max_lag` seconds behind the
+    # primary, they come back once a check passes again. Failed reads eject a replica straight away.
+
+    def __init__(self, replicas: list, max_lag: float = 5.0, check_interval: float = 2.0):
+        self.replicas = replicas
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+
+        self._lock = threading.Lock()
+        self._next = itertools.count()
+        self._stopped = threading.Event()
+
+        self._thread = threading.Thread(target=self._run, name="replica-health", daemon=True)
+        self._thread.start()
+
+    def choose(self):
+        # None when no replica is healthy, the read goes to the primary then
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+
+        replica = healthy[next(self._next) % len(healthy)]
+        with self._lock:
+            replica.reads += 1
+        return replica
+
+    def eject(self, replica: Replica, error):
+        with self._lock:
+            if replica.healthy:
+                replica.ejections += 1
+            replica.healthy = False
+            replica.last_error = str(error)
+        log.warning("Replica %s ejected: %s", replica.name, error)
+
+    def _check(self, replica: Replica):
+        # Replay lag is 0 while everything received has been replayed, an idle primary is not lag
+        try:
+            conn = replica.pool.getconn()
+        except (psycopg2.Error, PoolTimeout) as e:
+            self.eject(replica, e)
+            return
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                            "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END")
+                lag = float(cur.fetchone()[0])
+            conn.rollback()
+        except psycopg2.Error as e:
+            self.eject(replica, e)
+            return
+        finally:
+            replica.pool.putconn(conn)
+
+        with self._lock:
+            replica.lag = lag
+            if lag > self.max_lag:
+                if replica.healthy:
+                    replica.ejections += 1
+                replica.healthy = False
+                replica.last_error = f"Replication lag {lag:.1f}s"
+            else:
+                replica.healthy = True
+
+    def _run(self):
+        while not self._stopped.wait(self.check_interval):
+            for replica in self.replicas:
+                self._check(replica)
+
+    def close(self):
+        self._stopped.set()
+        for replica in self.replicas:
+            replica.pool.closeall()
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "max_lag_seconds": self.max_lag,
+                "replicas": [{
+                    "name": replica.name,
+                    "healthy": replica.healthy,
+                    "lag_seconds": replica.lag,
+                    "reads": replica.reads,
+                    "ejections": replica.ejections,
+                    "last_error": replica.last_error,
+                    "pool": replica.pool.metrics(),
+                } for replica in self.replicas],
+            }
+
+
+class RecentWriters:
+    # Clients that wrote within the last `window` seconds, their reads stay on the primary
+
+    def __init__(self, window: float = 5.0, max_size: int = 100000):
+        self.window = window
+        self.max_size = max_size
+
+        self._lock = threading.Lock()
+        self._writes = OrderedDict()  # client key -> last write, oldest first
+
+    def wrote(self, key: str):
+        with self._lock:
+            self._writes.pop(key, None)
+            self._writes[key] = time.monotonic()
+
+            cutoff = time.monotonic() - self.window
+            while self._writes and (len(self._writes) > self.max_size or next(iter(self._writes.values())) < cutoff):
+                self._writes.popitem(last=False)
+
+    def recently_wrote(self, key: str) -> bool:
+        wrote_at = self._writes.get(key)
+        return wrote_at is not None and time.monotonic() - wrote_at < self.window
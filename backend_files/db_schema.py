@@ -0,0 +1,42 @@
+import threading
+
+
+class SchemaRegistry:
+    # Column layout of every table in the public schema, read from information_schema once
+    # instead of on every query. Call load() again after a migration to refresh it.
+
+    QUERY = ("SELECT table_name, column_name "
+             "FROM information_schema.columns "
+             "WHERE table_schema = 'public' "
+             "ORDER BY table_name, ordinal_position")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tables = dict()
+
+    def load(self, cur):
+        cur.execute(self.QUERY)
+        self.update(cur.fetchall())
+
+    async def load_async(self, cur):
+        # Same as load() on an async psycopg cursor
+        await cur.execute(self.QUERY)
+        self.update(await cur.fetchall())
+
+    def update(self, rows):
+        # (table_name, column_name) rows in ordinal order, as returned by QUERY
+        tables = dict()
+        for table_name, column_name in rows:
+            tables.setdefault(table_name, []).append(column_name)
+
+        with self._lock:
+            self._tables = {table_name: tuple(columns) for table_name, columns in tables.items()}
+
+    def __contains__(self, table_name: str) -> bool:
+        return table_name in self._tables
+
+    def tables(self) -> list:
+        return list(self._tables)
+
+    def columns(self, table_name: str) -> tuple:
+        return self._tables[table_name]
@@ -0,0 +1,66 @@
+import threading
+import weakref
+
+
+class PreparedStatements:
+    # Named statements that are PREPAREd on a connection the first time they run there and EXECUTEd
+    # from then on, so PostgreSQL parses and plans each of them once per pooled connection instead of
+    # on every call. Prepared statements belong to the session: rollbacks and trips through the pool
+    # keep them, a reconnect starts over.
+    #
+    # invalidate() after a schema change, a prepared SELECT * fails with "cached plan must not change
+    # result type" once the table's columns change. Every connection deallocates its statements on its
+    # next use then. invalidate() only reaches this process: `version` returns the shared schema_ version,
+    # and once it moves on the connections of every process holding it start over as well.
+
+    def __init__(self, statements: dict, version=None):
+        self.statements = statements  # name -> SQL with $1, $2... placeholders
+        self.version = version
+
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._prepared = weakref.WeakKeyDictionary()  # connection -> (generation, names prepared on it)
+
+        self._prepares = 0
+        self._executions = 0
+
+    def execute(self, cur, name: str, params: tuple = ()):
+        conn = cur.connection
+        version = self.version() if self.version is not None else None
+        with self._lock:
+            generation = (self._generation, version)
+            state = self._prepared.get(conn)
+
+        if state is None or state[0] != generation:
+            if state is not None:
+                cur.execute("DEALLOCATE ALL")
+            state = (generation, set())
+            with self._lock:
+                self._prepared[conn] = state
+
+        if name not in state[1]:
+            cur.execute(f"PREPARE {name} AS {self.statements[name]}")
+            state[1].add(name)
+            with self._lock:
+                self._prepares += 1
+
+        if params:
+            cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+        else:
+            cur.execute(f"EXECUTE {name}")
+
+        with self._lock:
+            self._executions += 1
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "statements": len(self.statements),
+                "connections": len(self._prepared),
+                "prepares": self._prepares,
+                "executions": self._executions,
+            }
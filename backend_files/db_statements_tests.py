@@ -0,0 +1,67 @@
+import unittest
+
+from db_statements import PreparedStatements
+
+
+class Connection:
+    pass
+
+
+class Cursor:
+    # Records the SQL it is given instead of running it
+    def __init__(self, connection: Connection):
+        self.connection = connection
+        self.executed = list()
+
+    def execute(self, query: str, params=None):
+        self.executed.append((query, params))
+
+
+class PreparedStatementsTests(unittest.TestCase):
+    def setUp(self):
+        self.version = 1
+        self.statements = PreparedStatements({"user_by_id": "SELECT * FROM users_ WHERE id_ = $1",
+                                              "users": "SELECT * FROM users_"}, version=lambda: self.version)
+        self.cur = Cursor(Connection())
+
+    def test_prepared_once_per_connection(self):
+        self.statements.execute(self.cur, "user_by_id", (1,))
+        self.statements.execute(self.cur, "user_by_id", (2,))
+        self.statements.execute(self.cur, "users")
+
+        self.assertEqual([("PREPARE user_by_id AS SELECT * FROM users_ WHERE id_ = $1", None),
+                          ("EXECUTE user_by_id (%s)", (1,)),
+                          ("EXECUTE user_by_id (%s)", (2,)),
+                          ("PREPARE users AS SELECT * FROM users_", None),
+                          ("EXECUTE users", None)], self.cur.executed)
+
+        other = Cursor(Connection())
+        self.statements.execute(other, "user_by_id", (1,))
+        self.assertEqual("PREPARE user_by_id AS SELECT * FROM users_ WHERE id_ = $1", other.executed[0][0])
+
+        self.assertEqual({"statements": 2, "connections": 2, "prepares": 3, "executions": 4},
+                         self.statements.metrics())
+
+    def test_invalidate_deallocates_on_next_use(self):
+        self.statements.execute(self.cur, "users")
+        self.statements.invalidate()
+        self.cur.executed.clear()
+
+        self.statements.execute(self.cur, "users")
+        self.assertEqual(["DEALLOCATE ALL", "PREPARE users AS SELECT * FROM users_", "EXECUTE users"],
+                         [query for query, _ in self.cur.executed])
+
+    def test_schema_version_of_another_process_deallocates(self):
+        # POST /schema/refresh served by another worker only moves the shared schema_ version
+        self.statements.execute(self.cur, "users")
+        self.version = 2
+        self.cur.executed.clear()
+
+        self.statements.execute(self.cur, "users")
+        self.statements.execute(self.cur, "users")
+        self.assertEqual(["DEALLOCATE ALL", "PREPARE users AS SELECT * FROM users_", "EXECUTE users",
+                          "EXECUTE users"], [query for query, _ in self.cur.executed])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import datetime
+import decimal
+import json
+import uuid
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _datetime(value: datetime.datetime) -> str:
+    # Same text str() gave these before, so clients see the same values
+    return value.isoformat(" ")
+
+
+def _isoformat(value) -> str:
+    return value.isoformat()
+
+
+# Checked in order, so datetime has to come before its base class date
+TYPE_HANDLERS = [
+    (datetime.datetime, _datetime),
+    (datetime.date, _isoformat),
+    (datetime.time, _isoformat),
+    (decimal.Decimal, str),
+    (uuid.UUID, str),
+    ((set, frozenset), list),
+]
+
+
+def _default(value):
+    for types, handler in TYPE_HANDLERS:
+        if isinstance(value, types):
+            return handler(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class JSONEncoder:
+    # Encodes responses to UTF-8 bytes, with orjson when it is installed and the standard library otherwise.
+    # Both run values they don't know natively through TYPE_HANDLERS. orjson writes compact UTF-8, the
+    # standard library backend keeps json.dumps' defaults, so its bytes are the ones the API always sent.
+
+    def __init__(self, backend: str = "auto"):
+        if backend == "auto":
+            backend = "orjson" if orjson is not None else "json"
+        if backend == "orjson" and orjson is None:
+            raise ValueError("orjson is not installed")
+        if backend not in ("orjson", "json"):
+            raise ValueError(f"Unknown JSON backend {backend}")
+
+        self.backend = backend
+
+        if backend == "orjson":
+            # Dates and times go through the handlers too, orjson would write datetimes with a "T"
+            options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+            self.dumps = lambda value: orjson.dumps(value, default=_default, option=options)
+            self.separator = b","
+        else:
+            encoder = json.JSONEncoder(default=_default)
+            self.dumps = lambda value: encoder.encode(value).encode()
+            self.separator = b", "
+
+    def array_items(self, items: list, first: bool = True) -> bytes:
+        # The items as they appear inside dumps() of a list, with the separator in front unless `first`.
+        # Concatenated between "[" and "]" they give exactly dumps() of the whole list.
+        body = self.dumps(items)[1:-1]
+        return body if first or not body else self.separator + body
+
+    def iter_array(self, items, batch_size: int = 500):
+        # dumps() of a list in chunks, without ever holding the whole list
+        yield b"["
+        batch = list()
+        first = True
+        for item in items:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                yield self.array_items(batch, first)
+                batch = list()
+                first = False
+        yield self.array_items(batch, first) + b"]"
@@ -0,0 +1,54 @@
+import datetime
+import decimal
+import json
+import unittest
+import uuid
+
+from json_encoding import JSONEncoder, orjson
+
+ROWS = [
+    {"id_": 1, "place_name_": "Туалет у метро", "creation_date_": datetime.date(2024, 5, 1),
+     "opening_time_": datetime.time(8, 30), "average_rating_": 13 / 3, "cost_": decimal.Decimal("50.00")},
+    {"id_": 2, "place_name_": None, "time_": datetime.datetime(2024, 5, 1, 12, 30, 15, 250),
+     "token_": uuid.UUID(int=7), "flags_": [True, False], "nested_": {"a": 0}},
+]
+
+
+class JSONEncoderTests(unittest.TestCase):
+    def backends(self):
+        return ["json", "orjson"] if orjson is not None else ["json"]
+
+    def test_json_backend_writes_what_json_dumps_did(self):
+        # The API sent json.dumps(message, default=str) before the encoder was pluggable
+        encoder = JSONEncoder("json")
+
+        for value in (ROWS, ROWS[0], {"Message": "Ошибка"}, [], "text"):
+            self.assertEqual(json.dumps(value, default=str).encode(), encoder.dumps(value))
+
+    def test_backends_agree_on_values(self):
+        expected = json.loads(json.dumps(ROWS, default=str))
+
+        for backend in self.backends():
+            self.assertEqual(expected, json.loads(JSONEncoder(backend).dumps(ROWS)), backend)
+
+    def test_streamed_array_is_dumps_of_the_list(self):
+        for backend in self.backends():
+            encoder = JSONEncoder(backend)
+            for count in (0, 1, 2, 3, 7):
+                items = [dict(ROWS[i % 2], id_=i) for i in range(count)]
+                for batch_size in (1, 2, 500):
+                    self.assertEqual(encoder.dumps(items), b"".join(encoder.iter_array(iter(items), batch_size)),
+                                     (backend, count, batch_size))
+
+    def test_unknown_types_are_rejected(self):
+        for backend in self.backends():
+            with self.assertRaises(TypeError):
+                JSONEncoder(backend).dumps({"value": object()})
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            JSONEncoder("simplejson")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+
+
+class SampleFilter(logging.Filter):
+    # Lets through `rate` of the records below WARNING, warnings and errors always pass
+
+    def __init__(self, rate: float = 1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record) -> bool:
+        return record.levelno >= logging.WARNING or self.rate >= 1.0 or random.random() < self.rate
+
+
+def setup_logging(level: str = "INFO", sample_rate: float = 1.0):
+    # The "toilets" loggers hand their records to a queue, one background thread writes them to stdout,
+    # so request threads never wait on the terminal or a log pipe
+    records = queue.SimpleQueue()
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    listener = logging.handlers.QueueListener(records, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    queue_handler = logging.handlers.QueueHandler(records)
+    queue_handler.addFilter(SampleFilter(sample_rate))
+
+    logger = logging.getLogger("toilets")
+    logger.setLevel(level)
+    logger.handlers = [queue_handler]
+    logger.propagate = False
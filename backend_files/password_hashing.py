@@ -0,0 +1,126 @@
+import asyncio
+import concurrent.futures
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError, VerificationError, InvalidHashError
+
+log = logging.getLogger("toilets.passwords")
+
+
+class PasswordQueueFull(Exception):
+    pass
+
+
+class PasswordService:
+    # Argon2 runs on a small dedicated thread pool (argon2-cffi releases the GIL while hashing),
+    # so a burst of logins can use at most `max_workers` cores and cheap requests don't queue behind it.
+    # Once `max_queue` jobs are already waiting, new ones are rejected instead of piling up, and a job that
+    # takes longer than `timeout` seconds is given up on. Both raise PasswordQueueFull.
+
+    def __init__(self, time_cost: int = 3, memory_cost: int = 65536, parallelism: int = 4,
+                 max_workers: int = 2, max_queue: int = 64, timeout: float = 30.0):
+        self.hasher = PasswordHasher(time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism)
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="argon2")
+        self._lock = threading.Lock()
+
+        self._pending = 0
+        self._max_pending = 0
+        self._completed = 0
+        self._rejected = 0
+        self._timeouts = 0
+        self._rehashed = 0
+
+    def _done(self, future):
+        with self._lock:
+            self._pending -= 1
+            self._completed += 1
+
+    def _submit(self, fn, *args):
+        with self._lock:
+            if self._pending >= self.max_workers + self.max_queue:
+                self._rejected += 1
+                raise PasswordQueueFull("Too many password operations in progress")
+            self._pending += 1
+            self._max_pending = max(self._max_pending, self._pending)
+
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(self._done)
+
+        return future
+
+    def _timed_out(self, future):
+        # Reported like a full queue, the pool is too busy to answer in time. A job that hasn't started
+        # yet is dropped, one that is running finishes in the background.
+        future.cancel()
+        with self._lock:
+            self._timeouts += 1
+        return PasswordQueueFull(f"Password operation didn't finish within {self.timeout} seconds")
+
+    def _run(self, fn, *args):
+        future = self._submit(fn, *args)
+        try:
+            return future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            raise self._timed_out(future) from None
+
+    async def _run_async(self, fn, *args):
+        # The event loop waits on the same pool without blocking, so async callers share its limits
+        future = self._submit(fn, *args)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            raise self._timed_out(future) from None
+
+    def hash(self, password: str) -> str:
+        return self._run(self.hasher.hash, password)
+
+    def _verify(self, password_hash: str, password: str) -> bool:
+        try:
+            return self.hasher.verify(password_hash, password)
+        except (VerifyMismatchError, VerificationError, InvalidHashError) as e:
+            log.info("Password verification failed: %s", e)
+            return False
+
+    def verify(self, password_hash: str, password: str) -> bool:
+        return self._run(self._verify, password_hash, password)
+
+    async def hash_async(self, password: str) -> str:
+        return await self._run_async(self.hasher.hash, password)
+
+    async def verify_async(self, password_hash: str, password: str) -> bool:
+        return await self._run_async(self._verify, password_hash, password)
+
+    def needs_rehash(self, password_hash: str) -> bool:
+        # True when the hash was made with different Argon2 parameters than the configured ones
+        try:
+            return self.hasher.check_needs_rehash(password_hash)
+        except InvalidHashError:
+            return False
+
+    def rehashed(self):
+        with self._lock:
+            self._rehashed += 1
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "pending": self._pending,
+                "queue_depth": max(0, self._pending - self.max_workers),
+                "max_pending": self._max_pending,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "timeouts": self._timeouts,
+                "rehashed": self._rehashed,
+                "time_cost": self.hasher.time_cost,
+                "memory_cost": self.hasher.memory_cost,
+                "parallelism": self.hasher.parallelism,
+            }
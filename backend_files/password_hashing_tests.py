@@ -0,0 +1,55 @@
+import asyncio
+import threading
+import unittest
+
+from password_hashing import PasswordService, PasswordQueueFull
+
+
+def cheap_service(**kwargs) -> PasswordService:
+    return PasswordService(time_cost=1, memory_cost=8, parallelism=1, **kwargs)
+
+
+class PasswordServiceTests(unittest.TestCase):
+    def test_hash_and_verify(self):
+        service = cheap_service()
+        password_hash = service.hash("secret")
+
+        self.assertTrue(service.verify(password_hash, "secret"))
+        self.assertFalse(service.verify(password_hash, "wrong"))
+        self.assertFalse(service.verify("not a hash", "secret"))
+        self.assertFalse(service.needs_rehash(password_hash))
+        self.assertTrue(PasswordService(time_cost=2, memory_cost=8, parallelism=1).needs_rehash(password_hash))
+
+    def test_full_queue_is_rejected(self):
+        service = cheap_service(max_workers=1, max_queue=0)
+        release = threading.Event()
+        service._submit(release.wait)
+
+        try:
+            with self.assertRaises(PasswordQueueFull):
+                service.hash("secret")
+        finally:
+            release.set()
+
+        self.assertEqual(1, service.metrics()["rejected"])
+
+    def test_timeout_is_reported_as_overload(self):
+        service = cheap_service(max_workers=1, max_queue=1, timeout=0.05)
+        release = threading.Event()
+        service._submit(release.wait)
+
+        try:
+            with self.assertRaises(PasswordQueueFull):
+                service.hash("secret")
+            with self.assertRaises(PasswordQueueFull):
+                asyncio.run(service.hash_async("secret"))
+        finally:
+            release.set()
+
+        self.assertEqual(2, service.metrics()["timeouts"])
+        # The queued jobs that timed out were dropped, the pool is usable again
+        self.assertTrue(service.verify(service.hash("secret"), "secret"))
+
+
+if __name__ == '__main__':
+    unittest.main()
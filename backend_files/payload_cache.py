@@ -0,0 +1,104 @@
+import threading
+from collections import OrderedDict
+
+
+class PayloadCache:
+    # Encoded bodies of hot responses, keyed by their ETag. The ETag covers the request path and the write
+    # versions the response depends on, so a write makes the old entries unreachable and they age out of
+    # the LRU. An entry can carry precompressed variants of the body (encoding -> bytes).
+    # Bounded by the total size of bodies and variants, bodies over `max_entry_bytes` are not kept.
+    # Of the requests building the same entry only the one that claim()ed it buffers the body.
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, max_entry_bytes: int = 16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (body, headers, variants)
+        self._bytes = 0
+        self._claims = set()  # keys whose body a request is buffering
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.too_large = 0
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    @staticmethod
+    def _size(entry: tuple) -> int:
+        return len(entry[0]) + sum(len(variant) for variant in entry[2].values())
+
+    def claim(self, key: str) -> bool:
+        # Whether the caller should buffer the body for `key`, put() or release() ends the claim
+        with self._lock:
+            if key in self._claims:
+                return False
+            self._claims.add(key)
+            return True
+
+    def release(self, key: str):
+        with self._lock:
+            self._claims.discard(key)
+
+    def put(self, key: str, body: bytes, headers: list, variants: dict = None):
+        with self._lock:
+            self._claims.discard(key)
+            if len(body) > self.max_entry_bytes:
+                self.too_large += 1
+                return
+
+            self._store(key, (body, headers, variants or dict()))
+            self.stores += 1
+
+    def add_variants(self, key: str, body: bytes, variants: dict):
+        # Compressed variants made after the entry was put, dropped if the entry is gone or was replaced since
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is body and variants:
+                self._store(key, (body, entry[1], {**entry[2], **variants}))
+
+    def _store(self, key: str, entry: tuple):
+        # Must hold the lock
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= self._size(old)
+
+        self._entries[key] = entry
+        self._bytes += self._size(entry)
+
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= self._size(evicted)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def metrics(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "max_entry_bytes": self.max_entry_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "too_large": self.too_large,
+            }
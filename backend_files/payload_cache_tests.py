@@ -0,0 +1,63 @@
+import unittest
+
+from payload_cache import PayloadCache
+
+HEADERS = [("Content-Type", "application/json")]
+
+
+class PayloadCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.cache = PayloadCache(max_bytes=100, max_entry_bytes=40)
+
+    def test_put_and_get(self):
+        self.cache.put("a", b"[1]", HEADERS)
+        self.assertEqual((b"[1]", HEADERS, {}), self.cache.get("a"))
+        self.assertIsNone(self.cache.get("b"))
+
+    def test_too_large_bodies_are_not_kept(self):
+        self.cache.put("a", b"x" * 41, HEADERS)
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(1, self.cache.metrics()["too_large"])
+
+    def test_least_recently_used_is_evicted(self):
+        for key in "abc":
+            self.cache.put(key, b"x" * 30, HEADERS)
+        self.cache.get("a")
+        self.cache.put("d", b"x" * 30, HEADERS)
+
+        self.assertIsNone(self.cache.get("b"))
+        self.assertIsNotNone(self.cache.get("a"))
+        self.assertEqual((90, 1), (self.cache.metrics()["bytes"], self.cache.metrics()["evictions"]))
+
+    def test_one_claim_per_key(self):
+        self.assertTrue(self.cache.claim("a"))
+        self.assertFalse(self.cache.claim("a"))
+        self.assertTrue(self.cache.claim("b"))
+
+        self.cache.put("a", b"[1]", HEADERS)
+        self.assertTrue(self.cache.claim("a"))
+
+        self.cache.release("b")
+        self.assertTrue(self.cache.claim("b"))
+
+    def test_variants_added_later(self):
+        body = b"[1]"
+        self.cache.put("a", body, HEADERS)
+        self.cache.add_variants("a", body, {"gzip": b"g"})
+
+        self.assertEqual({"gzip": b"g"}, self.cache.get("a")[2])
+        self.assertEqual(4, self.cache.metrics()["bytes"])
+
+    def test_variants_of_a_replaced_body_are_dropped(self):
+        old = b"[1]"
+        self.cache.put("a", old, HEADERS)
+        self.cache.put("a", b"[2]", HEADERS)
+        self.cache.add_variants("a", old, {"gzip": b"g"})
+        self.cache.add_variants("gone", old, {"gzip": b"g"})
+
+        self.assertEqual((b"[2]", HEADERS, {}), self.cache.get("a"))
+        self.assertIsNone(self.cache.get("gone"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,238 @@
+import atexit
+import datetime
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+log = logging.getLogger("toilets.reports")
+
+
+class ReportSink:
+    # Toilet reports go into a bounded queue and are written by one background thread as JSON lines.
+    # Each process writes its own files (reports-<start time>-<pid>.jsonl), rotated by size and age,
+    # so workers never interleave. A report's id_ is "<file name>:<byte offset>" and stays stable.
+    # At most max_files files are kept in the directory, whichever worker wrote them.
+
+    def __init__(self, directory: str = "reports", queue_size: int = 10000, flush_interval: float = 1.0,
+                 max_bytes: int = 10 * 1024 * 1024, max_age: float = 24 * 60 * 60, max_files: int = 50):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_files = max_files
+
+        os.makedirs(directory, exist_ok=True)
+
+        self._queue = queue.Queue(queue_size)
+        self._file = None
+        self._file_opened_at = 0.0
+        self._stopped = threading.Event()
+
+        self.written = 0
+        self.dropped = 0
+        self.rotations = 0
+
+        self._index = ReportIndex(directory)
+
+        self._thread = threading.Thread(target=self._run, name="report-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, user_id: int, toilet_id: int, message: str) -> bool:
+        # Called on the request thread, never blocks and never touches the disk
+        report = {
+            "time_": datetime.datetime.now().isoformat(),
+            "user_id_": user_id,
+            "toilet_id_": toilet_id,
+            "message_": message,
+        }
+
+        try:
+            self._queue.put_nowait(report)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def _open(self):
+        name = f"reports-{datetime.datetime.now().strftime('%Y%m%dT%H%M%S%f')}-{os.getpid()}.jsonl"
+        self._file = open(os.path.join(self.directory, name), "a", encoding="utf-8")
+        self._file_opened_at = time.monotonic()
+
+    def _rotate_if_needed(self):
+        if self._file is None:
+            return
+
+        too_big = self._file.tell() >= self.max_bytes
+        too_old = time.monotonic() - self._file_opened_at >= self.max_age
+        if not (too_big or too_old):
+            return
+
+        self._file.close()
+        self._file = None
+        self.rotations += 1
+
+        self._prune()
+
+    def _prune(self):
+        # Keeps the newest max_files files of all workers together, including those of workers that are gone.
+        # Another worker's newest file may still be open for writing: it is only removed once it hasn't been
+        # written for longer than max_age, by then a live worker has rotated it.
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(".jsonl"))
+
+        newest = {name.rsplit("-", 1)[-1]: name for name in names}  # "<pid>.jsonl" -> newest file of that pid
+        own = f"{os.getpid()}.jsonl"
+        written_before = time.time() - self.max_age - self.flush_interval
+
+        for name in names[:-self.max_files]:
+            path = os.path.join(self.directory, name)
+            try:
+                pid = name.rsplit("-", 1)[-1]
+                if pid != own and newest[pid] == name and os.path.getmtime(path) > written_before:
+                    continue
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # pruned by another worker
+
+    def _write(self, batch: list):
+        if self._file is None:
+            self._open()
+
+        self._file.write("".join(json.dumps(report) + "\n" for report in batch))
+        self.written += len(batch)
+
+    def _run(self):
+        last_flush = time.monotonic()
+
+        while not self._stopped.is_set() or not self._queue.empty():
+            batch = list()
+            try:
+                batch.append(self._queue.get(timeout=self.flush_interval))
+                while len(batch) < 1000:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            try:
+                if batch:
+                    self._write(batch)
+
+                if self._file is not None and time.monotonic() - last_flush >= self.flush_interval:
+                    self._file.flush()
+                    last_flush = time.monotonic()
+
+                self._rotate_if_needed()
+            except OSError as e:
+                log.error("Report log error: %s", e)
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join(timeout=5)
+
+    def query(self, toilet_id: int = None, user_id: int = None, before: str = None, limit: int = 50) -> list:
+        return self._index.query(toilet_id, user_id, before, limit)
+
+    def metrics(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "rotations": self.rotations,
+        }
+
+
+class ReportIndex:
+    # (time, id, toilet id, user id) of every report in the directory, kept in memory so reports can be
+    # filtered and paged without scanning the files. Each query only reads the bytes appended since the last one.
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+        self._lock = threading.Lock()
+        self._offsets = dict()  # file name -> bytes already indexed
+        self._entries = list()  # sorted by (time_, id_)
+
+    def _refresh(self):
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(".jsonl"))
+
+        gone = set(self._offsets) - set(names)
+
+        new_entries = list()
+        for name in names:
+            offset = self._offsets.get(name, 0)
+            try:
+                f = open(os.path.join(self.directory, name), "rb")
+            except FileNotFoundError:
+                gone.add(name)  # pruned by another worker since it was listed
+                continue
+
+            with f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # still being written, picked up next time
+                    try:
+                        report = json.loads(line)
+                        new_entries.append((report["time_"], f"{name}:{offset}",
+                                            str(report.get("toilet_id_")), str(report.get("user_id_"))))
+                    except (ValueError, KeyError):
+                        pass
+                    offset += len(line)
+            self._offsets[name] = offset
+
+        if gone:
+            for name in gone:
+                self._offsets.pop(name, None)
+            self._entries = [entry for entry in self._entries if entry[1].rsplit(":", 1)[0] not in gone]
+
+        if new_entries:
+            self._entries.extend(new_entries)
+            self._entries.sort()
+
+    def _read(self, report_id: str) -> dict:
+        name, offset = report_id.rsplit(":", 1)
+        with open(os.path.join(self.directory, name), "rb") as f:
+            f.seek(int(offset))
+            report = json.loads(f.readline())
+
+        return {"id_": report_id, **report}
+
+    def query(self, toilet_id: int = None, user_id: int = None, before: str = None, limit: int = 50) -> list:
+        # Newest first, `before` is the id_ of the last report of the previous page.
+        # KeyError when there is no such report (anymore).
+        with self._lock:
+            self._refresh()
+
+            found = list()
+            passed_cursor = before is None
+            for entry in reversed(self._entries):
+                if not passed_cursor:
+                    passed_cursor = entry[1] == before
+                    continue
+                if toilet_id is not None and entry[2] != str(toilet_id):
+                    continue
+                if user_id is not None and entry[3] != str(user_id):
+                    continue
+
+                found.append(entry[1])
+                if len(found) == limit:
+                    break
+
+            if not passed_cursor:
+                raise KeyError(before)
+
+        res = list()
+        for report_id in found:
+            try:
+                res.append(self._read(report_id))
+            except (OSError, ValueError):
+                pass  # rotated away in the meantime
+
+        return res
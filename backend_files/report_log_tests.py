@@ -0,0 +1,120 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import report_log
+from report_log import ReportIndex, ReportSink
+
+
+class ReportLogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="toilet_reports_")
+        self.addCleanup(shutil.rmtree, self.directory, True)
+
+    def write_file(self, name: str, reports: list = (), age: float = 0.0) -> str:
+        path = os.path.join(self.directory, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("".join(json.dumps(report) + "\n" for report in reports))
+
+        written_at = time.time() - age
+        os.utime(path, (written_at, written_at))
+        return name
+
+    def files(self) -> list:
+        return sorted(os.listdir(self.directory))
+
+
+class PruneTests(ReportLogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.sink = ReportSink(self.directory, flush_interval=0.01, max_age=3600, max_files=3)
+        self.addCleanup(self.sink.close)
+        self.pid = os.getpid()
+
+    def test_files_of_every_worker_count(self):
+        # Workers 1 and 2 are gone, their files were rotated long ago
+        old = [self.write_file(f"reports-2026010{day}T000000000000-{pid}.jsonl", age=86400)
+               for day, pid in ((1, 1), (2, 2), (3, 1), (4, 2))]
+        own = [self.write_file(f"reports-2026010{day}T000000000000-{self.pid}.jsonl") for day in (5, 6)]
+
+        self.sink._prune()
+
+        self.assertEqual([old[-1]] + own, self.files())
+
+    def test_open_file_of_another_worker_is_kept(self):
+        # Worker 7 may still be appending to its newest file, written to a minute ago
+        names = [self.write_file(f"reports-2026010{day}T000000000000-{pid}.jsonl", age=age)
+                 for day, pid, age in ((1, 7, 86400), (2, 7, 60), (3, self.pid, 0), (4, self.pid, 0),
+                                       (5, self.pid, 0))]
+
+        self.sink._prune()
+
+        self.assertEqual(names[1:], self.files())
+
+    def test_rotation_prunes(self):
+        for day in range(1, 6):
+            self.write_file(f"reports-2026010{day}T000000000000-9.jsonl", age=86400)
+
+        self.sink.max_bytes = 1
+        self.assertTrue(self.sink.submit(1, 2, "broken"))
+        deadline = time.monotonic() + 5
+        while len(self.files()) != 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(1, self.sink.rotations)
+        self.assertEqual(3, len(self.files()))
+        self.assertIn(f"-{self.pid}.jsonl", self.files()[-1])
+
+
+class ReportIndexTests(ReportLogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write_file("reports-20260101T000000000000-1.jsonl",
+                        [{"time_": f"2026-01-01T00:00:0{second}", "user_id_": second % 2, "toilet_id_": 10 + second,
+                          "message_": f"report {second}"} for second in range(5)])
+        self.index = ReportIndex(self.directory)
+
+    def messages(self, reports: list) -> list:
+        return [report["message_"] for report in reports]
+
+    def test_newest_first_in_pages(self):
+        first = self.index.query(limit=2)
+        self.assertEqual(["report 4", "report 3"], self.messages(first))
+
+        second = self.index.query(before=first[-1]["id_"], limit=2)
+        self.assertEqual(["report 2", "report 1"], self.messages(second))
+
+        self.assertEqual(["report 0"], self.messages(self.index.query(before=second[-1]["id_"], limit=2)))
+
+    def test_filters(self):
+        self.assertEqual(["report 3", "report 1"], self.messages(self.index.query(user_id=1)))
+        self.assertEqual(["report 2"], self.messages(self.index.query(toilet_id=12)))
+
+    def test_unknown_cursor(self):
+        with self.assertRaises(KeyError):
+            self.index.query(before="reports-20260101T000000000000-1.jsonl:3")
+
+    def test_files_pruned_while_listing_are_skipped(self):
+        self.index.query()
+        listed = sorted(os.listdir(self.directory)) + ["reports-20260102T000000000000-2.jsonl"]
+        os.remove(os.path.join(self.directory, "reports-20260101T000000000000-1.jsonl"))
+
+        # Both files were pruned by another worker between the listing and the reads
+        with mock.patch.object(report_log.os, "listdir", return_value=listed):
+            self.assertEqual([], self.index.query())
+
+    def test_appended_reports_are_picked_up(self):
+        self.index.query()
+        with open(os.path.join(self.directory, "reports-20260101T000000000000-1.jsonl"), "a", encoding="utf-8") as f:
+            f.write(json.dumps({"time_": "2026-01-01T00:00:09", "user_id_": 3, "toilet_id_": 1, "message_": "new"})
+                    + "\n" + '{"time_": "2026-01-01T00:00:10"')
+
+        self.assertEqual(["new", "report 4"], self.messages(self.index.query(limit=2)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+import threading
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels) -> str:
+    return ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items())
+
+
+class ActiveRequest:
+    # What RequestMetrics collects about one request until end()
+    __slots__ = ("started", "query_count", "query_seconds", "queries", "ended")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.query_count = 0
+        self.query_seconds = 0.0
+        self.queries = list()
+        self.ended = False
+
+
+class RequestMetrics:
+    # Per-route request counts by status, latency histograms and the database statements each request
+    # sent. begin() starts a request on its thread and end() finishes it, once its response is closed.
+    # query() is the connection pools' query_listener and attributes statements to the request bound to
+    # the calling thread: the one begin() started there, or the one whose streamed body bind() is sending.
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS, max_logged_queries: int = 100):
+        self.buckets = buckets
+        self.max_logged_queries = max_logged_queries
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        self._statuses = dict()  # (method, route, status) -> count
+        self._latency = dict()  # (method, route) -> [bucket counts..., sum, count]
+        self._queries = dict()  # (method, route) -> [statements, seconds]
+
+    def begin(self) -> ActiveRequest:
+        active = self._local.request = ActiveRequest()
+        return active
+
+    def query(self, query, seconds: float):
+        active = getattr(self._local, "request", None)
+        if active is None or active.ended:
+            return  # not inside a request, e.g. a background thread
+
+        active.query_count += 1
+        active.query_seconds += seconds
+        if len(active.queries) < self.max_logged_queries:
+            active.queries.append((query, seconds))
+
+    def bind(self, active: ActiveRequest, chunks):
+        # Iterates a streamed body with the statements it sends attributed to `active`, whatever thread
+        # the server sends it from
+        iterator = iter(chunks)
+        try:
+            while True:
+                previous = getattr(self._local, "request", None)
+                self._local.request = active
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self._local.request = previous
+                yield chunk
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+
+    def end(self, active: ActiveRequest, method: str, route: str, status: int) -> tuple:
+        # Returns (seconds, statement count, [(statement, seconds)]) of the request, counted once
+        if active.ended:
+            return 0.0, 0, []
+
+        active.ended = True
+        if getattr(self._local, "request", None) is active:
+            self._local.request = None
+
+        seconds = time.perf_counter() - active.started
+        query_count, query_seconds, queries = active.query_count, active.query_seconds, active.queries
+
+        with self._lock:
+            key = (method, route, status)
+            self._statuses[key] = self._statuses.get(key, 0) + 1
+
+            latency = self._latency.get((method, route))
+            if latency is None:
+                latency = self._latency[(method, route)] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    latency[i] += 1
+            latency[-2] += seconds
+            latency[-1] += 1
+
+            totals = self._queries.setdefault((method, route), [0, 0.0])
+            totals[0] += query_count
+            totals[1] += query_seconds
+
+        return seconds, query_count, queries
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        with self._lock:
+            statuses = sorted(self._statuses.items())
+            latencies = sorted((key, list(values)) for key, values in self._latency.items())
+            queries = sorted((key, list(values)) for key, values in self._queries.items())
+
+        lines = ["# HELP http_requests_total Requests by route and status.",
+                 "# TYPE http_requests_total counter"]
+        for (method, route, status), count in statuses:
+            lines.append(f"http_requests_total{{{_labels(method=method, route=route, status=status)}}} {count}")
+
+        lines += ["# HELP http_request_duration_seconds Time to produce the response.",
+                  "# TYPE http_request_duration_seconds histogram"]
+        for (method, route), values in latencies:
+            labels = _labels(method=method, route=route)
+            for bound, count in zip(self.buckets, values):
+                lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {values[-1]}')
+            lines.append(f"http_request_duration_seconds_sum{{{labels}}} {values[-2]}")
+            lines.append(f"http_request_duration_seconds_count{{{labels}}} {values[-1]}")
+
+        lines += ["# HELP http_request_db_queries_total Database statements sent while handling requests.",
+                  "# TYPE http_request_db_queries_total counter"]
+        for (method, route), (count, _) in queries:
+            lines.append(f"http_request_db_queries_total{{{_labels(method=method, route=route)}}} {count}")
+
+        lines += ["# HELP http_request_db_query_seconds_total Time spent in those statements.",
+                  "# TYPE http_request_db_query_seconds_total counter"]
+        for (method, route), (_, seconds) in queries:
+            lines.append(f"http_request_db_query_seconds_total{{{_labels(method=method, route=route)}}} {seconds}")
+
+        return "\n".join(lines) + "\n"
+
+
+def render_gauges(name: str, help_text: str, values: dict, **labels) -> str:
+    # Numeric entries of a metrics() dict as one gauge family, e.g. the pool or cache counters
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+    for key, value in values.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines.append(f"{name}{{{_labels(**labels, metric=key)}}} {value}")
+
+    return "\n".join(lines) + "\n"
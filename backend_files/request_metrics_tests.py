@@ -0,0 +1,88 @@
+import threading
+import unittest
+
+from request_metrics import RequestMetrics, render_gauges
+
+
+class RequestMetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.metrics = RequestMetrics(buckets=(0.1, 1.0), max_logged_queries=2)
+
+    def test_statements_of_the_request(self):
+        active = self.metrics.begin()
+        self.metrics.query("SELECT 1", 0.5)
+        self.metrics.query("SELECT 2", 0.25)
+        self.metrics.query("SELECT 3", 0.25)
+
+        seconds, query_count, queries = self.metrics.end(active, "GET", "/toilets", 200)
+
+        self.assertEqual(3, query_count)
+        self.assertEqual([("SELECT 1", 0.5), ("SELECT 2", 0.25)], queries)
+        self.assertIn('http_requests_total{method="GET",route="/toilets",status="200"} 1', self.metrics.render())
+        self.assertIn('http_request_db_query_seconds_total{method="GET",route="/toilets"} 1.0', self.metrics.render())
+
+    def test_ended_once(self):
+        active = self.metrics.begin()
+        self.metrics.end(active, "GET", "/", 200)
+        self.metrics.query("SELECT 1", 0.1)
+
+        self.assertEqual((0.0, 0, []), self.metrics.end(active, "GET", "/", 200))
+        self.assertIn('http_requests_total{method="GET",route="/",status="200"} 1', self.metrics.render())
+        self.assertIn('http_request_db_queries_total{method="GET",route="/"} 0', self.metrics.render())
+
+    def test_queries_outside_requests_are_ignored(self):
+        self.metrics.query("SELECT 1", 0.1)
+        self.assertNotIn("http_request_db_queries_total{", self.metrics.render())
+
+    def test_streamed_body_counts_for_its_request(self):
+        # The body is sent after the request's hooks ran, possibly from another thread
+        active = self.metrics.begin()
+        self.metrics.query("DECLARE listing CURSOR", 0.1)
+
+        def body():
+            for page in range(3):
+                self.metrics.query("FETCH 500 FROM listing", 0.1)
+                yield b"[]"
+
+        chunks = self.metrics.bind(active, body())
+        sender = threading.Thread(target=lambda: list(chunks))
+        sender.start()
+        sender.join()
+
+        self.assertEqual(4, self.metrics.end(active, "GET", "/toilets", 200)[1])
+
+    def test_bind_restores_the_thread_request(self):
+        streamed = self.metrics.begin()
+        chunks = self.metrics.bind(streamed, iter([b"[", b"]"]))
+
+        current = self.metrics.begin()
+        next(chunks)
+        self.metrics.query("SELECT 1", 0.1)
+
+        self.assertEqual(1, self.metrics.end(current, "GET", "/", 200)[1])
+        self.assertEqual(0, self.metrics.end(streamed, "GET", "/toilets", 200)[1])
+
+    def test_closing_the_stream_closes_the_body(self):
+        closed = list()
+
+        def body():
+            try:
+                yield b"["
+                yield b"]"
+            finally:
+                closed.append(True)
+
+        chunks = self.metrics.bind(self.metrics.begin(), body())
+        next(chunks)
+        chunks.close()
+        self.assertEqual([True], closed)
+
+
+class RenderGaugesTests(unittest.TestCase):
+    def test_numbers_only(self):
+        self.assertEqual('# HELP pool Pool.\n# TYPE pool gauge\npool{host="primary",metric="size"} 3\n',
+                         render_gauges("pool", "Pool.", {"size": 3, "open": True, "name": "db"}, host="primary"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+import heapq
+import math
+import threading
+
+from clustering import in_box
+
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS_M / 180
+
+
+def haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def parse_coordinates(coordinates):
+    # coordinates_ is stored as "(lat, lon)", the same format the Android app sends
+    try:
+        lat, lon = (float(value) for value in str(coordinates).strip("() ").split(","))
+    except (TypeError, ValueError):
+        return None
+
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+
+    return lat, lon
+
+
+class SpatialIndex:
+    # Grid of fixed size lat/lon cells, nearest neighbours are found by searching rings of cells
+    # around the query point, so the work depends on how many toilets are nearby, not on the total.
+
+    def __init__(self, cell_size_deg: float = 0.01):
+        self.cell_size_deg = cell_size_deg
+        self.columns = math.ceil(360 / cell_size_deg)
+        self.rows = math.ceil(180 / cell_size_deg)
+
+        self._lock = threading.Lock()
+        self._cells = dict()  # (row, column) -> {toilet_id: (lat, lon)}
+        self._locations = dict()  # toilet_id -> (lat, lon, cell)
+
+    def __len__(self):
+        return len(self._locations)
+
+    def cell_of(self, lat: float, lon: float) -> tuple:
+        row = min(int((lat + 90) / self.cell_size_deg), self.rows - 1)
+        column = int((lon + 180) / self.cell_size_deg) % self.columns
+        return row, column
+
+    def add(self, toilet_id: int, lat: float, lon: float):
+        cell = self.cell_of(lat, lon)
+
+        with self._lock:
+            old = self._locations.get(toilet_id)
+            if old is not None:
+                self._cells[old[2]].pop(toilet_id, None)
+
+            self._cells.setdefault(cell, dict())[toilet_id] = (lat, lon)
+            self._locations[toilet_id] = (lat, lon, cell)
+
+    def location(self, toilet_id: int):
+        location = self._locations.get(toilet_id)
+        return location[:2] if location else None
+
+    def _ring(self, row: int, column: int, radius: int):
+        if radius == 0:
+            yield row, column
+            return
+
+        for d_column in range(-radius, radius + 1):
+            yield row - radius, (column + d_column) % self.columns
+            yield row + radius, (column + d_column) % self.columns
+        for d_row in range(-radius + 1, radius):
+            yield row + d_row, (column - radius) % self.columns
+            yield row + d_row, (column + radius) % self.columns
+
+    def _min_ring_distance_m(self, lat: float, radius: int) -> float:
+        # Lower bound for the distance to any point in ring `radius`, cells get narrower towards the poles
+        if radius == 0:
+            return 0.0
+
+        widest_lat = min(89.9, abs(lat) + (radius + 1) * self.cell_size_deg)
+        return (radius - 1) * self.cell_size_deg * METERS_PER_DEGREE * math.cos(math.radians(widest_lat))
+
+    def nearest(self, lat: float, lon: float, k: int, radius_m: float = None) -> list:
+        # Returns up to k (distance_m, toilet_id) pairs, closest first
+        best = []  # max-heap of (-distance, toilet_id)
+        row, column = self.cell_of(lat, lon)
+
+        with self._lock:
+            total = len(self._locations)
+            seen_cells = set()
+            seen = 0
+            radius = 0
+
+            while seen < total:
+                bound = self._min_ring_distance_m(lat, radius)
+                if radius_m is not None and bound > radius_m:
+                    break
+                if len(best) == k and bound > -best[0][0]:
+                    break
+
+                if (2 * radius + 1) ** 2 > len(self._cells):
+                    # The rings have grown bigger than the occupied part of the grid, finish with a plain scan
+                    cells = [cell for cell in self._cells if cell not in seen_cells]
+                else:
+                    cells = [cell for cell in self._ring(row, column, radius)
+                             if 0 <= cell[0] < self.rows and cell not in seen_cells]
+
+                for cell in cells:
+                    seen_cells.add(cell)
+                    points = self._cells.get(cell)
+                    if not points:
+                        continue
+
+                    seen += len(points)
+                    for toilet_id, (point_lat, point_lon) in points.items():
+                        distance = haversine_m(lat, lon, point_lat, point_lon)
+                        if radius_m is not None and distance > radius_m:
+                            continue
+                        if len(best) < k:
+                            heapq.heappush(best, (-distance, toilet_id))
+                        elif distance < -best[0][0]:
+                            heapq.heapreplace(best, (-distance, toilet_id))
+
+                radius += 1
+
+        return sorted((-distance, toilet_id) for distance, toilet_id in best)
+
+    def within(self, min_lat: float, min_lon: float, max_lat: float, max_lon: float, limit: int = None) -> list:
+        # Ids of the toilets inside the box, stops once more than `limit` have been found
+        first_row, first_column = self.cell_of(min_lat, min_lon)
+        last_row, last_column = self.cell_of(max_lat, max_lon)
+        if last_column < first_column:
+            last_column += self.columns
+
+        res = list()
+        with self._lock:
+            if (last_row - first_row + 1) * (last_column - first_column + 1) > len(self._cells):
+                cells = list(self._cells)
+            else:
+                cells = [(row, column % self.columns) for row in range(first_row, last_row + 1)
+                         for column in range(first_column, last_column + 1)]
+
+            for cell in cells:
+                for toilet_id, (lat, lon) in self._cells.get(cell, dict()).items():
+                    if in_box(lat, lon, min_lat, min_lon, max_lat, max_lon):
+                        res.append(toilet_id)
+                        if limit is not None and len(res) > limit:
+                            return res
+
+        return res
@@ -0,0 +1,70 @@
+import random
+import unittest
+
+from spatial_index import SpatialIndex, haversine_m, parse_coordinates
+
+
+class ParseCoordinatesTests(unittest.TestCase):
+    def test_stored_format(self):
+        self.assertEqual((55.75, 37.61), parse_coordinates("(55.75, 37.61)"))
+        self.assertEqual((-33.9, 151.2), parse_coordinates(" (-33.9,151.2) "))
+
+    def test_unreadable(self):
+        for coordinates in (None, "", "nowhere", "(55.75)", "(91, 0)", "(0, 181)"):
+            self.assertIsNone(parse_coordinates(coordinates), coordinates)
+
+
+class HaversineTests(unittest.TestCase):
+    def test_distances(self):
+        self.assertEqual(0, haversine_m(55.75, 37.61, 55.75, 37.61))
+        # One degree of latitude
+        self.assertAlmostEqual(111195, haversine_m(0, 0, 1, 0), delta=1)
+        # Across the antimeridian
+        self.assertAlmostEqual(haversine_m(0, 0, 0, 0.2), haversine_m(0, 179.9, 0, -179.9), places=3)
+
+
+class SpatialIndexTests(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(4)
+        self.points = {toilet_id: (55.5 + rng.random(), 37.2 + rng.random()) for toilet_id in range(1, 501)}
+
+        self.index = SpatialIndex()
+        for toilet_id, (lat, lon) in self.points.items():
+            self.index.add(toilet_id, lat, lon)
+
+    def brute_force(self, lat: float, lon: float, k: int, radius_m: float = None) -> list:
+        distances = sorted((haversine_m(lat, lon, *point), toilet_id) for toilet_id, point in self.points.items())
+        return [pair for pair in distances if radius_m is None or pair[0] <= radius_m][:k]
+
+    def test_nearest_matches_a_full_scan(self):
+        for lat, lon, k, radius_m in ((56.0, 37.7, 10, None), (55.5, 37.2, 3, None), (56.0, 37.7, 100, 2000),
+                                      (40.0, 10.0, 5, None), (40.0, 10.0, 5, 1000)):
+            with self.subTest(lat=lat, lon=lon, k=k, radius_m=radius_m):
+                self.assertEqual(self.brute_force(lat, lon, k, radius_m), self.index.nearest(lat, lon, k, radius_m))
+
+    def test_within(self):
+        expected = {toilet_id for toilet_id, (lat, lon) in self.points.items()
+                    if 55.8 <= lat <= 56.1 and 37.3 <= lon <= 37.5}
+        self.assertEqual(expected, set(self.index.within(55.8, 37.3, 56.1, 37.5)))
+
+    def test_within_stops_past_the_limit(self):
+        self.assertEqual(11, len(self.index.within(55, 37, 57, 39, 10)))
+
+    def test_within_across_the_antimeridian(self):
+        index = SpatialIndex()
+        index.add(1, 10, 179.95)
+        index.add(2, 10, -179.95)
+        index.add(3, 10, 0)
+
+        self.assertEqual({1, 2}, set(index.within(9, 179.9, 11, -179.9)))
+
+    def test_adding_again_moves_the_toilet(self):
+        self.index.add(1, 10.0, 10.0)
+
+        self.assertEqual(len(self.points), len(self.index))
+        self.assertEqual((10.0, 10.0), self.index.location(1))
+        self.assertEqual([(0.0, 1)], self.index.nearest(10.0, 10.0, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class UserCache:
+    # Bounded LRU cache of public user summaries (id_, display_name_, creation_date_).
+    # Misses are loaded together through `loader(ids)`, which must return a list of summaries,
+    # or be a coroutine function returning one when the cache is used through get_many_async().
+    # `version` returns the current users_ version: once it moves on, everything loaded before is
+    # dropped, so a name changed through another worker process is never served under the new ETag.
+    # Writes made by this process invalidate entries explicitly, the TTL bounds staleness without `version`.
+
+    def __init__(self, loader, max_size: int = 10000, ttl: float = 60.0, version=None):
+        self.loader = loader
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version = version
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # id -> (summary, expires at)
+        self._version = None  # users_ version the entries were loaded under
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def _lookup(self, ids) -> tuple:
+        now = time.monotonic()
+        version = self.version() if self.version is not None else None
+        res = dict()
+        missing = list()
+
+        with self._lock:
+            if version is not None and (self._version is None or version > self._version):
+                self.invalidations += len(self._entries)
+                self._entries.clear()
+                self._version = version
+
+            invalidations = self.invalidations
+            for user_id in set(ids):
+                entry = self._entries.get(user_id)
+                if entry is not None and entry[1] <= now:
+                    del self._entries[user_id]
+                    self.expirations += 1
+                    entry = None
+
+                if entry is None:
+                    missing.append(user_id)
+                    self.misses += 1
+                else:
+                    self._entries.move_to_end(user_id)
+                    res[user_id] = entry[0]
+                    self.hits += 1
+
+        return res, missing, (invalidations, version)
+
+    def _store(self, res: dict, loaded: list, state: tuple):
+        expires_at = time.monotonic() + self.ttl
+        invalidations, version = state
+        current = self.version() if self.version is not None else None
+
+        with self._lock:
+            # Something was invalidated or the version moved on while loading, the loaded rows may be older
+            # than that, don't keep them
+            keep = invalidations == self.invalidations and version == current == self._version
+
+            for summary in loaded:
+                res[summary["id_"]] = summary
+                if keep:
+                    self._entries[summary["id_"]] = (summary, expires_at)
+                    self._entries.move_to_end(summary["id_"])
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_many(self, ids) -> dict:
+        res, missing, state = self._lookup(ids)
+        if missing:
+            self._store(res, self.loader(missing), state)
+
+        return res
+
+    async def get_many_async(self, ids) -> dict:
+        res, missing, state = self._lookup(ids)
+        if missing:
+            self._store(res, await self.loader(missing), state)
+
+        return res
+
+    def get(self, user_id: int):
+        return self.get_many([user_id]).get(user_id)
+
+    async def get_async(self, user_id: int):
+        return (await self.get_many_async([user_id])).get(user_id)
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._entries.pop(user_id, None)
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def metrics(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "version": self._version,
+            }
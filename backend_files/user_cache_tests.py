@@ -0,0 +1,103 @@
+import asyncio
+import time
+import unittest
+
+from user_cache import UserCache
+
+
+class Users:
+    # Loader over a dict of display names, counting the ids it was asked for
+    def __init__(self, names: dict):
+        self.names = names
+        self.loaded = list()
+        self.version = 1
+
+    def load(self, ids) -> list:
+        self.loaded += sorted(ids)
+        return [{"id_": user_id, "display_name_": self.names[user_id]} for user_id in ids if user_id in self.names]
+
+    async def load_async(self, ids) -> list:
+        return self.load(ids)
+
+
+class UserCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.users = Users({1: "Ann", 2: "Bob", 3: "Eve"})
+        self.cache = UserCache(self.users.load, max_size=2, ttl=60.0, version=lambda: self.users.version)
+
+    def test_misses_are_loaded_together(self):
+        self.assertEqual({1: {"id_": 1, "display_name_": "Ann"}, 2: {"id_": 2, "display_name_": "Bob"}},
+                         self.cache.get_many([1, 2, 1]))
+        self.assertEqual([1, 2], self.users.loaded)
+
+        self.assertEqual("Ann", self.cache.get(1)["display_name_"])
+        self.assertEqual([1, 2], self.users.loaded)
+        self.assertEqual((1, 2), (self.cache.metrics()["hits"], self.cache.metrics()["misses"]))
+
+    def test_unknown_users_are_missing(self):
+        self.assertIsNone(self.cache.get(404))
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.get_many([1, 2])
+        self.cache.get(1)
+        self.cache.get(3)
+
+        self.users.loaded.clear()
+        self.cache.get_many([1, 2, 3])
+        self.assertEqual([2], self.users.loaded)
+        self.assertEqual(2, self.cache.metrics()["evictions"])
+
+    def test_entries_expire(self):
+        cache = UserCache(self.users.load, ttl=0.0)
+        cache.get(1)
+        time.sleep(0.001)
+        cache.get(1)
+
+        self.assertEqual([1, 1], self.users.loaded)
+        self.assertEqual(1, cache.metrics()["expirations"])
+
+    def test_invalidate(self):
+        self.cache.get(1)
+        self.users.names[1] = "Anna"
+        self.cache.invalidate(1)
+
+        self.assertEqual("Anna", self.cache.get(1)["display_name_"])
+
+    def test_new_users_version_drops_older_entries(self):
+        # A name changed through another worker process: this process only sees the version move on
+        self.cache.get_many([1, 2])
+        self.users.names[1] = "Anna"
+        self.users.version = 2
+
+        self.assertEqual("Anna", self.cache.get(1)["display_name_"])
+        self.assertEqual(2, self.cache.metrics()["version"])
+        self.assertEqual(2, self.cache.metrics()["invalidations"])
+
+    def test_older_version_read_by_a_slower_request_keeps_the_entries(self):
+        self.users.version = 3
+        self.cache.get(1)
+
+        self.users.version = 2
+        self.users.loaded.clear()
+        self.cache.get(1)
+        self.assertEqual([], self.users.loaded)
+
+    def test_rows_loaded_while_the_version_moves_are_not_kept(self):
+        def load(ids):
+            self.users.version += 1
+            return self.users.load(ids)
+
+        self.cache.loader = load
+        self.assertEqual("Ann", self.cache.get(1)["display_name_"])
+        self.assertEqual(0, self.cache.metrics()["size"])
+
+    def test_async(self):
+        cache = UserCache(self.users.load_async, version=lambda: self.users.version)
+
+        self.assertEqual("Bob", asyncio.run(cache.get_async(2))["display_name_"])
+        self.assertEqual({2, 3}, set(asyncio.run(cache.get_many_async([2, 3]))))
+        self.assertEqual([2, 3], self.users.loaded)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import datetime
+
+from spatial_index import parse_coordinates
+
+# Each function checks one incoming item and returns the values to insert, in column order,
+# or raises ValueError with a message meant for the client.
+
+
+def _int(item: dict, key: str) -> int:
+    value = item[key]
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f"{key} must be an integer")
+    return int(value)
+
+
+def _bool(item: dict, key: str) -> bool:
+    value = item[key]
+    if isinstance(value, str) and value.lower() in ("true", "false"):
+        return value.lower() == "true"
+    if not isinstance(value, bool):
+        raise ValueError(f"{key} must be a boolean")
+    return value
+
+
+def parse_time(value, key: str) -> datetime.time:
+    # The app sends "HH:mm", older clients "HH:mm:ss"
+    try:
+        return datetime.time.fromisoformat(str(value))
+    except ValueError:
+        raise ValueError(f"{key} must be a time like HH:MM or HH:MM:SS")
+
+
+def _item(item) -> dict:
+    if not isinstance(item, dict):
+        raise ValueError("Item must be an object")
+    return item
+
+
+def toilet_values(item) -> tuple:
+    # (author_id_, coordinates_, place_name_, is_public_, disabled_access_, baby_access_,
+    #  parking_nearby_, opening_time_, closing_time_, cost_)
+    item = _item(item)
+    try:
+        location = parse_coordinates(item["coordinates_"])
+        if location is None:
+            raise ValueError("coordinates_ must look like \"(lat, lon)\"")
+
+        place_name = item["place_name_"]
+        if place_name is not None and not isinstance(place_name, str):
+            raise ValueError("place_name_ must be a string")
+
+        cost = _int(item, "cost_")
+        if cost < 0:
+            raise ValueError("cost_ can't be negative")
+
+        return (_int(item, "author_id_"), "(%s, %s)" % location, place_name,
+                _bool(item, "is_public_"), _bool(item, "disabled_access_"), _bool(item, "baby_access_"),
+                _bool(item, "parking_nearby_"),
+                parse_time(item["opening_time_"], "opening_time_"), parse_time(item["closing_time_"], "closing_time_"),
+                cost)
+    except KeyError as e:
+        raise ValueError(f"Missing field {e}")
+
+
+def review_values(item) -> tuple:
+    # (toilet_id_, user_id_, rating_, review_text_)
+    item = _item(item)
+    try:
+        rating = _int(item, "rating_")
+        if not 1 <= rating <= 5:
+            raise ValueError("rating_ must be between 1 and 5")
+
+        review_text = item.get("review_text_")
+        if review_text is not None and not isinstance(review_text, str):
+            raise ValueError("review_text_ must be a string")
+
+        return _int(item, "toilet_id_"), _int(item, "user_id_"), rating, review_text
+    except KeyError as e:
+        raise ValueError(f"Missing field {e}")
+
+
+def verification_values(item) -> tuple:
+    # (toilet_id_, user_id_, vote_)
+    item = _item(item)
+    try:
+        vote = _int(item, "vote")
+        if vote not in (-1, 1):
+            raise ValueError("vote must be 1 or -1")
+
+        return _int(item, "toilet_id"), _int(item, "user_id"), vote
+    except KeyError as e:
+        raise ValueError(f"Missing field {e}")
+
+
+def toilet_filters(args, now: datetime.time) -> dict:
+    # GET /toilets query arguments -> filters for db_connector.toilet_conditions(), absent ones don't filter.
+    # open_now is answered for `now`, the local time of the toilets.
+    filters = dict()
+    for key in ("is_public", "disabled_access", "baby_access", "parking", "open_now"):
+        value = args.get(key, "").lower()
+        if not value:
+            continue
+        if value not in ("true", "false"):
+            raise ValueError(f"{key} must be true or false")
+        filters[key] = value == "true"
+
+    if args.get("max_cost"):
+        try:
+            filters["max_cost"] = int(args["max_cost"])
+        except ValueError:
+            raise ValueError("max_cost must be an integer")
+
+    if "open_now" in filters:
+        filters["open_at"] = now
+
+    return filters
@@ -0,0 +1,75 @@
+import hashlib
+import threading
+import time
+
+
+class VersionTracker:
+    # In-memory copy of data_versions_. Every write bumps its keys in the database in the same
+    # transaction and updates this copy straight away. Writes made by other worker processes are
+    # picked up by refresh(), at most once every `refresh_interval` seconds, so checking an ETag
+    # normally doesn't touch the database at all.
+
+    def __init__(self, refresh_interval: float = 1.0, overlap_seconds: int = 60):
+        self.refresh_interval = refresh_interval
+        self.overlap_seconds = overlap_seconds
+
+        self._lock = threading.Lock()
+        self._versions = dict()  # key -> (version, modified_at)
+        self._last_refresh = None
+        self._refreshed_at = 0.0
+
+    def needs_refresh(self) -> bool:
+        return time.monotonic() - self._refreshed_at >= self.refresh_interval
+
+    def _refresh_query(self) -> tuple:
+        # Rows are read with some overlap, transactions that started earlier may have committed since
+        if self._last_refresh is None:
+            return "SELECT key_, version_, modified_at_ FROM data_versions_", None
+
+        return ("SELECT key_, version_, modified_at_ FROM data_versions_ "
+                "WHERE modified_at_ > %s - make_interval(secs => %s)", (self._last_refresh, self.overlap_seconds))
+
+    def refresh(self, cur):
+        self._refreshed_at = time.monotonic()
+
+        cur.execute("SELECT now()")
+        now = cur.fetchone()[0]
+
+        cur.execute(*self._refresh_query())
+
+        self.update(cur.fetchall())
+        self._last_refresh = now
+
+    async def refresh_async(self, cur):
+        # Same as refresh() on an async psycopg cursor
+        self._refreshed_at = time.monotonic()
+
+        await cur.execute("SELECT now()")
+        now = (await cur.fetchone())[0]
+
+        await cur.execute(*self._refresh_query())
+
+        self.update(await cur.fetchall())
+        self._last_refresh = now
+
+    def update(self, rows):
+        with self._lock:
+            for key, version, modified_at in rows:
+                current = self._versions.get(key)
+                if current is None or current[0] < version:
+                    self._versions[key] = (version, modified_at)
+
+    def get(self, key: str) -> tuple:
+        return self._versions.get(key, (0, None))
+
+    def etag(self, resource: str, keys: list) -> tuple:
+        # Strong ETag over the resource and the versions it depends on, plus the newest modification time
+        versions = [self.get(key) for key in keys]
+
+        digest = hashlib.blake2b(resource.encode(), digest_size=12)
+        for key, (version, _) in zip(keys, versions):
+            digest.update(f"|{key}={version}".encode())
+
+        modified = [modified_at for _, modified_at in versions if modified_at is not None]
+
+        return digest.hexdigest(), max(modified) if modified else None
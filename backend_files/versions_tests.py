@@ -0,0 +1,68 @@
+import datetime
+import unittest
+
+from versions import VersionTracker
+
+NOW = datetime.datetime(2026, 5, 1, 12, 0, tzinfo=datetime.timezone.utc)
+
+
+class Cursor:
+    # Answers SELECT now() and then the data_versions_ rows it was given, recording the queries
+    def __init__(self, rows: list):
+        self.rows = rows
+        self.executed = list()
+        self._result = None
+
+    def execute(self, query: str, params=None):
+        self.executed.append((query, params))
+        self._result = [(NOW,)] if query == "SELECT now()" else self.rows
+
+    def fetchone(self):
+        return self._result[0]
+
+    def fetchall(self):
+        return self._result
+
+
+class VersionTrackerTests(unittest.TestCase):
+    def setUp(self):
+        self.versions = VersionTracker(refresh_interval=60.0)
+
+    def test_etag_follows_the_versions(self):
+        self.versions.update([("toilets_", 1, NOW)])
+        etag, last_modified = self.versions.etag("/toilets", ["toilets_", "users_"])
+
+        self.assertEqual(NOW, last_modified)
+        self.assertEqual(etag, self.versions.etag("/toilets", ["toilets_", "users_"])[0])
+        self.assertNotEqual(etag, self.versions.etag("/toilets?limit=1", ["toilets_", "users_"])[0])
+
+        self.versions.update([("users_", 1, NOW)])
+        self.assertNotEqual(etag, self.versions.etag("/toilets", ["toilets_", "users_"])[0])
+
+    def test_never_written_keys(self):
+        self.assertEqual((0, None), self.versions.get("toilets_"))
+        self.assertIsNone(self.versions.etag("/toilets", ["toilets_"])[1])
+
+    def test_older_versions_are_ignored(self):
+        later = NOW + datetime.timedelta(seconds=5)
+        self.versions.update([("toilets_", 3, later)])
+        self.versions.update([("toilets_", 2, NOW)])
+
+        self.assertEqual((3, later), self.versions.get("toilets_"))
+
+    def test_refresh_reads_everything_then_recent_rows(self):
+        cur = Cursor([("toilets_", 4, NOW)])
+        self.assertTrue(self.versions.needs_refresh())
+
+        self.versions.refresh(cur)
+        self.assertEqual("SELECT key_, version_, modified_at_ FROM data_versions_", cur.executed[1][0])
+        self.assertEqual(4, self.versions.get("toilets_")[0])
+        self.assertFalse(self.versions.needs_refresh())
+
+        cur.executed.clear()
+        self.versions.refresh(cur)
+        self.assertEqual((NOW, 60), cur.executed[1][1])
+
+
+if __name__ == '__main__':
+    unittest.main()